@@ -4,19 +4,39 @@ import hmac
 import hashlib
 import asyncio
 from datetime import datetime, timezone, timedelta
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS  # Import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from dotenv import load_dotenv
 from supabase import create_client, Client
-from question_generator import QuestionGenerator
+# Sets up gRPC for gevent workers, so it must come before the LLM backend is imported
+from serving import run_blocking
+from question_generator import QuestionGenerator, EXTRACTOR_VERSION
+import text_store
+import content_cache
+import bulk_ingest
+import sandbox
+from sandbox import ExtractionError
+from redis_client import get_redis
+from pipeline import Pipeline, PipelineCancelled, Heartbeat, Deadline, CancelToken
+from job_events import (publish_job_event, stream_job_events, acquire_stream_slot, release_stream_slot,
+                        SSE_MAX_STREAMS, SSE_POLL_FALLBACK_S)
+from scheduler import get_scheduler
 import logging
 import time
 import re
 import unicodedata
 import random
-from functools import wraps
+import threading
+import socket
+import sys
+import subprocess
+import tempfile
+import zipfile
+import uuid
+import requests
+from functools import wraps, partial
 
 # Load environment variables
 load_dotenv()
@@ -210,6 +230,27 @@ def require_active_subscription(f):
     
     return decorated_function
 
+def is_admin_key(auth_key):
+    """Whether auth_key is ADMIN_SECRET_KEY; while that is unset, no key is."""
+    admin_key = os.getenv('ADMIN_SECRET_KEY')
+    if not admin_key or not auth_key:
+        return False
+    return hmac.compare_digest(auth_key.encode(), admin_key.encode())
+
+if not os.getenv('ADMIN_SECRET_KEY'):
+    app.logger.warning("ADMIN_SECRET_KEY is not set, admin endpoints will refuse every request")
+
+# Define a decorator to protect admin endpoints with the shared admin key
+def require_admin_key(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not is_admin_key(request.headers.get('X-Admin-Key')):
+            app.logger.warning(f"Unauthorized attempt to access admin endpoint: {request.path}")
+            return jsonify({"error": "Unauthorized access"}), 401
+        return f(*args, **kwargs)
+    
+    return decorated_function
+
 # Initialize Supabase client
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_KEY")
@@ -224,6 +265,765 @@ RC_WEBHOOK_SECRET = os.getenv("REVENUECAT_WEBHOOK_SECRET", "")
 # Initialize question generator
 question_generator = QuestionGenerator()
 
+# Lazy explanations: generate only stems/options/answers on upload, explanations on demand
+LAZY_EXPLANATIONS = os.getenv('LAZY_EXPLANATIONS', 'off').lower() == 'on'
+
+# Upload failure codes the client may retry automatically
+RETRYABLE_ERROR_CODES = {'llm_unavailable', 'llm_timeout', 'llm_rate_limited', 'queue_timeout'}
+
+# Processing jobs touch their row this often; one silent for JOB_STALE_AFTER_S lost its worker
+JOB_HEARTBEAT_S = float(os.getenv('JOB_HEARTBEAT_S', '30'))
+JOB_STALE_AFTER_S = float(os.getenv('JOB_STALE_AFTER_S', '180'))
+# A job whose worker died this many times is failed instead of resumed again
+JOB_MAX_RESUMES = int(os.getenv('JOB_MAX_RESUMES', '2'))
+JOB_REAPER_INTERVAL_S = float(os.getenv('JOB_REAPER_INTERVAL_S', '60'))
+
+# Load parsers and the LLM SDK in the background after boot instead of on the first upload
+WARM_UP_ON_START = os.getenv('WARM_UP_ON_START', 'off').lower() == 'on'
+
+# Files a single upload may combine into one quiz
+MAX_FILES_PER_UPLOAD = int(os.getenv('MAX_FILES_PER_UPLOAD', '5'))
+
+# Time budgets: a request must answer before gunicorn's --timeout (300s) kills the worker;
+# background jobs have no such limit but are bounded too
+REQUEST_BUDGET_S = float(os.getenv('REQUEST_BUDGET_S', '270'))
+JOB_BUDGET_S = float(os.getenv('JOB_BUDGET_S', '600'))
+
+def build_question_rows(job_id, questions):
+    """Map generated questions to rows for the questions table."""
+    rows = []
+    for q in questions:
+        question_data = {
+            'job_id': job_id,
+            'created_at': datetime.now(timezone.utc).isoformat()
+        }
+        
+        # Copy essential fields
+        for key in ['question', 'options']:
+            if key in q:
+                question_data[key] = q[key]
+        
+        # Fix field name mismatch - map 'correctAnswer' to 'correct_option_index'
+        if 'correctAnswer' in q:
+            question_data['correct_option_index'] = q['correctAnswer']
+        elif 'correct_option_index' in q:
+            question_data['correct_option_index'] = q['correct_option_index']
+        
+        # Include explanation field if it exists (left empty in lazy mode, filled on demand)
+        if q.get('explanation'):
+            question_data['explanation'] = q['explanation']
+        
+        # Chunk of the extracted text the question came from, used to regenerate it alone
+        for key in ['source_chunk', 'source_start', 'source_end']:
+            if q.get(key) is not None:
+                question_data[key] = q[key]
+        
+        rows.append(question_data)
+    return rows
+
+ALLOWED_MIME_TYPES = [
+    'application/pdf', 
+    'text/plain', 
+    'application/msword', 
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+]
+
+def resolve_mime_type(mime_type, filename):
+    """Determine the type from the filename when the client sent application/octet-stream."""
+    if mime_type == 'application/octet-stream':
+        filename = filename.lower()
+        if filename.endswith('.pdf'):
+            app.logger.info(f"Overriding octet-stream with application/pdf based on filename: {filename}")
+            mime_type = 'application/pdf'
+        elif filename.endswith('.txt'):
+            app.logger.info(f"Overriding octet-stream with text/plain based on filename: {filename}")
+            mime_type = 'text/plain'
+        elif filename.endswith('.doc'):
+            app.logger.info(f"Overriding octet-stream with application/msword based on filename: {filename}")
+            mime_type = 'application/msword'
+        elif filename.endswith('.docx'):
+            app.logger.info(f"Overriding octet-stream with application/vnd.openxmlformats-officedocument.wordprocessingml.document based on filename: {filename}")
+            mime_type = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+    return mime_type
+
+def check_upload_quota(user_id):
+    """Check the daily upload limit; returns an error response tuple, or None if the user may upload."""
+    try:
+        result = supabase.table('user_subscriptions').select('status').eq('user_id', user_id).eq('status', 'active').execute()
+        has_subscription = len(result.data) > 0
+        
+        # Get today's uploads - use explicit UTC date range
+        today = datetime.now(timezone.utc).date()
+        today_start = datetime.combine(today, datetime.min.time()).replace(tzinfo=timezone.utc)
+        today_end = datetime.combine(today, datetime.max.time()).replace(tzinfo=timezone.utc)
+        
+        # Debug logging
+        app.logger.warning(f"Checking uploads between {today_start.isoformat()} and {today_end.isoformat()} for user {user_id}")
+        
+        uploads_today = supabase.table('uploads').select('id', count='exact')\
+            .eq('user_id', user_id)\
+            .gte('created_at', today_start.isoformat())\
+            .lte('created_at', today_end.isoformat())\
+            .execute()
+        
+        # Set limits based on subscription status
+        daily_limit = 10 if has_subscription else 1
+        upload_count = uploads_today.count if hasattr(uploads_today, 'count') and uploads_today.count is not None else 0
+        
+        app.logger.warning(f"User uploads today: {upload_count}/{daily_limit}, Premium: {has_subscription}")
+        
+        # Check if user has reached their limit
+        if upload_count >= daily_limit:
+            error_message = "הגעת למכסת ההעלאות היומית למשתמשי פרימיום" if has_subscription else "הגעת למכסת ההעלאות היומית למשתמשי חינם. שדרג לפרימיום להעלאות נוספות."
+            english_message = "Free users are limited to 1 upload per day. Please upgrade to premium for increased limits."
+            return jsonify({
+                "error": error_message,
+                "code": "free_limit_reached" if not has_subscription else "premium_limit_reached",
+                "message": english_message if not has_subscription else error_message
+            }), 403
+    except Exception as e:
+        app.logger.error(f"Error checking subscription: {str(e)}")
+        # In case of error, continue without checking subscription
+    return None
+
+def is_premium_user(user_id):
+    """Whether the user has an active subscription; used to pick the scheduler lane."""
+    try:
+        result = supabase.table('user_subscriptions').select('status').eq('user_id', user_id).eq('status', 'active').execute()
+        return len(result.data) > 0
+    except Exception as e:
+        app.logger.error(f"Error checking subscription tier: {str(e)}")
+        return False
+
+def check_generation_admission(user_id):
+    """
+    Shed new uploads while generation is saturated; returns a 503 response tuple, or None to accept.
+    
+    Runs before the quota check and before the upload row exists, so a shed
+    upload does not count against the daily limit or leave a job behind.
+    """
+    admission = get_scheduler().admit(premium=is_premium_user(user_id))
+    if admission.admitted:
+        return None
+    response = jsonify({
+        "error": "שירות יצירת השאלות עמוס כרגע. נסה שוב בעוד מספר דקות.",
+        "code": "overloaded",
+        "retryable": True,
+        "retry_after": admission.retry_after,
+        "message": "Question generation is at capacity. Please try again shortly."
+    })
+    response.headers['Retry-After'] = str(admission.retry_after)
+    return response, 503
+
+# Supabase signed upload URLs are valid for two hours; pending direct uploads expire with them
+DIRECT_UPLOAD_TTL_S = 2 * 60 * 60
+
+def pending_upload_key(job_id):
+    return f"upload:pending:{job_id}"
+
+# Resumable uploads: the file arrives in fixed-size chunks, each stored as soon as it is received
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(5 * 1024 * 1024)))
+# Sessions survive a day of interrupted connectivity; every received chunk extends them
+UPLOAD_SESSION_TTL_S = 24 * 60 * 60
+
+def upload_session_key(job_id):
+    return f"upload:session:{job_id}"
+
+def upload_session_chunks_key(job_id):
+    return f"upload:session:{job_id}:chunks"
+
+def upload_session_progress(session, received):
+    """Progress summary of a resumable upload session for the client."""
+    missing = [index for index in range(session['total_chunks']) if index not in received]
+    received_bytes = sum(
+        min(session['chunk_size'], session['size'] - index * session['chunk_size']) for index in received
+    )
+    return {
+        "job_id": session['job_id'],
+        "size": session['size'],
+        "chunk_size": session['chunk_size'],
+        "total_chunks": session['total_chunks'],
+        "received_bytes": received_bytes,
+        "missing_chunks": missing,
+        "complete": not missing
+    }
+
+# Unreferenced file blobs are only collected after this long, so an upload that just reused
+# a blob has time to insert the upload row that references it
+BLOB_GC_GRACE_HOURS = float(os.getenv('BLOB_GC_GRACE_HOURS', '24'))
+
+def blob_storage_path(digest):
+    """Storage path of the content-addressed object for a SHA-256 digest."""
+    return f"blobs/{digest[:2]}/{digest}"
+
+def store_file_blob(file_content, mime_type, staging_path=None, digest=None):
+    """
+    Store file content once per SHA-256 digest; returns (storage path, digest).
+    
+    Byte-identical files uploaded by different users share one object under
+    blobs/. The storage PUT is skipped when the blob is already recorded, and
+    its last_referenced_at is refreshed so the garbage collector keeps it.
+    Files the client uploaded directly are moved from their staging_path
+    instead of being uploaded again.
+    """
+    digest = digest or hashlib.sha256(file_content).hexdigest()
+    storage_path = blob_storage_path(digest)
+    now = datetime.now(timezone.utc).isoformat()
+    
+    existing = supabase.table('file_blobs').select('sha256').eq('sha256', digest).execute()
+    if existing.data:
+        supabase.table('file_blobs').update({'last_referenced_at': now}).eq('sha256', digest).execute()
+        app.logger.info(f"File blob {digest} already stored, skipping upload of {len(file_content)} bytes")
+        if staging_path:
+            supabase.storage.from_('uploads').remove([staging_path])
+        return storage_path, digest
+    
+    try:
+        if staging_path:
+            supabase.storage.from_('uploads').move(staging_path, storage_path)
+        else:
+            supabase.storage.from_('uploads').upload(storage_path, file_content, {"content-type": mime_type})
+    except Exception as e:
+        # A concurrent upload of the same content stored the object first - it is identical
+        if 'Duplicate' not in str(e) and 'already exists' not in str(e):
+            raise
+        app.logger.info(f"File blob {digest} was stored concurrently")
+        if staging_path:
+            supabase.storage.from_('uploads').remove([staging_path])
+    
+    supabase.table('file_blobs').upsert({
+        'sha256': digest,
+        'storage_path': storage_path,
+        'size_bytes': len(file_content),
+        'mime_type': mime_type,
+        'last_referenced_at': now
+    }).execute()
+    return storage_path, digest
+
+def store_extracted_text(user_id, job_id, text):
+    """
+    Store cleaned extracted text zstd-compressed next to the upload.
+    
+    Returns the uploads columns to set (path, text hash, extractor version),
+    or an empty dict if the text could not be stored.
+    """
+    path = f"{user_id}/{job_id}/extracted.txt{text_store.COMPRESSED_SUFFIX}"
+    try:
+        compressed, digest = text_store.compress_text(text)
+        supabase.storage.from_('uploads').upload(path, compressed, {"content-type": text_store.CONTENT_TYPE})
+        return {
+            'extracted_text_path': path,
+            'extracted_text_hash': digest,
+            'extractor_version': EXTRACTOR_VERSION
+        }
+    except Exception as e:
+        # Not fatal - reprocessing falls back to re-extracting the original file
+        app.logger.error(f"Error storing extracted text for job {job_id}: {str(e)}")
+        return {}
+
+def open_storage_stream(bucket, path):
+    """Open a storage object as a streamed HTTP response (caller closes it)."""
+    response = requests.get(
+        f"{supabase_url}/storage/v1/object/{bucket}/{path}",
+        headers={"apikey": supabase_key, "Authorization": f"Bearer {supabase_key}"},
+        stream=True,
+        timeout=(5, 60)
+    )
+    response.raise_for_status()
+    response.raw.decode_content = True
+    return response
+
+def read_stored_text(path):
+    """Read stored extracted text, decompressing it while it streams in."""
+    if not path.endswith(text_store.COMPRESSED_SUFFIX):
+        # Older uploads stored plain UTF-8
+        return supabase.storage.from_('uploads').download(path).decode('utf-8')
+    try:
+        with open_storage_stream('uploads', path) as response:
+            return text_store.read_text(response.raw)
+    except Exception as e:
+        app.logger.warning(f"Streaming {path} failed, downloading it whole: {str(e)}")
+        return text_store.decompress_text(supabase.storage.from_('uploads').download(path))
+
+def read_storage_object(path, max_bytes):
+    """Stream an object from storage into memory, refusing objects larger than max_bytes."""
+    try:
+        chunks = []
+        size = 0
+        with open_storage_stream('uploads', path) as response:
+            for chunk in response.iter_content(chunk_size=256 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"File exceeds the maximum size of {max_bytes} bytes")
+                chunks.append(chunk)
+        return b''.join(chunks)
+    except requests.RequestException as e:
+        app.logger.warning(f"Streaming {path} failed, downloading it whole: {str(e)}")
+        content = supabase.storage.from_('uploads').download(path)
+        if len(content) > max_bytes:
+            raise ValueError(f"File exceeds the maximum size of {max_bytes} bytes")
+        return content
+
+def load_extracted_text(upload):
+    """Load the cleaned text of an upload, re-extracting (and storing) it if it was never saved."""
+    if upload.get('extracted_text_path'):
+        try:
+            return read_stored_text(upload['extracted_text_path'])
+        except Exception as e:
+            app.logger.error(f"Error loading extracted text for job {upload['id']}: {str(e)}")
+    
+    # Older uploads: parse the original file once and keep the result for next time
+    app.logger.info(f"No stored text for job {upload['id']}, re-extracting from the original file")
+    if upload.get('source_files'):
+        documents = []
+        for source in upload['source_files']:
+            file_content = supabase.storage.from_('uploads').download(source['storage_path'])
+            text = run_blocking(question_generator.extract_text, file_content, source['mime_type'])
+            documents.append((source['file_name'], question_generator.clean_text(text)))
+        clean_text = question_generator.combine_documents(documents)
+    else:
+        file_content = supabase.storage.from_('uploads').download(upload['storage_path'])
+        clean_text = run_blocking(question_generator.prepare_text, file_content, upload['mime_type'])
+    text_fields = store_extracted_text(upload['user_id'], upload['id'], clean_text)
+    if text_fields:
+        supabase.table('uploads').update(text_fields).eq('id', upload['id']).execute()
+    return clean_text
+
+def lookup_content_cache(file_content):
+    """The content cache entry of a file (see content_cache.py), or None."""
+    entry = content_cache.get_cached_content(supabase, hashlib.sha256(file_content).hexdigest(), EXTRACTOR_VERSION)
+    if entry:
+        app.logger.info(f"Content cache hit for {entry['content_sha256']} ({entry.get('source')})")
+    return entry
+
+def load_cached_content_text(entry):
+    """The cached text of a content cache entry; None without an entry or if it cannot be read."""
+    if not entry:
+        return None
+    try:
+        return content_cache.load_cached_text(supabase, entry)
+    except Exception as e:
+        app.logger.warning(f"Could not read cached text {entry.get('text_path')}, extracting the file: {str(e)}")
+        return None
+
+def process_upload(job_id, user_id, file_content, mime_type, store_file=None, upload_row=None, deadline=None,
+                   documents=None):
+    """
+    Run the upload processing pipeline; returns the question count.
+    
+    The steps form a small DAG so independent work overlaps: storing the file
+    (store_file) and inserting the upload row (upload_row) run alongside text
+    extraction and question generation, so the first LLM call does not wait
+    for the storage round trip. The first failing stage cancels the others
+    and its exception is re-raised. Stage timings are saved on the upload.
+    
+    Every stage works within deadline (JOB_BUDGET_S from now by default):
+    extraction may use half of what is left, and generation returns the
+    questions it has when the budget runs out, so a partial quiz is stored
+    instead of the worker being killed with nothing saved.
+    
+    documents, a list of (file name, content, MIME type), replaces
+    file_content and mime_type for an upload of several files: each is
+    extracted in its own stage, concurrently, and their texts are combined
+    under one content budget for a single generation pass.
+    """
+    num_questions = 20  # As per architecture document
+    documents = documents or [(None, file_content, mime_type)]
+    app.logger.debug(f"Generating questions using {', '.join(doc_mime_type for _, _, doc_mime_type in documents)} files")
+    pipeline = Pipeline(f"upload {job_id}", deadline=deadline or Deadline(JOB_BUDGET_S))
+    
+    if store_file:
+        pipeline.add('store_file', store_file)
+    if upload_row:
+        def insert_upload():
+            supabase.table('uploads').insert(upload_row).execute()
+            # A stage that failed while the insert was in flight could not mark the row failed yet
+            if pipeline.token.cancelled:
+                mark_upload_failed(job_id, PipelineCancelled(pipeline.token.reason))
+            else:
+                publish_job_event(job_id, 'uploaded')
+        
+        pipeline.add('insert_upload', insert_upload)
+    
+    else:
+        # Direct and resumable uploads already have their row and their file in storage
+        publish_job_event(job_id, 'uploaded')
+    
+    def extract(cache_entry):
+        publish_job_event(job_id, 'extracting')
+        clean_text = load_cached_content_text(cache_entry)
+        if clean_text is not None:
+            return clean_text
+        deadline = pipeline.token.deadline
+        return run_blocking(question_generator.prepare_text, file_content, mime_type,
+                            deadline=deadline.child(deadline.remaining() / 2))
+    
+    def extract_document(index, content, doc_mime_type):
+        publish_job_event(job_id, 'extracting', document=index)
+        clean_text = load_cached_content_text(lookup_content_cache(content))
+        if clean_text is not None:
+            return clean_text
+        deadline = pipeline.token.deadline
+        text = run_blocking(question_generator.extract_text, content, doc_mime_type,
+                            deadline=deadline.child(deadline.remaining() / 2))
+        return question_generator.clean_text(text)
+    
+    def combine(*texts):
+        return question_generator.combine_documents([(name, text) for (name, _, _), text in zip(documents, texts)])
+    
+    def generate(clean_text, premium, cache_entry=None):
+        # A pre-processed course pack already has its questions
+        questions = content_cache.cached_questions(cache_entry, num_questions, not LAZY_EXPLANATIONS)
+        if questions:
+            app.logger.info(f"Using {len(questions)} cached questions for job {job_id}")
+            return questions
+        return generate_job_questions(job_id, user_id, clean_text, num_questions, premium,
+                                      cancel_token=pipeline.token, timings=pipeline.timings['generate'])
+    
+    def checkpoint_text(text_fields, *_):
+        # Saved right away, not at completion, so a resumed job never re-parses the file
+        if text_fields and not update_owned_job(job_id, text_fields):
+            raise PipelineCancelled(f"Job {job_id} was taken over by another worker")
+    
+    # Extract once and keep the text so "more questions" can skip re-parsing the file
+    if len(documents) == 1:
+        _, file_content, mime_type = documents[0]
+        pipeline.add('cache_lookup', lambda: lookup_content_cache(file_content))
+        pipeline.add('extract', extract, deps=['cache_lookup'], inline=True)
+    else:
+        for index, (_, content, doc_mime_type) in enumerate(documents):
+            pipeline.add(f'extract_{index}', partial(extract_document, index, content, doc_mime_type))
+        pipeline.add('extract', combine, deps=[f'extract_{index}' for index in range(len(documents))])
+    pipeline.add('store_text', lambda clean_text: store_extracted_text(user_id, job_id, clean_text),
+                 deps=['extract'])
+    pipeline.add('checkpoint_text', checkpoint_text,
+                 deps=['store_text'] + (['insert_upload'] if upload_row else []))
+    pipeline.add('tier', lambda: is_premium_user(user_id))
+    # Holds its thread through the scheduler queue and every LLM call, so it runs on this one
+    pipeline.add('generate', generate, deps=['extract', 'tier'] + (['cache_lookup'] if len(documents) == 1 else []),
+                 inline=True)
+    
+    def complete(text_fields, questions, *_):
+        # The quiz is only usable once the file, the text and the questions are all stored.
+        # Questions reference the upload row, so this also waits for the insert.
+        publish_job_event(job_id, 'storing', question_count=len(questions))
+        if not questions:
+            app.logger.warning("No questions were generated")
+        question_count = complete_job(job_id, {
+            'stage_timings': dict(pipeline.timings),
+            'checkpoint': None,
+            **text_fields
+        }, questions)
+        app.logger.debug("Questions stored and upload status updated to completed")
+        publish_job_event(job_id, 'completed', question_count=question_count,
+                          partial=question_count < num_questions)
+        return question_count
+    
+    pipeline.add('complete', complete,
+                 deps=['store_text', 'generate'] + (['insert_upload'] if upload_row else [])
+                 + (['store_file'] if store_file else []))
+    with job_heartbeat(job_id, pipeline.token):
+        return pipeline.run()['complete']
+
+def worker_id():
+    """Identify this worker process on the jobs it processes."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def update_owned_job(job_id, fields):
+    """
+    Update a processing job's row only while this worker owns it; returns whether it did.
+    
+    The reaper hands a stale job to another worker by rewriting worker_id, so a
+    worker that was only cut off (not dead) finds its writes matching no row.
+    """
+    result = supabase.table('uploads').update(fields)\
+        .eq('id', job_id)\
+        .eq('status', 'processing')\
+        .eq('worker_id', worker_id())\
+        .execute()
+    return bool(result.data)
+
+def job_heartbeat(job_id, token):
+    """
+    Keep the upload row's heartbeat fresh while this worker owns the job.
+    
+    Once another worker has taken the job over, token is cancelled so this
+    one stops instead of finishing the job a second time.
+    """
+    def beat():
+        if not update_owned_job(job_id, {'heartbeat_at': datetime.now(timezone.utc).isoformat()}):
+            if not token.cancelled:
+                app.logger.warning(f"Job {job_id} was taken over by another worker, stopping")
+            token.cancel("job was taken over by another worker")
+    return Heartbeat(job_id, beat, JOB_HEARTBEAT_S)
+
+def complete_job(job_id, fields, questions):
+    """
+    Store a job's questions and mark it completed while this worker owns it; returns the question count.
+    
+    The insert and the status change are one fenced transaction (complete_upload_job),
+    so a worker that was taken over stores nothing and the new owner's questions are
+    never touched. Raises PipelineCancelled if another worker has taken the job over.
+    """
+    if fields and not update_owned_job(job_id, fields):
+        raise PipelineCancelled(f"Job {job_id} was taken over by another worker")
+    stored = supabase.rpc('complete_upload_job', {
+        'target_job_id': job_id,
+        'owner_worker_id': worker_id(),
+        'question_rows': build_question_rows(job_id, questions)
+    }).execute().data
+    if stored is None:
+        raise PipelineCancelled(f"Job {job_id} was taken over by another worker")
+    return stored
+
+def save_job_checkpoint(job_id, checkpoint):
+    """Persist the partial results of a processing job this worker owns; best effort."""
+    try:
+        update_owned_job(job_id, {'checkpoint': checkpoint})
+    except Exception as e:
+        app.logger.warning(f"Could not checkpoint job {job_id}: {str(e)}")
+
+def generate_job_questions(job_id, user_id, clean_text, num_questions, premium,
+                           cancel_token=None, timings=None, done_questions=None):
+    """
+    Generate the questions of an upload job, checkpointing every accepted question.
+    
+    done_questions are questions checkpointed by an earlier attempt of the job;
+    only the remainder is generated, excluding them. timings receives the time
+    spent waiting for a generation slot.
+    """
+    done_questions = list(done_questions or [])[:num_questions]
+    remaining = num_questions - len(done_questions)
+    if remaining <= 0:
+        return done_questions
+    
+    include_explanations = not LAZY_EXPLANATIONS
+    def checkpoint(questions):
+        save_job_checkpoint(job_id, {
+            'num_questions': num_questions,
+            'include_explanations': include_explanations,
+            'extractor_version': EXTRACTOR_VERSION,
+            'questions': done_questions + questions
+        })
+    
+    # Wait for a cluster-wide generation slot; premium users have their own lane.
+    # Queueing may use at most half of the time left, the rest is for generating.
+    deadline = cancel_token.deadline if cancel_token else None
+    with get_scheduler().slot(
+        user_id, premium=premium,
+        on_queued=lambda ahead: publish_job_event(job_id, 'queued', jobs_ahead=ahead),
+        max_wait=deadline.remaining() / 2 if deadline else None
+    ) as queue_wait:
+        if timings is not None:
+            timings['queue_wait_ms'] = round(queue_wait * 1000)
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        publish_job_event(job_id, 'generating', question_count=len(done_questions), total=num_questions)
+        questions = question_generator.generate_questions_from_text(
+            clean_text, remaining,
+            include_explanations=include_explanations,
+            exclude_questions=done_questions or None,
+            cancel_token=cancel_token,
+            on_progress=lambda count: publish_job_event(job_id, 'generating', question_count=len(done_questions) + count, total=num_questions),
+            on_checkpoint=checkpoint
+        )
+    return done_questions + questions
+
+def resume_upload(upload):
+    """
+    Finish a job whose worker died, from its last checkpoint; returns the question count.
+    
+    The stored text is reused instead of re-parsing the file, and only the
+    questions missing from the checkpoint are generated. Questions are stored
+    together with the completion, so a job still processing has none yet;
+    one stored by an older worker is simply marked completed.
+    """
+    job_id, user_id = upload['id'], upload['user_id']
+    publish_job_event(job_id, 'resumed', attempt=upload.get('resume_attempts'))
+    cancel_token = CancelToken(Deadline(JOB_BUDGET_S))
+    with job_heartbeat(job_id, cancel_token):
+        stored = supabase.table('questions').select('id', count='exact').eq('job_id', job_id).execute()
+        question_count = stored.count if stored.count is not None else len(stored.data or [])
+        questions = []
+        if not question_count:
+            checkpoint = upload.get('checkpoint') or {}
+            clean_text = load_extracted_text(upload)
+            questions = generate_job_questions(
+                job_id, user_id, clean_text, checkpoint.get('num_questions', 20), is_premium_user(user_id),
+                cancel_token=cancel_token, done_questions=checkpoint.get('questions')
+            )
+            publish_job_event(job_id, 'storing', question_count=len(questions))
+            question_count = len(questions)
+        
+        complete_job(job_id, {'checkpoint': None}, questions)
+    publish_job_event(job_id, 'completed', question_count=question_count)
+    return question_count
+
+def run_resumed_upload(upload):
+    """Background task: resume a job taken over from a dead worker."""
+    try:
+        question_count = resume_upload(upload)
+        app.logger.info(f"Resumed job {upload['id']} completed with {question_count} questions")
+    except Exception as e:
+        app.logger.error(f"Error resuming job {upload['id']}: {str(e)}")
+        mark_upload_failed(upload['id'], e)
+
+def reap_stale_jobs(limit=20):
+    """
+    Take over processing jobs whose heartbeat went stale and resume them here.
+    
+    A job is claimed with a conditional update on its old heartbeat, so when
+    several workers sweep at once only one resumes it. Jobs that already lost
+    their worker JOB_MAX_RESUMES times are failed instead.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(seconds=JOB_STALE_AFTER_S)).isoformat()
+    stale = supabase.table('uploads')\
+        .select('*')\
+        .eq('status', 'processing')\
+        .lt('heartbeat_at', cutoff)\
+        .limit(limit)\
+        .execute().data or []
+    
+    resumed, failed = [], []
+    for upload in stale:
+        attempts = (upload.get('resume_attempts') or 0) + 1
+        claimed = supabase.table('uploads').update({
+            'heartbeat_at': now.isoformat(),
+            'worker_id': worker_id(),
+            'resume_attempts': attempts
+        }).eq('id', upload['id']).eq('status', 'processing').eq('heartbeat_at', upload['heartbeat_at']).execute().data
+        if not claimed:
+            continue  # Another worker got there first
+        
+        app.logger.warning(f"Job {upload['id']} lost worker {upload.get('worker_id')}, attempt {attempts}")
+        if attempts > JOB_MAX_RESUMES:
+            mark_upload_failed(upload['id'], Exception(f"Processing was interrupted {attempts} times"))
+            failed.append(upload['id'])
+            continue
+        
+        threading.Thread(target=run_resumed_upload, args=({**upload, **claimed[0]},), daemon=True).start()
+        resumed.append(upload['id'])
+    return {"resumed": resumed, "failed": failed}
+
+def job_reaper_loop():
+    """Background thread: sweep for stale jobs; one worker in the cluster sweeps per interval."""
+    while True:
+        time.sleep(JOB_REAPER_INTERVAL_S + random.uniform(0, 5))
+        try:
+            if not get_redis().set('job:reaper:lock', worker_id(), nx=True, ex=max(1, int(JOB_REAPER_INTERVAL_S))):
+                continue
+            result = reap_stale_jobs()
+            if result['resumed'] or result['failed']:
+                app.logger.warning(f"Job reaper resumed {len(result['resumed'])} and failed {len(result['failed'])} stale jobs")
+        except Exception as e:
+            app.logger.error(f"Job reaper error: {str(e)}")
+
+def mark_upload_failed(job_id, error):
+    """
+    Record a processing failure on the upload row, with the error's machine-readable
+    code when it has one (retryable LLM errors, classified extraction failures).
+    """
+    # Other exceptions may have a code too (postgrest's SQLSTATE), which is not ours to store
+    classified = getattr(error, 'retryable', False) or isinstance(error, ExtractionError)
+    error_code = getattr(error, 'code', None) if classified else None
+    try:
+        failed_update = {'status': 'failed', 'error_message': str(error)[:1000]}
+        if error_code:
+            failed_update['error_code'] = error_code
+        if not update_owned_job(job_id, failed_update):
+            # A job another worker has taken over is that worker's to finish or fail
+            row = supabase.table('uploads').select('worker_id').eq('id', job_id).execute().data
+            if row and row[0].get('worker_id') != worker_id():
+                app.logger.info(f"Job {job_id} now belongs to {row[0].get('worker_id')}, not marking it failed")
+                return
+        app.logger.info(f"Updated job {job_id} status to failed")
+    except Exception as update_error:
+        app.logger.error(f"Error updating failed status: {str(update_error)}")
+    publish_job_event(job_id, 'failed', error=str(error)[:1000], error_code=error_code,
+                      retryable=error_code in RETRYABLE_ERROR_CODES)
+
+def process_direct_upload(job_id, user_id, staging_path, mime_type):
+    """Background task: process a file the client uploaded straight to storage."""
+    deadline = Deadline(JOB_BUDGET_S)
+    try:
+        file_content = read_storage_object(staging_path, app.config['MAX_CONTENT_LENGTH'])
+        
+        def adopt_file():
+            storage_path, content_sha256 = store_file_blob(file_content, mime_type, staging_path=staging_path)
+            supabase.table('uploads').update({
+                'storage_path': storage_path,
+                'content_sha256': content_sha256
+            }).eq('id', job_id).execute()
+            return storage_path, content_sha256
+        
+        question_count = process_upload(job_id, user_id, file_content, mime_type, store_file=adopt_file,
+                                        deadline=deadline)
+        app.logger.info(f"Direct upload {job_id} processed with {question_count} questions")
+    except Exception as e:
+        app.logger.error(f"Error processing direct upload {job_id}: {str(e)}")
+        mark_upload_failed(job_id, e)
+
+def process_chunked_upload(job_id, user_id, chunk_paths, mime_type):
+    """Background task: assemble a resumable upload from its stored chunks and process it."""
+    deadline = Deadline(JOB_BUDGET_S)
+    try:
+        file_content = b''.join(read_storage_object(path, UPLOAD_CHUNK_SIZE) for path in chunk_paths)
+        
+        def store_assembled_file():
+            storage_path, content_sha256 = store_file_blob(file_content, mime_type)
+            supabase.table('uploads').update({
+                'storage_path': storage_path,
+                'content_sha256': content_sha256
+            }).eq('id', job_id).execute()
+            try:
+                supabase.storage.from_('uploads').remove(chunk_paths)
+            except Exception as e:
+                app.logger.error(f"Error removing chunks of upload {job_id}: {str(e)}")
+            return storage_path, content_sha256
+        
+        question_count = process_upload(job_id, user_id, file_content, mime_type, store_file=store_assembled_file,
+                                        deadline=deadline)
+        app.logger.info(f"Resumable upload {job_id} processed with {question_count} questions")
+    except Exception as e:
+        app.logger.error(f"Error processing resumable upload {job_id}: {str(e)}")
+        mark_upload_failed(job_id, e)
+
+def fill_missing_explanations(job_id, questions):
+    """Generate and persist explanations for questions that do not have one yet; returns id -> explanation."""
+    missing = [q for q in questions if not q.get('explanation')]
+    if not missing:
+        return {}
+    
+    explanations = question_generator.generate_explanations(missing)
+    
+    # The questions table is the cache - later requests read the stored explanation
+    for question_id, explanation in explanations.items():
+        try:
+            supabase.table('questions').update({'explanation': explanation}).eq('id', question_id).execute()
+        except Exception as e:
+            app.logger.error(f"Error storing explanation for question {question_id}: {str(e)}")
+    return explanations
+
+def wrong_answer_explanations(job_id, question_ids):
+    """Batch-generate the missing explanations for the questions a user got wrong; returns id -> explanation."""
+    try:
+        result = supabase.table('questions')\
+            .select('id, question, options, correct_option_index, explanation')\
+            .eq('job_id', job_id)\
+            .in_('id', question_ids)\
+            .execute()
+        questions = result.data or []
+        explanations = {str(q['id']): q['explanation'] for q in questions if q.get('explanation')}
+        generated = fill_missing_explanations(job_id, questions)
+        app.logger.info(f"Generated {len(generated)} explanations for wrong answers in job {job_id}")
+        explanations.update(generated)
+        return explanations
+    except Exception as e:
+        app.logger.error(f"Error generating explanations for job {job_id}: {str(e)}")
+        return {}
+
 def verify_lemonsqueezy_signature(payload, signature):
     """Verify that the webhook payload was sent by LemonSqueezy."""
     if not LS_SIGNING_SECRET:
@@ -575,6 +1375,9 @@ def upload_file():
         response.headers.add('Access-Control-Allow-Credentials', 'true')
         return response
     
+    # Everything below has to finish before gunicorn's worker timeout
+    deadline = Deadline(REQUEST_BUDGET_S)
+    
     # Enhanced logging for debugging
     app.logger.warning("Upload endpoint called with Content-Type: %s", request.content_type)
     app.logger.warning("Request headers: %s", dict(request.headers))
@@ -604,194 +1407,106 @@ def upload_file():
             app.logger.error("No user ID provided in token or form data")
             return jsonify({"error": "Authentication required", "code": "auth_required"}), 401
     
+    # Shed load before anything counts against the user's quota
+    overload_error = check_generation_admission(user_id)
+    if overload_error:
+        return overload_error
+    
     # Check for subscription
-    try:
-        result = supabase.table('user_subscriptions').select('status').eq('user_id', user_id).eq('status', 'active').execute()
-        has_subscription = len(result.data) > 0
-        
-        # Get today's uploads - use explicit UTC date range
-        today = datetime.now(timezone.utc).date()
-        today_start = datetime.combine(today, datetime.min.time()).replace(tzinfo=timezone.utc)
-        today_end = datetime.combine(today, datetime.max.time()).replace(tzinfo=timezone.utc)
-        
-        # Debug logging
-        app.logger.warning(f"Checking uploads between {today_start.isoformat()} and {today_end.isoformat()} for user {user_id}")
-        
-        uploads_today = supabase.table('uploads').select('id', count='exact')\
-            .eq('user_id', user_id)\
-            .gte('created_at', today_start.isoformat())\
-            .lte('created_at', today_end.isoformat())\
-            .execute()
-        
-        # Set limits based on subscription status
-        daily_limit = 10 if has_subscription else 1
-        upload_count = uploads_today.count if hasattr(uploads_today, 'count') and uploads_today.count is not None else 0
-        
-        app.logger.warning(f"User uploads today: {upload_count}/{daily_limit}, Premium: {has_subscription}")
-        
-        # Check if user has reached their limit
-        if upload_count >= daily_limit:
-            error_message = "הגעת למכסת ההעלאות היומית למשתמשי פרימיום" if has_subscription else "הגעת למכסת ההעלאות היומית למשתמשי חינם. שדרג לפרימיום להעלאות נוספות."
-            english_message = "Free users are limited to 1 upload per day. Please upgrade to premium for increased limits."
-            return jsonify({
-                "error": error_message,
-                "code": "free_limit_reached" if not has_subscription else "premium_limit_reached",
-                "message": english_message if not has_subscription else error_message
-            }), 403
-    except Exception as e:
-        app.logger.error(f"Error checking subscription: {str(e)}")
-        # In case of error, continue without checking subscription
-        pass
+    quota_error = check_upload_quota(user_id)
+    if quota_error:
+        return quota_error
     
-    # Check for file
-    if 'file' not in request.files:
+    # Check for file - several 'file' parts make one quiz across all of them
+    files = request.files.getlist('file')
+    if not files:
         app.logger.error("No file in request")
         app.logger.error(f"Request content type: {request.content_type}")
         app.logger.error(f"Request files: {request.files}")
         app.logger.error(f"Request form: {request.form}")
         return jsonify({"error": "No file provided"}), 400
     
-    file = request.files['file']
-    
-    if not file.filename:
-        app.logger.error("Empty filename")
-        return jsonify({"error": "Empty filename"}), 400
-        
-    mime_type = file.content_type
-    app.logger.info(f"File upload attempt - filename: {file.filename}, content_type: {mime_type}, user_id: {user_id}")
+    if len(files) > MAX_FILES_PER_UPLOAD:
+        app.logger.error(f"Too many files in one upload: {len(files)}")
+        return jsonify({"error": f"At most {MAX_FILES_PER_UPLOAD} files can be combined into one quiz",
+                        "code": "too_many_files"}), 400
     
-    # Check file type
-    allowed_types = [
-        'application/pdf', 
-        'text/plain', 
-        'application/msword', 
-        'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        'application/vnd.openxmlformats-officedocument.presentationml.presentation'
-    ]
-    
-    # For debugging - try to determine type from filename if mime_type is application/octet-stream
-    if mime_type == 'application/octet-stream':
-        filename = file.filename.lower()
-        if filename.endswith('.pdf'):
-            app.logger.info(f"Overriding octet-stream with application/pdf based on filename: {filename}")
-            mime_type = 'application/pdf'
-        elif filename.endswith('.txt'):
-            app.logger.info(f"Overriding octet-stream with text/plain based on filename: {filename}")
-            mime_type = 'text/plain'
-        elif filename.endswith('.doc'):
-            app.logger.info(f"Overriding octet-stream with application/msword based on filename: {filename}")
-            mime_type = 'application/msword'
-        elif filename.endswith('.docx'):
-            app.logger.info(f"Overriding octet-stream with application/vnd.openxmlformats-officedocument.wordprocessingml.document based on filename: {filename}")
-            mime_type = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-    
-    if mime_type not in allowed_types:
-        app.logger.error(f"Unsupported file type: {mime_type}")
-        return jsonify({"error": f"Unsupported file type: {mime_type}"}), 400
+    mime_types = []
+    for file in files:
+        if not file.filename:
+            app.logger.error("Empty filename")
+            return jsonify({"error": "Empty filename"}), 400
+        
+        app.logger.info(f"File upload attempt - filename: {file.filename}, content_type: {file.content_type}, user_id: {user_id}")
+        
+        # Check file type
+        mime_type = resolve_mime_type(file.content_type, file.filename)
+        if mime_type not in ALLOWED_MIME_TYPES:
+            app.logger.error(f"Unsupported file type: {mime_type}")
+            return jsonify({"error": f"Unsupported file type: {mime_type}"}), 400
+        mime_types.append(mime_type)
     
     try:
-        # Read file content
-        file_content = file.read()
-        
         # Generate unique job ID
         job_id = f"{user_id}_{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
         
-        # Store file in Supabase Storage
-        try:
-            # Sanitize the filename to avoid Supabase storage issues
-            original_filename = file.filename
-            sanitized_filename, display_name = sanitize_filename(original_filename)
+        sources = []
+        for file, mime_type in zip(files, mime_types):
+            # Read file content
+            file_content = file.read()
             
-            storage_path = f"{user_id}/{job_id}/{sanitized_filename}"
-            
-            # Attempt storage
-            supabase.storage.from_('uploads').upload(storage_path, file_content)
-            app.logger.debug("File uploaded to Supabase storage")
-            
-            # Continue to use display name in the database for display purposes
-            original_filename_for_db = display_name
-        except Exception as storage_error:
-            app.logger.error(f"Error storing file in Supabase: {str(storage_error)}")
-            raise storage_error
-        
-        # Create upload record with original filename but sanitized storage path
+            # Sanitize the filename to avoid Supabase storage issues
+            sanitized_filename, display_name = sanitize_filename(file.filename)
+            
+            # Content-addressed storage - the path is known before the object is written
+            content_sha256 = hashlib.sha256(file_content).hexdigest()
+            sources.append({
+                'file_name': display_name,
+                'mime_type': mime_type,
+                'storage_path': blob_storage_path(content_sha256),
+                'content_sha256': content_sha256,
+                'content': file_content
+            })
+        
+        # Create upload record with original filename but content-addressed storage path;
+        # the first file fills the single-file columns
         upload_data = {
             'id': job_id,
             'user_id': user_id,
-            'file_name': original_filename_for_db,
-            'mime_type': mime_type,
-            'storage_path': storage_path,
+            'file_name': ' + '.join(source['file_name'] for source in sources),
+            'mime_type': sources[0]['mime_type'],
+            'storage_path': sources[0]['storage_path'],
+            'content_sha256': sources[0]['content_sha256'],
             'status': 'processing',
+            'heartbeat_at': datetime.now(timezone.utc).isoformat(),
+            'worker_id': worker_id(),
             'created_at': datetime.now(timezone.utc).isoformat()
         }
-        
-        try:
-            supabase.table('uploads').insert(upload_data).execute()
-            app.logger.debug("Upload record created in database")
-        except Exception as db_error:
-            app.logger.error(f"Error creating upload record: {str(db_error)}")
-            raise db_error
-        
-        # Generate questions (non-async version)
-        num_questions = 20  # As per architecture document
-        app.logger.debug(f"Generating questions using {mime_type} file")
-        
-        try:
-            # Use the generate_questions method but in a non-async way
-            questions = question_generator.generate_questions(file_content, mime_type, num_questions)
-            app.logger.debug(f"Generated {len(questions)} questions")
-        except Exception as gen_error:
-            app.logger.error(f"Error generating questions: {str(gen_error)}")
-            raise gen_error
-        
-        # Store questions in database
-        try:
-            if questions:
-                processed_questions = []
-                for q in questions:
-                    question_data = {
-                        'job_id': job_id,
-                        'created_at': datetime.now(timezone.utc).isoformat()
-                    }
-                    
-                    # Copy essential fields
-                    for key in ['question', 'options']:
-                        if key in q:
-                            question_data[key] = q[key]
-                    
-                    # Fix field name mismatch - map 'correctAnswer' to 'correct_option_index'
-                    if 'correctAnswer' in q:
-                        question_data['correct_option_index'] = q['correctAnswer']
-                    elif 'correct_option_index' in q:
-                        question_data['correct_option_index'] = q['correct_option_index']
-                    
-                    # Include explanation field if it exists
-                    if 'explanation' in q:
-                        question_data['explanation'] = q['explanation']
-                    
-                    processed_questions.append(question_data)
-                
-                supabase.table('questions').insert(processed_questions).execute()
-                app.logger.debug("Questions stored in database")
-            else:
-                app.logger.warning("No questions were generated")
-        except Exception as q_db_error:
-            app.logger.error(f"Error storing questions: {str(q_db_error)}")
-            raise q_db_error
-        
-        # Update upload status
-        try:
-            supabase.table('uploads').update({'status': 'completed'}).eq('id', job_id).execute()
-            app.logger.debug("Upload status updated to completed")
-        except Exception as status_error:
-            app.logger.error(f"Error updating upload status: {str(status_error)}")
-            raise status_error
+        if len(sources) > 1:
+            upload_data['source_files'] = [
+                {key: source[key] for key in ('file_name', 'mime_type', 'storage_path', 'content_sha256')}
+                for source in sources
+            ]
+            upload_data['source_sha256s'] = [source['content_sha256'] for source in sources]
+        
+        def store_files():
+            for source in sources:
+                store_file_blob(source['content'], source['mime_type'], digest=source['content_sha256'])
+        
+        # Generate questions - storing the files and the upload row overlap with extraction and generation
+        question_count = process_upload(
+            job_id, user_id, sources[0]['content'], sources[0]['mime_type'],
+            store_file=store_files,
+            upload_row=upload_data,
+            deadline=deadline,
+            documents=[(source['file_name'], source['content'], source['mime_type']) for source in sources]
+        )
         
         # Ensure the response has CORS headers
         response = jsonify({
             "success": True,
             "job_id": job_id,
-            "question_count": len(questions),
+            "question_count": question_count,
             "has_subscription": True
         })
         
@@ -812,20 +1527,39 @@ def upload_file():
         
     except Exception as e:
         app.logger.error(f"Error processing file upload: {str(e)}")
+        # Retryable LLM failures (circuit open, deadline exceeded) carry a machine-readable code
+        error_code = getattr(e, 'code', None) if getattr(e, 'retryable', False) else None
+        
         # If job ID was created, update status to failed
         if 'job_id' in locals():
-            try:
-                supabase.table('uploads').update({'status': 'failed'}).eq('id', job_id).execute()
-                app.logger.info(f"Updated job {job_id} status to failed")
-            except Exception as update_error:
-                app.logger.error(f"Error updating failed status: {str(update_error)}")
+            mark_upload_failed(job_id, e)
         
         # Check for PostgreSQL P0001 error related to upload limits
         error_str = str(e)
         status_code = 500
         response_data = {"error": error_str}
-        
-        if "P0001" in error_str:
+        retry_after = None
+        
+        if error_code:
+            # The AI service is degraded - tell the client it is safe to retry later
+            status_code = 503
+            retry_after = int(getattr(e, 'retry_after', 0) or 30)
+            response_data = {
+                "error": "שירות יצירת השאלות עמוס כרגע. נסה שוב בעוד מספר דקות.",
+                "code": error_code,
+                "retryable": True,
+                "message": "Question generation is temporarily unavailable. Please try again shortly."
+            }
+        elif isinstance(e, ExtractionError):
+            # The file itself could not be parsed within the sandbox limits; retrying will not help
+            status_code = 422
+            response_data = {
+                "error": "לא הצלחנו לקרוא את הקובץ. ודא שהקובץ תקין או נסה קובץ אחר.",
+                "code": e.code,
+                "retryable": False,
+                "message": error_str
+            }
+        elif "P0001" in error_str:
             # Handle database-level upload limit trigger errors
             if "Free users are limited to 1 upload per day" in error_str:
                 app.logger.warning("Caught database trigger error for free user upload limit")
@@ -856,23 +1590,431 @@ def upload_file():
                     except Exception as update_error:
                         app.logger.error(f"Error updating job status: {str(update_error)}")
         
-        # Ensure error response has CORS headers
-        response = jsonify(response_data)
+        # Ensure error response has CORS headers
+        response = jsonify(response_data)
+        
+        # Get the origin from the request
+        origin = request.headers.get('Origin', '*')
+        
+        # Set explicit Access-Control-Allow-Origin based on the request origin
+        if origin in ALLOWED_ORIGINS:
+            response.headers['Access-Control-Allow-Origin'] = origin
+        else:
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Accept, Origin'
+        response.headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        if retry_after:
+            response.headers['Retry-After'] = str(retry_after)
+        
+        return response, status_code
+
+@app.route('/api/upload/url', methods=['POST'])
+@limiter.limit("100 per day, 20 per minute")
+@add_cors_headers
+def create_upload_url():
+    """Issue a signed URL the client uploads the file to directly, bypassing the Flask worker."""
+    try:
+        # Get user ID from token
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token:
+            return jsonify({"error": "No authentication token provided"}), 401
+        
+        # Extract user ID from the token claims
+        try:
+            user_id = None
+            data = supabase.auth.get_user(token)
+            user_id = data.user.id if data and data.user else None
+            
+            if not user_id:
+                return jsonify({"error": "Invalid authentication token"}), 401
+        except Exception as auth_error:
+            app.logger.error(f"Auth error: {str(auth_error)}")
+            return jsonify({"error": "Authentication error"}), 401
+        
+        body = request.get_json(silent=True) or {}
+        file_name = body.get('file_name')
+        if not file_name:
+            return jsonify({"error": "file_name is required"}), 400
+        
+        mime_type = resolve_mime_type(body.get('mime_type') or 'application/octet-stream', file_name)
+        if mime_type not in ALLOWED_MIME_TYPES:
+            app.logger.error(f"Unsupported file type: {mime_type}")
+            return jsonify({"error": f"Unsupported file type: {mime_type}"}), 400
+        
+        # Reject over-quota users before they spend time uploading
+        quota_error = check_upload_quota(user_id)
+        if quota_error:
+            return quota_error
+        
+        job_id = f"{user_id}_{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+        sanitized_filename, display_name = sanitize_filename(file_name)
+        staging_path = f"incoming/{user_id}/{job_id}/{sanitized_filename}"
+        
+        signed = supabase.storage.from_('uploads').create_signed_upload_url(staging_path)
+        
+        # The upload row is only created on finalize; until then the session lives in Redis
+        get_redis().set(pending_upload_key(job_id), json.dumps({
+            'user_id': user_id,
+            'file_name': display_name,
+            'mime_type': mime_type,
+            'staging_path': staging_path
+        }), ex=DIRECT_UPLOAD_TTL_S)
+        
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "upload_url": signed['signed_url'],
+            "token": signed['token'],
+            "path": staging_path,
+            "mime_type": mime_type,
+            "expires_in": DIRECT_UPLOAD_TTL_S
+        }), 200
+        
+    except Exception as e:
+        app.logger.error(f"Error creating upload URL: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/upload/<job_id>/finalize', methods=['POST'])
+@limiter.limit("100 per day, 20 per minute")
+@add_cors_headers
+def finalize_upload(job_id):
+    """Queue processing of a file uploaded through a signed URL; poll /api/job/status for the result."""
+    try:
+        # Get user ID from token
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token:
+            return jsonify({"error": "No authentication token provided"}), 401
+        
+        # Extract user ID from the token claims
+        try:
+            user_id = None
+            data = supabase.auth.get_user(token)
+            user_id = data.user.id if data and data.user else None
+            
+            if not user_id:
+                return jsonify({"error": "Invalid authentication token"}), 401
+        except Exception as auth_error:
+            app.logger.error(f"Auth error: {str(auth_error)}")
+            return jsonify({"error": "Authentication error"}), 401
+        
+        redis_client = get_redis()
+        pending_raw = redis_client.get(pending_upload_key(job_id))
+        pending = json.loads(pending_raw) if pending_raw else None
+        if not pending or pending['user_id'] != user_id:
+            return jsonify({"error": "Upload session not found or expired"}), 404
+        
+        # The object must exist before processing is queued
+        staging_path = pending['staging_path']
+        folder, object_name = staging_path.rsplit('/', 1)
+        objects = supabase.storage.from_('uploads').list(folder) or []
+        stored_object = next((o for o in objects if o.get('name') == object_name), None)
+        if not stored_object:
+            return jsonify({"error": "File has not been uploaded yet", "code": "upload_missing"}), 409
+        
+        size = (stored_object.get('metadata') or {}).get('size')
+        if size and size > app.config['MAX_CONTENT_LENGTH']:
+            supabase.storage.from_('uploads').remove([staging_path])
+            redis_client.delete(pending_upload_key(job_id))
+            return jsonify({"error": "File is too large", "code": "file_too_large"}), 413
+        
+        # The pending upload is kept, so a shed finalize can simply be retried
+        overload_error = check_generation_admission(user_id)
+        if overload_error:
+            return overload_error
+        
+        # Quota is checked again - several URLs may have been issued before any was finalized
+        quota_error = check_upload_quota(user_id)
+        if quota_error:
+            return quota_error
+        
+        # Only the first finalize call for a session gets to queue the job
+        if not redis_client.delete(pending_upload_key(job_id)):
+            return jsonify({"error": "Upload was already finalized", "job_id": job_id}), 409
+        
+        supabase.table('uploads').insert({
+            'id': job_id,
+            'user_id': user_id,
+            'file_name': pending['file_name'],
+            'mime_type': pending['mime_type'],
+            'storage_path': staging_path,
+            'status': 'processing',
+            'heartbeat_at': datetime.now(timezone.utc).isoformat(),
+            'worker_id': worker_id(),
+            'created_at': datetime.now(timezone.utc).isoformat()
+        }).execute()
+        
+        # Processing streams the file from storage - the request returns right away
+        threading.Thread(
+            target=process_direct_upload,
+            args=(job_id, user_id, staging_path, pending['mime_type']),
+            daemon=True
+        ).start()
+        
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "status": "processing"
+        }), 202
+        
+    except Exception as e:
+        app.logger.error(f"Error finalizing upload: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/upload/sessions', methods=['POST'])
+@limiter.limit("100 per day, 20 per minute")
+@add_cors_headers
+def create_upload_session():
+    """Start a resumable upload; the file is then sent in chunks of chunk_size bytes."""
+    try:
+        # Get user ID from token
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token:
+            return jsonify({"error": "No authentication token provided"}), 401
+        
+        # Extract user ID from the token claims
+        try:
+            user_id = None
+            data = supabase.auth.get_user(token)
+            user_id = data.user.id if data and data.user else None
+            
+            if not user_id:
+                return jsonify({"error": "Invalid authentication token"}), 401
+        except Exception as auth_error:
+            app.logger.error(f"Auth error: {str(auth_error)}")
+            return jsonify({"error": "Authentication error"}), 401
+        
+        body = request.get_json(silent=True) or {}
+        file_name = body.get('file_name')
+        if not file_name:
+            return jsonify({"error": "file_name is required"}), 400
+        try:
+            size = int(body.get('size', 0))
+        except (TypeError, ValueError):
+            size = 0
+        if size <= 0:
+            return jsonify({"error": "size must be the file size in bytes"}), 400
+        if size > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({"error": "File is too large", "code": "file_too_large"}), 413
+        
+        mime_type = resolve_mime_type(body.get('mime_type') or 'application/octet-stream', file_name)
+        if mime_type not in ALLOWED_MIME_TYPES:
+            app.logger.error(f"Unsupported file type: {mime_type}")
+            return jsonify({"error": f"Unsupported file type: {mime_type}"}), 400
+        
+        # Reject over-quota users before they spend time uploading
+        quota_error = check_upload_quota(user_id)
+        if quota_error:
+            return quota_error
+        
+        job_id = f"{user_id}_{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+        sanitized_filename, display_name = sanitize_filename(file_name)
+        session = {
+            'job_id': job_id,
+            'user_id': user_id,
+            'file_name': display_name,
+            'mime_type': mime_type,
+            'size': size,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'total_chunks': (size + UPLOAD_CHUNK_SIZE - 1) // UPLOAD_CHUNK_SIZE,
+            'chunk_prefix': f"incoming/{user_id}/{job_id}/chunks"
+        }
+        get_redis().set(upload_session_key(job_id), json.dumps(session), ex=UPLOAD_SESSION_TTL_S)
+        
+        return jsonify({"success": True, **upload_session_progress(session, set())}), 200
+        
+    except Exception as e:
+        app.logger.error(f"Error creating upload session: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/upload/sessions/<job_id>/chunks', methods=['PUT'])
+@limiter.limit("2000 per day, 120 per minute")
+@add_cors_headers
+def upload_session_chunk(job_id):
+    """Store one chunk of a resumable upload; the byte offset is given in the 'offset' query parameter."""
+    try:
+        # Get user ID from token
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token:
+            return jsonify({"error": "No authentication token provided"}), 401
+        
+        # Extract user ID from the token claims
+        try:
+            user_id = None
+            data = supabase.auth.get_user(token)
+            user_id = data.user.id if data and data.user else None
+            
+            if not user_id:
+                return jsonify({"error": "Invalid authentication token"}), 401
+        except Exception as auth_error:
+            app.logger.error(f"Auth error: {str(auth_error)}")
+            return jsonify({"error": "Authentication error"}), 401
+        
+        session_raw = get_redis().get(upload_session_key(job_id))
+        session = json.loads(session_raw) if session_raw else None
+        if not session or session['user_id'] != user_id:
+            return jsonify({"error": "Upload session not found or expired"}), 404
+        
+        try:
+            offset = int(request.args.get('offset', ''))
+        except ValueError:
+            return jsonify({"error": "offset query parameter is required"}), 400
+        if offset < 0 or offset % session['chunk_size'] or offset >= session['size']:
+            return jsonify({"error": f"offset must be a multiple of {session['chunk_size']} below {session['size']}"}), 400
+        
+        index = offset // session['chunk_size']
+        expected_length = min(session['chunk_size'], session['size'] - offset)
+        # Read at most one chunk - no request ever holds the whole file
+        chunk = b''
+        while len(chunk) <= expected_length:
+            piece = request.stream.read(expected_length + 1 - len(chunk))
+            if not piece:
+                break
+            chunk += piece
+        if len(chunk) != expected_length:
+            return jsonify({
+                "error": f"Chunk {index} must be exactly {expected_length} bytes, got {len(chunk)}",
+                "code": "chunk_size_mismatch"
+            }), 400
+        
+        expected_hash = request.headers.get('X-Chunk-SHA256')
+        if expected_hash and hashlib.sha256(chunk).hexdigest() != expected_hash.lower():
+            return jsonify({"error": "Chunk checksum mismatch", "code": "chunk_checksum_mismatch"}), 400
+        
+        # Upsert so a retransmitted chunk simply replaces the earlier copy
+        supabase.storage.from_('uploads').upload(
+            f"{session['chunk_prefix']}/{index:05d}", chunk,
+            {"content-type": "application/octet-stream", "x-upsert": "true"}
+        )
+        
+        redis_client = get_redis()
+        pipe = redis_client.pipeline()
+        pipe.sadd(upload_session_chunks_key(job_id), index)
+        pipe.expire(upload_session_chunks_key(job_id), UPLOAD_SESSION_TTL_S)
+        pipe.expire(upload_session_key(job_id), UPLOAD_SESSION_TTL_S)
+        pipe.smembers(upload_session_chunks_key(job_id))
+        received = {int(i) for i in pipe.execute()[-1]}
+        
+        return jsonify({"success": True, "chunk": index, **upload_session_progress(session, received)}), 200
+        
+    except Exception as e:
+        app.logger.error(f"Error storing upload chunk: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/upload/sessions/<job_id>', methods=['GET'])
+@limiter.limit("2000 per day, 120 per minute")
+@add_cors_headers
+def get_upload_session(job_id):
+    """Report which chunks of a resumable upload were received, so only missing ones are resent."""
+    try:
+        # Get user ID from token
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token:
+            return jsonify({"error": "No authentication token provided"}), 401
+        
+        # Extract user ID from the token claims
+        try:
+            user_id = None
+            data = supabase.auth.get_user(token)
+            user_id = data.user.id if data and data.user else None
+            
+            if not user_id:
+                return jsonify({"error": "Invalid authentication token"}), 401
+        except Exception as auth_error:
+            app.logger.error(f"Auth error: {str(auth_error)}")
+            return jsonify({"error": "Authentication error"}), 401
         
-        # Get the origin from the request
-        origin = request.headers.get('Origin', '*')
+        session_raw = get_redis().get(upload_session_key(job_id))
+        session = json.loads(session_raw) if session_raw else None
+        if not session or session['user_id'] != user_id:
+            return jsonify({"error": "Upload session not found or expired"}), 404
         
-        # Set explicit Access-Control-Allow-Origin based on the request origin
-        if origin in ALLOWED_ORIGINS:
-            response.headers['Access-Control-Allow-Origin'] = origin
-        else:
-            response.headers['Access-Control-Allow-Origin'] = '*'
+        received = {int(i) for i in get_redis().smembers(upload_session_chunks_key(job_id))}
+        return jsonify({"success": True, **upload_session_progress(session, received)}), 200
+        
+    except Exception as e:
+        app.logger.error(f"Error reading upload session: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/upload/sessions/<job_id>/finalize', methods=['POST'])
+@limiter.limit("100 per day, 20 per minute")
+@add_cors_headers
+def finalize_upload_session(job_id):
+    """Queue processing once every chunk arrived; poll /api/job/status for the result."""
+    try:
+        # Get user ID from token
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token:
+            return jsonify({"error": "No authentication token provided"}), 401
+        
+        # Extract user ID from the token claims
+        try:
+            user_id = None
+            data = supabase.auth.get_user(token)
+            user_id = data.user.id if data and data.user else None
             
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Accept, Origin'
-        response.headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS'
-        response.headers['Access-Control-Allow-Credentials'] = 'true'
+            if not user_id:
+                return jsonify({"error": "Invalid authentication token"}), 401
+        except Exception as auth_error:
+            app.logger.error(f"Auth error: {str(auth_error)}")
+            return jsonify({"error": "Authentication error"}), 401
         
-        return response, status_code
+        session_raw = get_redis().get(upload_session_key(job_id))
+        session = json.loads(session_raw) if session_raw else None
+        if not session or session['user_id'] != user_id:
+            return jsonify({"error": "Upload session not found or expired"}), 404
+        
+        redis_client = get_redis()
+        received = {int(i) for i in redis_client.smembers(upload_session_chunks_key(job_id))}
+        progress = upload_session_progress(session, received)
+        if not progress['complete']:
+            return jsonify({"error": "Upload is incomplete", "code": "upload_incomplete", **progress}), 409
+        
+        # The session and its chunks are kept, so a shed finalize can simply be retried
+        overload_error = check_generation_admission(user_id)
+        if overload_error:
+            return overload_error
+        
+        # Quota is checked again - the session may have been created on an earlier day
+        quota_error = check_upload_quota(user_id)
+        if quota_error:
+            return quota_error
+        
+        # Only the first finalize call for a session gets to queue the job
+        if not redis_client.delete(upload_session_key(job_id)):
+            return jsonify({"error": "Upload was already finalized", "job_id": job_id}), 409
+        redis_client.delete(upload_session_chunks_key(job_id))
+        
+        chunk_paths = [f"{session['chunk_prefix']}/{index:05d}" for index in range(session['total_chunks'])]
+        supabase.table('uploads').insert({
+            'id': job_id,
+            'user_id': user_id,
+            'file_name': session['file_name'],
+            'mime_type': session['mime_type'],
+            'storage_path': session['chunk_prefix'],
+            'status': 'processing',
+            'heartbeat_at': datetime.now(timezone.utc).isoformat(),
+            'worker_id': worker_id(),
+            'created_at': datetime.now(timezone.utc).isoformat()
+        }).execute()
+        
+        # Chunks are assembled and processed in the background - the request returns right away
+        threading.Thread(
+            target=process_chunked_upload,
+            args=(job_id, user_id, chunk_paths, session['mime_type']),
+            daemon=True
+        ).start()
+        
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "status": "processing"
+        }), 202
+        
+    except Exception as e:
+        app.logger.error(f"Error finalizing upload session: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
 
 @app.route('/api/quiz/<job_id>', methods=['GET'])
 @limiter.limit("600 per day, 60 per minute")
@@ -922,8 +2064,9 @@ def get_quiz(job_id):
         
         # Get questions
         questions_result = supabase.table('questions').select('*').eq('job_id', job_id).execute()
+        questions = questions_result.data or []
         
-        if not questions_result.data:
+        if not questions:
             return jsonify({
                 "success": False,
                 "message": "No questions found for this quiz"
@@ -932,7 +2075,7 @@ def get_quiz(job_id):
         # Transform questions - rename 'correct_option_index' to 'correctAnswer' for frontend
         # AND randomize the order of the options for each question
         transformed_questions = []
-        for q in questions_result.data:
+        for q in questions:
             # Remove verbose logging of each question processing
             # app.logger.info(f"Processing question {q.get('id')} with options: {q.get('options')}")
             
@@ -1062,14 +2205,28 @@ def complete_quiz(job_id):
             # Insert quiz attempt record
             result = supabase.table('quiz_attempts').insert(quiz_attempt).execute()
             
+            # Explanations are only worth generating for wrong answers - one batched call for the whole review
+            explanations = {}
+            wrong_question_ids = quiz_data.get('wrong_question_ids')
+            # Only the quiz owner's questions are explained - the user_id fallback above always matches
+            owns_quiz = bool(upload_result.data) and upload_result.data[0].get('user_id') == user_id
+            if owns_quiz and wrong_question_ids and isinstance(wrong_question_ids, list):
+                question_ids = [str(qid) for qid in wrong_question_ids][:100]
+                explanations = wrong_answer_explanations(actual_job_id, question_ids)
+            
             if not result.data:
                 app.logger.error("Failed to save quiz attempt - no data returned from insert")
-                return jsonify({"success": True, "message": "Quiz attempted but results could not be saved"}), 200
+                return jsonify({
+                    "success": True,
+                    "message": "Quiz attempted but results could not be saved",
+                    "explanations": explanations
+                }), 200
             
             return jsonify({
                 "success": True,
                 "message": "Quiz completion saved successfully",
-                "data": result.data[0] if result.data else {"quiz_id": actual_job_id}
+                "data": result.data[0] if result.data else {"quiz_id": actual_job_id},
+                "explanations": explanations
             }), 200
             
         except Exception as save_error:
@@ -1090,6 +2247,232 @@ def complete_quiz(job_id):
             "error": str(e)
         }), 200
 
+@app.route('/api/quiz/<job_id>/more', methods=['POST'])
+@limiter.limit("60 per day, 10 per minute")
+@require_active_subscription
+@add_cors_headers
+def generate_more_questions(job_id):
+    """Generate additional questions for an existing quiz from its stored text, excluding the existing ones."""
+    deadline = Deadline(REQUEST_BUDGET_S)
+    try:
+        # Get user ID from token
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token:
+            return jsonify({"error": "No authentication token provided"}), 401
+        
+        # Extract user ID from the token claims
+        try:
+            user_id = None
+            data = supabase.auth.get_user(token)
+            user_id = data.user.id if data and data.user else None
+            
+            if not user_id:
+                return jsonify({"error": "Invalid authentication token"}), 401
+        except Exception as auth_error:
+            app.logger.error(f"Auth error: {str(auth_error)}")
+            return jsonify({"error": "Authentication error"}), 401
+        
+        # require_active_subscription lets every /api/quiz/ path through, so check the tier here
+        if not is_premium_user(user_id):
+            return jsonify({
+                "error": "יצירת שאלות נוספות זמינה למשתמשי פרימיום בלבד. שדרג לפרימיום כדי להמשיך.",
+                "code": "premium_required",
+                "message": "Generating more questions is available to premium users only. Please upgrade to premium."
+            }), 403
+        
+        # Verify the upload belongs to the user
+        upload_result = supabase.table('uploads').select('*').eq('id', job_id).eq('user_id', user_id).execute()
+        if not upload_result.data:
+            return jsonify({"error": "Quiz not found or not authorized"}), 404
+        
+        upload = upload_result.data[0]
+        if upload['status'] != 'completed':
+            return jsonify({"error": "Quiz is not ready yet", "status": upload['status']}), 409
+        
+        body = request.get_json(silent=True) or {}
+        try:
+            count = max(1, min(20, int(body.get('count', 10))))
+        except (TypeError, ValueError):
+            return jsonify({"error": "count must be a number between 1 and 20"}), 400
+        
+        # No upload, storage write or parsing - just the stored text and the existing stems
+        clean_text = load_extracted_text(upload)
+        existing_result = supabase.table('questions')\
+            .select('question, options, correct_option_index')\
+            .eq('job_id', job_id)\
+            .execute()
+        existing_questions = existing_result.data or []
+        
+        app.logger.info(f"Generating {count} more questions for job {job_id} excluding {len(existing_questions)} existing")
+        # Non-subscribers were turned away above, so this is always the premium lane
+        with get_scheduler().slot(user_id, premium=True, max_wait=deadline.remaining() / 2):
+            questions = question_generator.generate_questions_from_text(
+                clean_text, count,
+                include_explanations=not LAZY_EXPLANATIONS,
+                exclude_questions=existing_questions,
+                cancel_token=CancelToken(deadline)
+            )
+        
+        if questions:
+            supabase.table('questions').insert(build_question_rows(job_id, questions)).execute()
+        
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "added_count": len(questions),
+            "question_count": len(existing_questions) + len(questions)
+        }), 200
+        
+    except Exception as e:
+        app.logger.error(f"Error generating more questions: {str(e)}")
+        status_code = 503 if getattr(e, 'retryable', False) else 500
+        return jsonify({
+            "error": f"Server error: {str(e)}",
+            "code": getattr(e, 'code', None),
+            "retryable": getattr(e, 'retryable', False)
+        }), status_code
+
+@app.route('/api/quiz/<job_id>/questions/<question_id>/explanation', methods=['GET'])
+@limiter.limit("600 per day, 60 per minute")
+@require_active_subscription
+@add_cors_headers
+def get_question_explanation(job_id, question_id):
+    """Get the explanation for a question, generating and caching it on first request."""
+    try:
+        # Get user ID from token
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token:
+            return jsonify({"error": "No authentication token provided"}), 401
+        
+        # Extract user ID from the token claims
+        try:
+            user_id = None
+            data = supabase.auth.get_user(token)
+            user_id = data.user.id if data and data.user else None
+            
+            if not user_id:
+                return jsonify({"error": "Invalid authentication token"}), 401
+        except Exception as auth_error:
+            app.logger.error(f"Auth error: {str(auth_error)}")
+            return jsonify({"error": "Authentication error"}), 401
+        
+        # Verify the upload belongs to the user
+        upload_result = supabase.table('uploads').select('id').eq('id', job_id).eq('user_id', user_id).execute()
+        if not upload_result.data:
+            return jsonify({"error": "Quiz not found or not authorized"}), 404
+        
+        question_result = supabase.table('questions')\
+            .select('id, question, options, correct_option_index, explanation')\
+            .eq('id', question_id)\
+            .eq('job_id', job_id)\
+            .execute()
+        if not question_result.data:
+            return jsonify({"error": "Question not found"}), 404
+        
+        question = question_result.data[0]
+        explanation = question.get('explanation')
+        if not explanation:
+            explanation = fill_missing_explanations(job_id, [question]).get(str(question['id']))
+        
+        if not explanation:
+            return jsonify({
+                "success": False,
+                "message": "Explanation could not be generated"
+            }), 200
+        
+        return jsonify({
+            "success": True,
+            "question_id": question['id'],
+            "explanation": explanation
+        }), 200
+        
+    except Exception as e:
+        app.logger.error(f"Error retrieving explanation: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/quiz/<job_id>/questions/<question_id>/regenerate', methods=['POST'])
+@limiter.limit("100 per day, 20 per minute")
+@require_active_subscription
+@add_cors_headers
+def regenerate_question(job_id, question_id):
+    """Replace one question in place with a new one generated from its source chunk."""
+    try:
+        # Get user ID from token
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token:
+            return jsonify({"error": "No authentication token provided"}), 401
+        
+        # Extract user ID from the token claims
+        try:
+            user_id = None
+            data = supabase.auth.get_user(token)
+            user_id = data.user.id if data and data.user else None
+            
+            if not user_id:
+                return jsonify({"error": "Invalid authentication token"}), 401
+        except Exception as auth_error:
+            app.logger.error(f"Auth error: {str(auth_error)}")
+            return jsonify({"error": "Authentication error"}), 401
+        
+        # Verify the upload belongs to the user
+        upload_result = supabase.table('uploads').select('*').eq('id', job_id).eq('user_id', user_id).execute()
+        if not upload_result.data:
+            return jsonify({"error": "Quiz not found or not authorized"}), 404
+        
+        upload = upload_result.data[0]
+        if upload['status'] != 'completed':
+            return jsonify({"error": "Quiz is not ready yet", "status": upload['status']}), 409
+        
+        questions_result = supabase.table('questions')\
+            .select('id, question, options, correct_option_index, source_chunk, source_start, source_end')\
+            .eq('job_id', job_id)\
+            .execute()
+        questions = questions_result.data or []
+        question = next((q for q in questions if str(q['id']) == str(question_id)), None)
+        if not question:
+            return jsonify({"error": "Question not found"}), 404
+        
+        # One small call on the question's own chunk instead of a full-document generation
+        clean_text = load_extracted_text(upload)
+        new_question = question_generator.regenerate_question(
+            clean_text, question,
+            include_explanations=not LAZY_EXPLANATIONS,
+            exclude_questions=[q for q in questions if q is not question]
+        )
+        if not new_question:
+            return jsonify({
+                "success": False,
+                "message": "Could not generate a replacement question"
+            }), 200
+        
+        # Replace in place so the question keeps its id and position in the quiz
+        row = build_question_rows(job_id, [new_question])[0]
+        row.pop('job_id')
+        row.pop('created_at')
+        row['explanation'] = new_question.get('explanation') or None
+        supabase.table('questions').update(row).eq('id', question['id']).eq('job_id', job_id).execute()
+        
+        app.logger.info(f"Regenerated question {question['id']} of job {job_id} from chunk {new_question['source_chunk']}")
+        return jsonify({
+            "success": True,
+            "question": {
+                "id": question['id'],
+                "question": row['question'],
+                "options": row['options'],
+                "correctAnswer": row['correct_option_index'],
+                "explanation": row['explanation']
+            }
+        }), 200
+        
+    except Exception as e:
+        app.logger.error(f"Error regenerating question: {str(e)}")
+        status_code = 503 if getattr(e, 'retryable', False) else 500
+        return jsonify({
+            "error": f"Server error: {str(e)}",
+            "code": getattr(e, 'code', None),
+            "retryable": getattr(e, 'retryable', False)
+        }), status_code
+
 @app.route('/api/user/statistics', methods=['GET'])
 @limiter.limit("1200 per day, 120 per minute")
 @require_active_subscription
@@ -1424,8 +2807,7 @@ def recreate_quiz_attempts_table():
     try:
         # This should be protected in a real app with admin authentication
         # Simple key-based protection for demo purposes
-        auth_key = request.headers.get('X-Admin-Key')
-        if not auth_key or auth_key != os.getenv('ADMIN_SECRET_KEY', 'temporary_admin_key'):
+        if not is_admin_key(request.headers.get('X-Admin-Key')):
             return jsonify({"error": "Unauthorized access"}), 401
         
         app.logger.warning("Recreating quiz_attempts table...")
@@ -1644,6 +3026,166 @@ def apply_rls_policies():
         app.logger.error(f"Failed to apply RLS policies: {str(e)}")
         return jsonify({'error': f'Failed to apply RLS policies: {str(e)}'}), 500
 
+@app.route('/admin/llm/status', methods=['GET'])
+@limiter.limit("600 per day")
+@require_admin_key
+@add_cors_headers
+def llm_status():
+    """ADMIN ONLY: Cluster-wide Gemini quota utilization, circuit breaker state and generation queue."""
+    backend = question_generator.backend
+    governor = getattr(backend, 'governor', None)
+    breaker = getattr(backend, 'breaker', None)
+    return jsonify({
+        "success": True,
+        "rate_governor": governor.snapshot() if governor else None,
+        "circuit_breaker": breaker.snapshot() if breaker else None,
+        "generation_scheduler": get_scheduler().snapshot()
+    }), 200
+
+@app.route('/admin/jobs/reap', methods=['POST'])
+@limiter.limit("60 per hour")
+@require_admin_key
+@add_cors_headers
+def reap_jobs():
+    """ADMIN ONLY: Resume processing jobs whose worker stopped heartbeating, without waiting for the reaper."""
+    try:
+        body = request.get_json(silent=True) or {}
+        limit = max(1, min(100, int(body.get('limit', 20))))
+        return jsonify({"success": True, **reap_stale_jobs(limit)}), 200
+    except Exception as e:
+        app.logger.error(f"Error reaping stale jobs: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/admin/storage/gc', methods=['POST'])
+@limiter.limit("60 per day")
+@require_admin_key
+@add_cors_headers
+def collect_unreferenced_blobs():
+    """
+    ADMIN ONLY: Delete file blobs that no upload references any more.
+    
+    Blobs are scanned in sha256 order; pass the returned next_cursor as cursor
+    to continue where the previous batch stopped (null once the scan is done).
+    """
+    try:
+        body = request.get_json(silent=True) or {}
+        dry_run = bool(body.get('dry_run', False))
+        batch_size = max(1, min(1000, int(body.get('limit', 500))))
+        cursor = body.get('cursor') or ''
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=BLOB_GC_GRACE_HOURS)).isoformat()
+        
+        # The anti-join over uploads runs in the database (see supabase_schema_update.sql),
+        # so a blob shared by many uploads never depends on a capped list of referencing rows
+        orphans = supabase.rpc('unreferenced_file_blobs', {
+            'cutoff': cutoff,
+            'after_sha256': cursor,
+            'batch_size': batch_size
+        }).execute().data or []
+        next_cursor = orphans[-1]['sha256'] if len(orphans) == batch_size else None
+        unreferenced = len(orphans)
+        
+        if orphans and not dry_run:
+            # Delete the rows first, re-checking the cutoff: a blob reused since the scan keeps its row
+            deleted_result = supabase.table('file_blobs')\
+                .delete()\
+                .in_('sha256', [blob['sha256'] for blob in orphans])\
+                .lt('last_referenced_at', cutoff)\
+                .execute()
+            deleted_hashes = {row['sha256'] for row in deleted_result.data or []}
+            orphans = [blob for blob in orphans if blob['sha256'] in deleted_hashes]
+            if orphans:
+                supabase.storage.from_('uploads').remove([blob['storage_path'] for blob in orphans])
+        
+        freed_bytes = sum(blob.get('size_bytes') or 0 for blob in orphans)
+        app.logger.info(f"Blob GC: {len(orphans)} of {unreferenced} unreferenced blobs deleted, {freed_bytes} bytes, dry_run={dry_run}")
+        return jsonify({
+            "success": True,
+            "unreferenced": unreferenced,
+            "deleted": len(orphans),
+            "freed_bytes": freed_bytes,
+            "next_cursor": next_cursor,
+            "dry_run": dry_run
+        }), 200
+        
+    except Exception as e:
+        app.logger.error(f"Error collecting unreferenced blobs: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/admin/ingest', methods=['POST'])
+@limiter.limit("20 per day")
+@require_admin_key
+@add_cors_headers
+def start_bulk_ingest():
+    """ADMIN ONLY: Pre-process a zipped course pack into the content cache; poll GET /admin/ingest/<id>."""
+    try:
+        pack = request.files.get('file')
+        if not pack:
+            return jsonify({"error": "No file part"}), 400
+        num_questions = max(1, min(50, int(request.form.get('questions', 20))))
+        concurrency = max(1, min(8, int(request.form.get('concurrency', 2))))
+        label = request.form.get('label') or pack.filename
+        
+        fd, pack_path = tempfile.mkstemp(suffix='.zip')
+        with os.fdopen(fd, 'wb') as f:
+            pack.save(f)
+        if not zipfile.is_zipfile(pack_path):
+            os.remove(pack_path)
+            return jsonify({"error": "Course pack must be a zip file"}), 400
+        
+        ingest_id = str(uuid.uuid4())
+        status_key = bulk_ingest.ingest_status_key(ingest_id)
+        pipe = get_redis().pipeline()
+        pipe.hset(status_key, mapping={
+            'status': 'starting',
+            'label': label,
+            'questions': num_questions,
+            'started_at': datetime.now(timezone.utc).isoformat()
+        })
+        pipe.expire(status_key, bulk_ingest.INGEST_STATUS_TTL_S)
+        pipe.execute()
+        
+        # The run gets its own process (the bulk_ingest.py CLI), not a thread of this web worker;
+        # it records its progress in Redis and removes the pack when it ends
+        backend_dir = os.path.dirname(os.path.abspath(__file__))
+        try:
+            process = subprocess.Popen(
+                [sys.executable, os.path.join(backend_dir, 'bulk_ingest.py'), pack_path,
+                 f'--questions={num_questions}', f'--concurrency={concurrency}', f'--label={label}',
+                 f'--report={os.devnull}', '--no-resume', f'--ingest-id={ingest_id}', '--delete-source'],
+                cwd=backend_dir,
+                stdin=subprocess.DEVNULL
+            )
+        except Exception:
+            try:
+                os.remove(pack_path)
+            except OSError:
+                pass
+            raise
+        # Reap the child when it exits
+        threading.Thread(target=process.wait, name=f'ingest-{ingest_id}', daemon=True).start()
+        app.logger.info(f"Started bulk ingest {ingest_id} of {label} as process {process.pid}")
+        return jsonify({"success": True, "ingest_id": ingest_id, "status": "starting"}), 202
+    except Exception as e:
+        app.logger.error(f"Error starting bulk ingest: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route('/admin/ingest/<ingest_id>', methods=['GET'])
+@limiter.limit("600 per day")
+@require_admin_key
+@add_cors_headers
+def get_bulk_ingest(ingest_id):
+    """ADMIN ONLY: Progress of a course-pack ingest and the report entries of the files done so far."""
+    try:
+        redis_client = get_redis()
+        status = redis_client.hgetall(bulk_ingest.ingest_status_key(ingest_id))
+        if not status:
+            return jsonify({"error": "Ingest not found"}), 404
+        report = [json.loads(line) for line in redis_client.lrange(bulk_ingest.ingest_report_key(ingest_id), 0, -1)]
+        return jsonify({"success": True, "ingest_id": ingest_id, **status, "report": report}), 200
+    except Exception as e:
+        app.logger.error(f"Error reading bulk ingest {ingest_id}: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
 # Custom error handler for rate limiting
 @app.errorhandler(429)
 def ratelimit_handler(e):
@@ -1750,7 +3292,9 @@ def check_job_status():
                     "success": True,
                     "status": upload.get('status', 'pending'),
                     "job_id": job_id,
-                    "error": upload.get('error', None)
+                    "error": upload.get('error', None) or upload.get('error_message'),
+                    "error_code": upload.get('error_code'),
+                    "retryable": upload.get('error_code') in RETRYABLE_ERROR_CODES
                 })
                 
             else:
@@ -1764,6 +3308,88 @@ def check_job_status():
         app.logger.error(f"Error in job status endpoint: {str(e)}")
         return jsonify({"success": False, "error": f"Server error: {str(e)}"}), 500
 
+def terminal_job_event(upload):
+    """The completed or failed event of a finished upload row; None while it is processing."""
+    if upload['status'] == 'completed':
+        return {"event": "completed"}
+    if upload['status'] == 'failed':
+        return {
+            "event": "failed",
+            "error": upload.get('error_message'),
+            "error_code": upload.get('error_code'),
+            "retryable": upload.get('error_code') in RETRYABLE_ERROR_CODES
+        }
+    return None
+
+@app.route('/api/job/<job_id>/events', methods=['GET'])
+@limiter.limit("300 per hour")
+@add_cors_headers
+def job_events(job_id):
+    """
+    Stream stage transitions of a generation job as Server-Sent Events:
+    uploaded, extracting, generating (with question_count), storing, and
+    finally completed or failed. Replaces polling /api/job/status.
+    """
+    # EventSource clients cannot always set headers, so the token may also come as a query parameter
+    token = request.headers.get('Authorization', '').replace('Bearer ', '') or request.args.get('token', '')
+    if not token:
+        return jsonify({"error": "No authentication token provided"}), 401
+    
+    # Extract user ID from the token claims
+    try:
+        user_id = None
+        data = supabase.auth.get_user(token)
+        user_id = data.user.id if data and data.user else None
+        
+        if not user_id:
+            return jsonify({"error": "Invalid authentication token"}), 401
+    except Exception as auth_error:
+        app.logger.error(f"Auth error: {str(auth_error)}")
+        return jsonify({"error": "Authentication error"}), 401
+    
+    # One ownership check per stream instead of one read per poll
+    upload_result = supabase.table('uploads')\
+        .select('id, status, error_message, error_code')\
+        .eq('id', job_id)\
+        .eq('user_id', user_id)\
+        .execute()
+    if not upload_result.data:
+        return jsonify({"error": "Job not found or not authorized"}), 404
+    
+    def poll_event():
+        # Only used while Redis is down: one read per SSE_POLL_FALLBACK_S, not per client poll
+        result = supabase.table('uploads')\
+            .select('status, error_message, error_code')\
+            .eq('id', job_id)\
+            .execute()
+        return terminal_job_event(result.data[0]) if result.data else {"event": "failed", "error": "Job not found"}
+    
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Disable proxy buffering so events arrive immediately
+    }
+    initial_event = terminal_job_event(upload_result.data[0])
+    if initial_event is not None:
+        # A finished job is answered at once, without taking a stream slot
+        return Response(stream_job_events(job_id, initial_event), mimetype='text/event-stream', headers=headers), 200
+    
+    # Each open stream holds a request thread; past the cap the client polls /api/job/status instead
+    if not acquire_stream_slot():
+        app.logger.warning(f"All {SSE_MAX_STREAMS} event streams of this worker are open, refusing job {job_id}")
+        response = jsonify({
+            "error": "Too many open event streams, poll /api/job/status instead",
+            "code": "too_many_streams",
+            "retryable": True
+        })
+        response.headers['Retry-After'] = str(int(SSE_POLL_FALLBACK_S))
+        return response, 503
+    
+    response = Response(stream_job_events(job_id, initial_event, poll_event=poll_event),
+                        mimetype='text/event-stream', headers=headers)
+    # Runs when the stream ends or the client goes away, even if it never started
+    response.call_on_close(release_stream_slot)
+    return response, 200
+
 @app.route('/api/user/quizzes', methods=['GET'])
 @limiter.limit("600 per day, 60 per minute")
 @require_active_subscription
@@ -1821,6 +3447,23 @@ def get_user_quizzes():
         app.logger.error(f"Error retrieving user quizzes: {str(e)}")
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
+def warm_up():
+    """Import the document parsers and the LLM SDK ahead of the first upload that needs them."""
+    start = time.monotonic()
+    try:
+        modules = sandbox.warm_up()
+        question_generator.backend.warm_up()
+        app.logger.info(f"Warmed up parsers {modules} and the LLM backend in {time.monotonic() - start:.1f}s")
+    except Exception as e:
+        app.logger.error(f"Warm-up failed: {str(e)}")
+
+if WARM_UP_ON_START:
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+# Every worker runs the reaper; a Redis lock lets one of them sweep per interval
+if JOB_REAPER_INTERVAL_S > 0:
+    threading.Thread(target=job_reaper_loop, name='job-reaper', daemon=True).start()
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5001))
     app.logger.info(f"Starting Flask app on port {port}")
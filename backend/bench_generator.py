@@ -0,0 +1,83 @@
+"""
+Offline benchmark for QuestionGenerator using the fake LLM backend.
+
+Example:
+    python bench_generator.py --jobs 50 --concurrency 8 --latency-ms 800 --error-rate 0.1
+"""
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_backend import FakeBackend
+from question_generator import QuestionGenerator
+
+SAMPLE_TEXT = (
+    "תא הוא היחידה הבסיסית של החיים. לכל תא יש קרום התא השולט במעבר חומרים. "
+    "הגרעין מכיל את החומר התורשתי ומווסת את פעילות התא. המיטוכונדריה מייצרת אנרגיה. "
+) * 200
+
+
+def run_benchmark(args) -> dict:
+    backend = FakeBackend(
+        seed=args.seed,
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        ms_per_output_token=args.ms_per_output_token,
+        error_rate=args.error_rate,
+        truncation_rate=args.truncation_rate,
+        malformed_rate=args.malformed_rate,
+        duplicate_rate=args.duplicate_rate,
+    )
+    generator = QuestionGenerator(backend=backend)
+    content = SAMPLE_TEXT.encode('utf-8')
+
+    def one_job(job_index: int) -> tuple:
+        start = time.perf_counter()
+        # Vary the document per job so every job sees a different prompt
+        questions = generator.generate_questions(content + f" {job_index}".encode('utf-8'), 'text/plain', args.questions)
+        return time.perf_counter() - start, len(questions)
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(one_job, range(args.jobs)))
+    wall_time = time.perf_counter() - wall_start
+
+    latencies = sorted(r[0] for r in results)
+    short_jobs = sum(1 for r in results if r[1] < args.questions)
+    return {
+        "jobs": args.jobs,
+        "concurrency": args.concurrency,
+        "wall_time_s": round(wall_time, 3),
+        "jobs_per_s": round(args.jobs / wall_time, 2) if wall_time else None,
+        "p50_s": round(statistics.median(latencies), 3),
+        "p95_s": round(latencies[int(0.95 * (len(latencies) - 1))], 3),
+        "max_s": round(latencies[-1], 3),
+        "short_jobs": short_jobs,
+        "backend_calls": backend.stats["calls"],
+        "calls_per_job": round(backend.stats["calls"] / args.jobs, 2),
+        "backend_stats": backend.stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark question generation against the fake LLM backend")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--ms-per-output-token", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--truncation-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    for key, value in run_benchmark(args).items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
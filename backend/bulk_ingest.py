@@ -0,0 +1,344 @@
+"""
+Bulk course-pack ingestion: parse every document of a directory or zip and
+generate its questions ahead of time, into the content cache (content_cache.py).
+A student's upload of a byte-identical file is then served from the cache
+without parsing it or calling the LLM.
+
+Files are processed in parallel (--concurrency); each is parsed in the
+extraction sandbox and generates inside a free-lane scheduler slot, so a
+large pack shares the Gemini quota with live uploads instead of starving
+them. Every file appends one JSON line to the report with its status and
+per-stage timings. A rerun with the same report skips the files it lists as
+done, and files already in the cache are skipped either way.
+
+Uses SUPABASE_URL, SUPABASE_KEY, LLM_BACKEND etc. from the environment, as the app does.
+POST /admin/ingest runs this CLI in a separate process for an uploaded zip;
+with --ingest-id the report and status also go to Redis for GET /admin/ingest/<id>.
+
+Example:
+    python bulk_ingest.py packs/biology-101.zip --report biology-101.jsonl --concurrency 4
+    python bulk_ingest.py packs/ --questions 20 --label spring-2026
+"""
+import os
+import json
+import time
+import zipfile
+import hashlib
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+import content_cache
+from pipeline import CancelToken, Deadline
+from redis_client import get_redis
+from question_generator import EXTRACTOR_VERSION
+from scheduler import get_scheduler
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = {
+    '.pdf': 'application/pdf',
+    '.txt': 'text/plain',
+    '.doc': 'application/msword',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+}
+# Same limit as a single upload
+MAX_FILE_BYTES = 50 * 1024 * 1024
+# Time per file for extraction and generation together, as JOB_BUDGET_S is for an upload
+BULK_INGEST_BUDGET_S = float(os.getenv("BULK_INGEST_BUDGET_S", "600"))
+# Scheduler "user" that bulk ingestion queues as
+SCHEDULER_USER = "bulk-ingest"
+# Report statuses a rerun does not process again
+DONE_STATUSES = ("ok", "cached")
+# How long the Redis status and report of an /admin/ingest run are kept
+INGEST_STATUS_TTL_S = 7 * 24 * 3600
+
+
+class Document(NamedTuple):
+    name: str
+    mime_type: str
+    size: int
+    read: Callable[[], bytes]
+
+
+def _is_hidden(name: str) -> bool:
+    # Finder and Office leave metadata files next to the real documents
+    return any(part.startswith(('.', '~$')) or part == '__MACOSX' for part in name.split('/'))
+
+
+def _mime_type(name: str) -> Optional[str]:
+    return SUPPORTED_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+
+
+def _read_member(package: zipfile.ZipFile, info: zipfile.ZipInfo) -> bytes:
+    # The sizes in a zip header are the archive's word; stop reading past the limit regardless
+    with package.open(info) as member:
+        content = member.read(MAX_FILE_BYTES + 1)
+    if len(content) > MAX_FILE_BYTES:
+        raise ValueError(f"{info.filename} is larger than {MAX_FILE_BYTES // (1024 * 1024)}MB")
+    return content
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@contextmanager
+def open_course_pack(source: str) -> Iterator[List[Document]]:
+    """
+    The supported documents of a directory (recursively) or a zip file, by name.
+
+    Names are relative to the directory or archive root, so they stay the same
+    across runs. Hidden files and files over MAX_FILE_BYTES are left out.
+    """
+    if os.path.isdir(source):
+        documents = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, source).replace(os.sep, '/')
+                mime_type = _mime_type(name)
+                size = os.path.getsize(path)
+                if mime_type and not _is_hidden(name) and size <= MAX_FILE_BYTES:
+                    documents.append(Document(name, mime_type, size, lambda path=path: _read_file(path)))
+        yield documents
+        return
+
+    with zipfile.ZipFile(source) as package:
+        documents = []
+        for info in sorted(package.infolist(), key=lambda info: info.filename):
+            mime_type = _mime_type(info.filename)
+            if info.is_dir() or not mime_type or _is_hidden(info.filename) or info.file_size > MAX_FILE_BYTES:
+                continue
+            documents.append(Document(info.filename, mime_type, info.file_size,
+                                      lambda info=info: _read_member(package, info)))
+        yield documents
+
+
+def completed_names(report_path: str) -> set:
+    """Names the report already lists as done; an unreadable line (a run killed mid-write) is ignored."""
+    done = set()
+    if not os.path.exists(report_path):
+        return done
+    with open(report_path, encoding='utf-8') as report:
+        for line in report:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('status') in DONE_STATUSES:
+                done.add(entry.get('name'))
+    return done
+
+
+def ingest_status_key(ingest_id: str) -> str:
+    return f"ingest:{ingest_id}"
+
+
+def ingest_report_key(ingest_id: str) -> str:
+    return f"ingest:{ingest_id}:report"
+
+
+class IngestProgress:
+    """Mirrors a run's status and report into Redis; best effort, ingestion goes on without it."""
+
+    def __init__(self, ingest_id: str):
+        self.status_key = ingest_status_key(ingest_id)
+        self.report_key = ingest_report_key(ingest_id)
+
+    def _write(self, fn: Callable):
+        try:
+            pipe = get_redis().pipeline()
+            fn(pipe)
+            pipe.expire(self.status_key, INGEST_STATUS_TTL_S)
+            pipe.expire(self.report_key, INGEST_STATUS_TTL_S)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not record ingest progress in {self.status_key}: {e}")
+
+    def start(self, files: int):
+        self._write(lambda pipe: pipe.hset(self.status_key, mapping={'status': 'processing', 'files': files}))
+
+    def record(self, entry: Dict):
+        def write(pipe):
+            pipe.rpush(self.report_key, json.dumps(entry, ensure_ascii=False))
+            pipe.hincrby(self.status_key, entry['status'], 1)
+        self._write(write)
+
+    def finish(self, status: str, **fields):
+        self._write(lambda pipe: pipe.hset(self.status_key, mapping={'status': status, **fields}))
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+class BulkIngester:
+    """Fills the content cache from course-pack documents; see the module docstring."""
+
+    def __init__(self, supabase, generator, num_questions: int = 20, include_explanations: bool = True,
+                 concurrency: int = 4, budget_s: float = BULK_INGEST_BUDGET_S, label: Optional[str] = None):
+        self.supabase = supabase
+        self.generator = generator
+        self.num_questions = num_questions
+        self.include_explanations = include_explanations
+        self.concurrency = max(1, concurrency)
+        self.budget_s = budget_s
+        self.label = label
+
+    def ingest_one(self, document: Document) -> Dict:
+        """Extract, generate and cache one document; returns its report entry. Never raises."""
+        entry = {'name': document.name, 'mime_type': document.mime_type, 'size_bytes': document.size}
+        timings: Dict[str, int] = {}
+        entry['timings_ms'] = timings
+        start = time.perf_counter()
+
+        def lap(stage: str):
+            nonlocal start
+            now = time.perf_counter()
+            timings[f'{stage}_ms'] = round((now - start) * 1000)
+            start = now
+
+        try:
+            content = document.read()
+            lap('read')
+            digest = hashlib.sha256(content).hexdigest()
+            entry['content_sha256'] = digest
+            lap('hash')
+
+            cached = content_cache.get_cached_content(self.supabase, digest, EXTRACTOR_VERSION)
+            if content_cache.cached_questions(cached, self.num_questions, self.include_explanations):
+                entry['status'] = 'cached'
+                return entry
+
+            deadline = Deadline(self.budget_s)
+            # The text is still good when only the question settings changed
+            if cached:
+                clean_text = content_cache.load_cached_text(self.supabase, cached)
+            else:
+                clean_text = self.generator.prepare_text(content, document.mime_type,
+                                                         deadline=deadline.child(deadline.remaining() / 2))
+            entry['text_chars'] = len(clean_text)
+            lap('extract')
+
+            with get_scheduler().slot(SCHEDULER_USER, premium=False,
+                                      max_wait=deadline.remaining() / 2) as queue_wait:
+                timings['queue_wait_ms'] = round(queue_wait * 1000)
+                questions = self.generator.generate_questions_from_text(
+                    clean_text, self.num_questions,
+                    include_explanations=self.include_explanations,
+                    cancel_token=CancelToken(deadline)
+                )
+            entry['question_count'] = len(questions)
+            lap('generate')
+
+            # A short set would give uploads a short quiz; keep only the text then
+            complete = len(questions) >= self.num_questions
+            content_cache.store_cached_content(
+                self.supabase, digest, clean_text, EXTRACTOR_VERSION,
+                questions=questions if complete else None, num_questions=self.num_questions,
+                include_explanations=self.include_explanations, source=self.label or document.name
+            )
+            lap('store')
+            entry['status'] = 'ok' if complete else 'partial'
+        except Exception as e:
+            logger.error(f"Ingesting {document.name} failed: {e}")
+            entry['status'] = 'failed'
+            entry['error'] = str(e)
+            entry['code'] = getattr(e, 'code', None)
+        return entry
+
+    def run(self, documents: Iterable[Document], skip: Iterable[str] = (),
+            on_result: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """
+        Ingest the documents, concurrency at a time; on_result gets each
+        report entry as its file finishes. Returns a summary.
+        """
+        skip = set(skip)
+        documents = list(documents)
+        todo = [document for document in documents if document.name not in skip]
+        counts = {'skipped': len(documents) - len(todo), 'ok': 0, 'cached': 0, 'partial': 0, 'failed': 0}
+        lock = threading.Lock()
+
+        def process(document: Document):
+            entry = self.ingest_one(document)
+            with lock:
+                counts[entry['status']] += 1
+                if on_result:
+                    on_result(entry)
+            logger.info(f"{document.name}: {entry['status']} {entry['timings_ms']}")
+
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="ingest") as executor:
+            list(executor.map(process, todo))
+        return {'files': len(todo), **counts, 'wall_time_s': round(time.perf_counter() - wall_start, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-process a course pack into the content cache")
+    parser.add_argument("source", help="directory or .zip of course documents")
+    parser.add_argument("--report", default="ingest-report.jsonl", help="JSONL report, also used to resume")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--label", help="stored as the cache entries' source (default: the file name)")
+    parser.add_argument("--budget", type=float, default=BULK_INGEST_BUDGET_S, help="seconds per file")
+    parser.add_argument("--no-resume", action="store_true", help="process every file and start a new report")
+    parser.add_argument("--ingest-id", help="also record the status and report in Redis under this id")
+    parser.add_argument("--delete-source", action="store_true", help="remove the source once the run ends")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    from supabase import create_client
+    from question_generator import QuestionGenerator
+
+    supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+    ingester = BulkIngester(
+        supabase, QuestionGenerator(), num_questions=args.questions,
+        include_explanations=os.getenv('LAZY_EXPLANATIONS', 'off').lower() != 'on',
+        concurrency=args.concurrency, budget_s=args.budget, label=args.label
+    )
+    skip = set() if args.no_resume else completed_names(args.report)
+    progress = IngestProgress(args.ingest_id) if args.ingest_id else None
+
+    try:
+        with open(args.report, 'w' if args.no_resume else 'a', encoding='utf-8') as report:
+            if report.tell() and not _ends_with_newline(args.report):
+                report.write("\n")  # Close the line a killed run left half-written
+
+            def write_entry(entry: Dict):
+                report.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                report.flush()
+                if progress:
+                    progress.record(entry)
+
+            with open_course_pack(args.source) as documents:
+                if progress:
+                    progress.start(len(documents))
+                summary = ingester.run(documents, skip=skip, on_result=write_entry)
+        if progress:
+            progress.finish('completed', wall_time_s=summary['wall_time_s'])
+    except Exception as e:
+        if progress:
+            progress.finish('failed', error=str(e))
+        raise
+    finally:
+        if args.delete_source:
+            try:
+                os.remove(args.source)
+            except OSError as e:
+                logger.warning(f"Could not remove {args.source}: {e}")
+
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import os
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import text_store
+
+logger = logging.getLogger(__name__)
+
+# Extracted text and generated questions of known documents (course packs), keyed by the
+# SHA-256 of the file. Written by bulk ingestion (bulk_ingest.py); uploads of a byte-identical
+# file reuse them instead of parsing the file and calling the LLM again.
+CONTENT_CACHE = os.getenv("CONTENT_CACHE", "on").lower() not in ("0", "off", "false", "no")
+CACHE_TABLE = "content_cache"
+CACHE_BUCKET = "uploads"
+
+
+def cache_text_path(digest: str) -> str:
+    return f"cache/{digest[:2]}/{digest}.txt{text_store.COMPRESSED_SUFFIX}"
+
+
+def get_cached_content(supabase, digest: str, extractor_version: str) -> Optional[Dict]:
+    """
+    The cache entry of a file, or None on a miss, when the entry was made by
+    another extractor version, or when the cache cannot be read.
+    """
+    if not CONTENT_CACHE:
+        return None
+    try:
+        result = supabase.table(CACHE_TABLE).select('*').eq('content_sha256', digest).execute()
+    except Exception as e:
+        logger.warning(f"Content cache lookup failed for {digest}: {e}")
+        return None
+    entry = (result.data or [None])[0]
+    if entry and entry.get('extractor_version') != extractor_version:
+        return None
+    return entry
+
+
+def load_cached_text(supabase, entry: Dict) -> str:
+    """The cleaned text of a cache entry."""
+    return text_store.decompress_text(supabase.storage.from_(CACHE_BUCKET).download(entry['text_path']))
+
+
+def cached_questions(entry: Optional[Dict], num_questions: int, include_explanations: bool) -> Optional[List[Dict]]:
+    """The cached questions, if the entry has them for this many questions and explanation mode."""
+    if not entry or not entry.get('questions'):
+        return None
+    if entry.get('num_questions') != num_questions or entry.get('include_explanations') != include_explanations:
+        return None
+    return [dict(question) for question in entry['questions']]
+
+
+def store_cached_content(supabase, digest: str, text: str, extractor_version: str,
+                         questions: Optional[List[Dict]] = None, num_questions: Optional[int] = None,
+                         include_explanations: bool = True, source: Optional[str] = None) -> Dict:
+    """Write (or replace) the cache entry of a file; returns the row."""
+    path = cache_text_path(digest)
+    compressed, text_hash = text_store.compress_text(text)
+    supabase.storage.from_(CACHE_BUCKET).upload(path, compressed, {"content-type": text_store.CONTENT_TYPE,
+                                                                  "x-upsert": "true"})
+    row = {
+        'content_sha256': digest,
+        'extractor_version': extractor_version,
+        'text_path': path,
+        'text_hash': text_hash,
+        'text_chars': len(text),
+        'questions': questions,
+        'num_questions': num_questions if questions else None,
+        'include_explanations': include_explanations,
+        'source': source,
+        'created_at': datetime.now(timezone.utc).isoformat()
+    }
+    supabase.table(CACHE_TABLE).upsert(row).execute()
+    return row
@@ -0,0 +1,314 @@
+import io
+import logging
+import zipfile
+import importlib
+import posixpath
+import xml.etree.ElementTree as ET
+from typing import Callable, Dict, Iterable, List, Optional
+
+import ocr
+from pipeline import Deadline
+
+logger = logging.getLogger(__name__)
+
+# MIME type -> extractor(file_content, deadline) -> text. Each extractor imports its parser
+# library inside the function, so a worker only loads the parsers it actually needs.
+_EXTRACTORS: Dict[str, Callable[[bytes, Optional[Deadline]], str]] = {}
+# MIME type -> the parser module its extractor imports, for warm_up()
+_PARSER_MODULES: Dict[str, str] = {}
+
+# Office Open XML namespaces
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+_P = "{http://schemas.openxmlformats.org/presentationml/2006/main}"
+_R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_MC = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
+
+
+def register(mime_types: Iterable[str], parser_module: Optional[str] = None):
+    """Register the decorated function as the extractor for the given MIME types."""
+    def decorator(fn):
+        for mime_type in mime_types:
+            _EXTRACTORS[mime_type] = fn
+            if parser_module:
+                _PARSER_MODULES[mime_type] = parser_module
+        return fn
+    return decorator
+
+
+@register(['application/pdf'], 'PyPDF2')
+def extract_pdf(file_content: bytes, deadline: Optional[Deadline] = None) -> str:
+    import PyPDF2
+
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
+    page_texts = []
+    for page_number, page in enumerate(pdf_reader.pages):
+        if deadline and deadline.expired:
+            logger.warning(f"Extraction deadline reached, keeping the first {page_number} of {len(pdf_reader.pages)} pages")
+            break
+        page_texts.append(page.extract_text())
+
+    # Scanned pages have no text layer; OCR them all at once, in parallel
+    scanned = {index: pdf_reader.pages[index] for index, text in enumerate(page_texts) if ocr.needs_ocr(text)}
+    if scanned:
+        for index, text in ocr.ocr_pages(file_content, scanned, deadline).items():
+            page_texts[index] = text
+    return "".join(text + "\n" for text in page_texts)
+
+
+def extract_docx_object_model(file_content: bytes, deadline: Optional[Deadline] = None) -> str:
+    """python-docx fallback for documents the streaming path cannot read; body paragraphs only."""
+    import docx
+
+    doc = docx.Document(io.BytesIO(file_content))
+    return "".join(para.text + "\n" for para in doc.paragraphs)
+
+
+@register(['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'])
+def extract_docx(file_content: bytes, deadline: Optional[Deadline] = None) -> str:
+    """
+    Stream word/document.xml out of the package with an iterative parser.
+
+    Nothing else in the zip (images, embedded objects) is read. Body
+    paragraphs become lines and each table row becomes one line of
+    " | "-separated cells.
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_content)) as package:
+            with package.open("word/document.xml") as document:
+                return _docx_text(document, deadline)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError) as e:
+        logger.warning(f"Streaming DOCX extraction failed ({e}), falling back to python-docx")
+        return extract_docx_object_model(file_content, deadline)
+
+
+def _docx_text(document, deadline: Optional[Deadline]) -> str:
+    lines: List[str] = []
+    paragraphs: List[List[str]] = []  # Open paragraphs; text boxes nest a paragraph inside another
+    tables: List[Dict[str, List[str]]] = []  # Open tables, innermost last
+    # Text boxes are stored twice, as drawing and as legacy fallback; only the first is read
+    fallback_depth = 0
+
+    for event, elem in ET.iterparse(document, events=("start", "end")):
+        tag = elem.tag
+        if event == "start":
+            if tag == _W + "p":
+                paragraphs.append([])
+            elif tag == _W + "tbl":
+                tables.append({"row": [], "cell": []})
+            elif tag == _MC + "Fallback":
+                fallback_depth += 1
+            continue
+
+        if tag == _MC + "Fallback":
+            fallback_depth -= 1
+        elif fallback_depth:
+            if tag == _W + "p":
+                paragraphs.pop()
+            elif tag == _W + "tbl" and tables:
+                tables.pop()
+        elif tag == _W + "t":
+            if paragraphs:
+                paragraphs[-1].append(elem.text or "")
+        elif tag == _W + "tab":
+            if paragraphs:
+                paragraphs[-1].append("\t")
+        elif tag in (_W + "br", _W + "cr"):
+            if paragraphs:
+                paragraphs[-1].append("\n")
+        elif tag == _W + "p":
+            text = "".join(paragraphs.pop())
+            if paragraphs:
+                paragraphs[-1].append(text)
+            elif tables:
+                tables[-1]["cell"].append(text)
+            else:
+                lines.append(text)
+            elem.clear()
+            if deadline and deadline.expired:
+                logger.warning(f"Extraction deadline reached, keeping the first {len(lines)} paragraphs")
+                break
+        elif tag == _W + "tc" and tables:
+            tables[-1]["row"].append(" ".join(t for t in tables[-1]["cell"] if t))
+            tables[-1]["cell"] = []
+        elif tag == _W + "tr" and tables:
+            row = " | ".join(tables[-1]["row"])
+            tables[-1]["row"] = []
+            if len(tables) > 1:
+                tables[-2]["cell"].append(row)  # A table nested in a cell
+            else:
+                lines.append(row)
+            elem.clear()
+        elif tag == _W + "tbl" and tables:
+            tables.pop()
+    return "".join(line + "\n" for line in lines)
+
+
+def extract_pptx_object_model(file_content: bytes, deadline: Optional[Deadline] = None) -> str:
+    """python-pptx fallback for presentations the streaming path cannot read; shape text only."""
+    import pptx
+
+    presentation = pptx.Presentation(io.BytesIO(file_content))
+    text_content = ""
+    for slide_number, slide in enumerate(presentation.slides):
+        if deadline and deadline.expired:
+            logger.warning(f"Extraction deadline reached, keeping the first {slide_number} slides")
+            break
+        for shape in slide.shapes:
+            if hasattr(shape, "text"):
+                text_content += shape.text + "\n"
+        # Add a separator between slides
+        text_content += "\n---\n"
+    return text_content
+
+
+@register(['application/vnd.openxmlformats-officedocument.presentationml.presentation'])
+def extract_pptx(file_content: bytes, deadline: Optional[Deadline] = None) -> str:
+    """
+    Stream each slide's XML, and its speaker notes, out of the package in presentation order.
+
+    Media parts are never read. Every text paragraph (shapes, groups,
+    tables) becomes a line; notes follow their slide's text.
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_content)) as package:
+            slide_paths = _pptx_slide_paths(package)
+            if not slide_paths:
+                raise KeyError("no slides reachable from ppt/presentation.xml")
+            text_content = ""
+            for slide_number, slide_path in enumerate(slide_paths):
+                if deadline and deadline.expired:
+                    logger.warning(f"Extraction deadline reached, keeping the first {slide_number} slides")
+                    break
+                with package.open(slide_path) as slide:
+                    text_content += _drawingml_text(slide)
+                notes_path = _related_part(package, slide_path, "/notesSlide")
+                if notes_path:
+                    with package.open(notes_path) as notes:
+                        text_content += _drawingml_text(notes, body_placeholders_only=True)
+                # Add a separator between slides
+                text_content += "\n---\n"
+            return text_content
+    except (zipfile.BadZipFile, KeyError, ET.ParseError) as e:
+        logger.warning(f"Streaming PPTX extraction failed ({e}), falling back to python-pptx")
+        return extract_pptx_object_model(file_content, deadline)
+
+
+def _relationships(package: zipfile.ZipFile, part_path: str) -> Dict[str, Dict[str, str]]:
+    """Relationship id -> {type, target} for a part, with targets resolved to package paths."""
+    directory, name = posixpath.split(part_path)
+    rels_path = posixpath.join(directory, "_rels", name + ".rels")
+    if rels_path not in package.NameToInfo:
+        return {}
+    with package.open(rels_path) as rels:
+        root = ET.parse(rels).getroot()
+    return {
+        rel.get("Id"): {
+            "type": rel.get("Type", ""),
+            "target": _resolve_target(directory, rel.get("Target", ""))
+        }
+        for rel in root.iter(_PKG_REL + "Relationship")
+        if rel.get("TargetMode") != "External"
+    }
+
+
+def _resolve_target(directory: str, target: str) -> str:
+    # Targets are relative to the source part, or to the package root when they start with "/"
+    if target.startswith("/"):
+        return posixpath.normpath(target.lstrip("/"))
+    return posixpath.normpath(posixpath.join(directory, target))
+
+
+def _related_part(package: zipfile.ZipFile, part_path: str, type_suffix: str) -> Optional[str]:
+    for rel in _relationships(package, part_path).values():
+        if rel["type"].endswith(type_suffix) and rel["target"] in package.NameToInfo:
+            return rel["target"]
+    return None
+
+
+def _pptx_slide_paths(package: zipfile.ZipFile) -> List[str]:
+    # Slide files are not numbered in presentation order; presentation.xml lists the order
+    relationships = _relationships(package, "ppt/presentation.xml")
+    with package.open("ppt/presentation.xml") as presentation:
+        root = ET.parse(presentation).getroot()
+    paths = []
+    for slide_id in root.iter(_P + "sldId"):
+        rel = relationships.get(slide_id.get(_R + "id"))
+        if rel and rel["target"] in package.NameToInfo:
+            paths.append(rel["target"])
+    return paths
+
+
+def _drawingml_text(part, body_placeholders_only: bool = False) -> str:
+    """
+    Text of a slide or notes part, one line per paragraph.
+
+    Notes parts also hold the slide image and slide number placeholders, so
+    for them only the body placeholder (the notes text itself) is kept.
+    """
+    lines: List[str] = []
+    paragraph: List[str] = []
+    shapes: List[bool] = []  # Per open shape: whether its text is kept
+
+    for event, elem in ET.iterparse(part, events=("start", "end")):
+        tag = elem.tag
+        if event == "start":
+            if tag == _P + "sp":
+                shapes.append(not body_placeholders_only)
+            elif tag == _P + "ph" and shapes and body_placeholders_only:
+                shapes[-1] = elem.get("type") == "body"
+            continue
+
+        keep = not body_placeholders_only or (shapes and shapes[-1])
+        if tag == _A + "t":
+            if keep:
+                paragraph.append(elem.text or "")
+        elif tag == _A + "br":
+            if keep:
+                paragraph.append("\n")
+        elif tag == _A + "p":
+            text = "".join(paragraph)
+            paragraph = []
+            if keep and text:
+                lines.append(text)
+            elem.clear()
+        elif tag == _P + "sp":
+            shapes.pop()
+            elem.clear()
+    return "".join(line + "\n" for line in lines)
+
+
+@register(['text/plain'])
+def extract_plain_text(file_content: bytes, deadline: Optional[Deadline] = None) -> str:
+    return file_content.decode('utf-8', errors='ignore')
+
+
+def extract_text(file_content: bytes, mime_type: str, deadline: Optional[Deadline] = None) -> str:
+    """Extract text with the extractor registered for mime_type; unknown types are read as text."""
+    extractor = _EXTRACTORS.get(mime_type)
+    if extractor is None:
+        logger.warning(f"No extractor for {mime_type}, reading it as plain text")
+        extractor = extract_plain_text
+    return extractor(file_content, deadline)
+
+
+def parser_modules(mime_types: Optional[Iterable[str]] = None) -> List[str]:
+    """The parser libraries the extractors for mime_types (all registered ones by default) import."""
+    mime_types = list(mime_types) if mime_types is not None else list(_PARSER_MODULES)
+    return list(dict.fromkeys(_PARSER_MODULES[m] for m in mime_types if m in _PARSER_MODULES))
+
+
+def warm_up(mime_types: Optional[Iterable[str]] = None) -> List[str]:
+    """
+    Import the parser libraries ahead of the first upload that needs them
+    (all registered ones by default); returns the modules imported.
+    """
+    imported = []
+    for module in parser_modules(mime_types):
+        try:
+            importlib.import_module(module)
+            imported.append(module)
+        except ImportError as e:
+            logger.error(f"Could not warm up parser {module}: {e}")
+    return imported
@@ -0,0 +1,17 @@
+# Gunicorn settings; the serving mode is chosen with SERVING_MODE (see serving.py)
+import os
+
+serving_mode = os.getenv("SERVING_MODE", "threads").lower()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# Requests are bounded by REQUEST_BUDGET_S, which stays below this
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+
+if serving_mode == "gevent":
+    # Each request is a greenlet; the limit is on open connections, not threads
+    worker_class = "gevent"
+    worker_connections = int(os.getenv("WORKER_CONNECTIONS", "500"))
+else:
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", "8"))
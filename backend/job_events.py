@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Callable, Dict, Iterator, Optional
+
+from redis_client import get_redis
+from serving import SERVING_MODE, request_concurrency
+
+logger = logging.getLogger(__name__)
+
+# Events after which a job's stream is closed
+TERMINAL_EVENTS = {"completed", "failed"}
+# The last event of a job is kept so a client that subscribes late still learns the current stage
+LAST_EVENT_TTL_S = 60 * 60
+# A stream is closed after this long; EventSource clients reconnect on their own
+SSE_MAX_STREAM_S = float(os.getenv("SSE_MAX_STREAM_S", "300"))
+SSE_HEARTBEAT_S = 15.0
+# How often a stream polls the uploads row while Redis is unavailable
+SSE_POLL_FALLBACK_S = float(os.getenv("SSE_POLL_FALLBACK_S", "10"))
+# Open streams per worker. A stream holds a request thread for up to SSE_MAX_STREAM_S,
+# so threaded workers keep most of theirs for uploads and API calls; a greenlet is cheap.
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "0")) or max(
+    1, request_concurrency() // (2 if SERVING_MODE == "gevent" else 4))
+
+_stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+
+def _channel(job_id: str) -> str:
+    return f"job:events:{job_id}"
+
+
+def _last_event_key(job_id: str) -> str:
+    return f"job:last_event:{job_id}"
+
+
+def publish_job_event(job_id: str, event: str, **data):
+    """
+    Publish a stage transition of a generation job (uploaded, extracting,
+    generating, storing, completed, failed). Best effort - processing never
+    fails because Redis is unavailable.
+    """
+    payload = json.dumps({"event": event, "job_id": job_id, "ts": time.time(), **data}, ensure_ascii=False)
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.set(_last_event_key(job_id), payload, ex=LAST_EVENT_TTL_S)
+        pipe.publish(_channel(job_id), payload)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not publish '{event}' event for job {job_id}: {e}")
+
+
+def acquire_stream_slot() -> bool:
+    """Take one of this worker's SSE_MAX_STREAMS stream slots; False if all are open."""
+    return _stream_slots.acquire(blocking=False)
+
+
+def release_stream_slot():
+    _stream_slots.release()
+
+
+def format_sse(payload: str) -> str:
+    """Format a JSON event payload as a Server-Sent Events message."""
+    event = json.loads(payload).get("event", "message")
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+def _event_payload(job_id: str, event: Dict) -> str:
+    return json.dumps({"job_id": job_id, "ts": time.time(), **event}, ensure_ascii=False)
+
+
+def stream_job_events(job_id: str, initial_event: Optional[Dict] = None,
+                      max_duration: float = SSE_MAX_STREAM_S,
+                      poll_event: Optional[Callable[[], Optional[Dict]]] = None) -> Iterator[str]:
+    """
+    Yield Server-Sent Events for a job until it completes or fails, or until
+    max_duration passes.
+
+    A terminal initial_event (built from the uploads row) is sent right away,
+    without Redis. Otherwise the last published event is replayed first, so
+    no transition is missed between the client's request and the
+    subscription. If Redis cannot be reached, poll_event (which returns the
+    job's terminal event, or None) is called every SSE_POLL_FALLBACK_S
+    instead; without it an "unavailable" event ends the stream.
+    """
+    # Tell EventSource clients how quickly to reconnect after the stream closes
+    yield "retry: 3000\n\n"
+
+    if initial_event is not None and initial_event.get("event") in TERMINAL_EVENTS:
+        yield format_sse(_event_payload(job_id, initial_event))
+        return
+
+    deadline = time.monotonic() + max_duration
+    try:
+        client = get_redis()
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(_channel(job_id))
+    except Exception as e:
+        logger.warning(f"Cannot subscribe to events of job {job_id}, falling back to polling: {e}")
+        yield from _poll_job_events(job_id, poll_event, deadline)
+        return
+
+    try:
+        last_event = client.get(_last_event_key(job_id))
+        if last_event is None and initial_event is not None:
+            last_event = _event_payload(job_id, initial_event)
+        if last_event is not None:
+            yield format_sse(last_event)
+            if json.loads(last_event).get("event") in TERMINAL_EVENTS:
+                return
+
+        last_sent = time.monotonic()
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=1.0)
+            if message is None:
+                if time.monotonic() - last_sent >= SSE_HEARTBEAT_S:
+                    # Comment line - keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    last_sent = time.monotonic()
+                continue
+            yield format_sse(message["data"])
+            last_sent = time.monotonic()
+            if json.loads(message["data"]).get("event") in TERMINAL_EVENTS:
+                return
+    except Exception as e:
+        logger.warning(f"Lost the event stream of job {job_id}, falling back to polling: {e}")
+        yield from _poll_job_events(job_id, poll_event, deadline)
+    finally:
+        try:
+            pubsub.close()
+        except Exception:
+            pass
+
+
+def _poll_job_events(job_id: str, poll_event: Optional[Callable[[], Optional[Dict]]],
+                     deadline: float) -> Iterator[str]:
+    """Without Redis: wait for the job's terminal event by polling, rather than dropping the stream."""
+    if poll_event is None:
+        yield format_sse(_event_payload(job_id, {"event": "unavailable"}))
+        return
+    while time.monotonic() < deadline:
+        event = poll_event()
+        if event is not None:
+            yield format_sse(_event_payload(job_id, event))
+            return
+        time.sleep(SSE_POLL_FALLBACK_S)
+        yield ": keepalive\n\n"
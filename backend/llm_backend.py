@@ -0,0 +1,348 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass, replace, asdict
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+from pipeline import Deadline
+
+logger = logging.getLogger(__name__)
+
+# Safety settings used for every generation call - BLOCK_NONE for all categories
+DEFAULT_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+
+@dataclass(frozen=True)
+class GenerationParams:
+    """Immutable per-call generation parameters; derive variants with with_temperature()."""
+
+    temperature: float = 1.0
+    top_p: float = 1.0
+    top_k: int = 32
+    max_output_tokens: int = 8192
+
+    def with_temperature(self, temperature: float) -> "GenerationParams":
+        return replace(self, temperature=temperature)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class LLMBackendError(Exception):
+    """Raised when a backend call fails (API error, simulated fault, empty response)."""
+
+
+class LLMResponse:
+    """Normalized result of a single generation call."""
+
+    def __init__(self, text: str, input_tokens: int = 0, output_tokens: int = 0, finish_reason: str = "STOP"):
+        self.text = text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.finish_reason = finish_reason
+
+    def __repr__(self):
+        return f"LLMResponse(chars={len(self.text)}, in={self.input_tokens}, out={self.output_tokens}, finish={self.finish_reason})"
+
+
+class LLMBackend:
+    """Interface every LLM backend implements."""
+
+    name = "base"
+
+    def generate(self, prompt: str, params: GenerationParams,
+                 safety_settings: Optional[List[Dict]] = None,
+                 deadline: Optional[Deadline] = None) -> LLMResponse:
+        """
+        Generate a full response for the prompt.
+
+        Backends that cannot bound a single call ignore deadline;
+        ResilientBackend enforces it around them.
+        """
+        raise NotImplementedError
+
+    def generate_stream(self, prompt: str, params: GenerationParams,
+                        safety_settings: Optional[List[Dict]] = None) -> Iterator[str]:
+        """Yield the response text in pieces as it is produced."""
+        raise NotImplementedError
+
+    def count_tokens(self, text: str) -> int:
+        """Return the number of input tokens the text would consume."""
+        raise NotImplementedError
+
+    def warm_up(self):
+        """Load whatever the first call would otherwise load (SDKs, clients); optional."""
+
+
+class GeminiBackend(LLMBackend):
+    """
+    Backend that calls the Google Gemini API.
+
+    Model clients are pooled process-wide, one per (model, safety settings)
+    pair, and never mutated after construction - generation parameters are
+    passed per call instead. All pooled models share the SDK's default
+    client, whose gRPC channel keeps its connection alive and is safe to
+    use from several threads, so concurrent generations in one worker reuse
+    the same TLS connection.
+
+    The SDK (google.generativeai and gRPC) is imported on the first call,
+    not at construction, so workers boot without it; see warm_up().
+    """
+
+    name = "gemini"
+
+    _pool: Dict[Tuple, Any] = {}
+    _pool_lock = threading.Lock()
+    _configured_key: Optional[Tuple] = None
+
+    def __init__(self, model_name: str = "gemini-2.0-flash", api_key: Optional[str] = None):
+        self.model_name = model_name
+        self._api_key = api_key or os.getenv("GEMINI_API_KEY")
+        self._transport = os.getenv("GEMINI_TRANSPORT", "grpc")
+        self._genai = None
+
+    def _sdk(self):
+        if self._genai is None:
+            # Imported here so the fake backend works on machines without the SDK
+            import google.generativeai as genai
+
+            self._configure(genai, self._api_key, self._transport)
+            self._genai = genai
+        return self._genai
+
+    @classmethod
+    def _configure(cls, genai, api_key: Optional[str], transport: str):
+        # genai.configure() drops the cached API clients, so only call it when the settings change
+        with cls._pool_lock:
+            if cls._configured_key == (api_key, transport):
+                return
+            genai.configure(api_key=api_key, transport=transport)
+            cls._configured_key = (api_key, transport)
+            cls._pool.clear()
+
+    def _model(self, safety_settings: Optional[List[Dict]] = None):
+        safety_settings = safety_settings or DEFAULT_SAFETY_SETTINGS
+        key = (self.model_name, tuple(tuple(sorted(s.items())) for s in safety_settings))
+        model = self._pool.get(key)
+        if model is None:
+            genai = self._sdk()  # Configures under the pool lock, so not while holding it
+            with self._pool_lock:
+                model = self._pool.get(key)
+                if model is None:
+                    model = genai.GenerativeModel(
+                        model_name=self.model_name,
+                        safety_settings=safety_settings
+                    )
+                    self._pool[key] = model
+                    logger.info(f"Created pooled Gemini client for {self.model_name} (pool size {len(self._pool)})")
+        return model
+
+    def generate(self, prompt: str, params: GenerationParams,
+                 safety_settings: Optional[List[Dict]] = None,
+                 deadline: Optional[Deadline] = None) -> LLMResponse:
+        response = self._model(safety_settings).generate_content(prompt, generation_config=params.as_dict())
+
+        if not response or not hasattr(response, 'text'):
+            raise LLMBackendError("Empty response from Gemini API")
+
+        usage = getattr(response, 'usage_metadata', None)
+        finish_reason = "STOP"
+        candidates = getattr(response, 'candidates', None)
+        if candidates:
+            finish_reason = str(getattr(candidates[0], 'finish_reason', "STOP"))
+
+        return LLMResponse(
+            text=response.text,
+            input_tokens=getattr(usage, 'prompt_token_count', 0) if usage else 0,
+            output_tokens=getattr(usage, 'candidates_token_count', 0) if usage else 0,
+            finish_reason=finish_reason
+        )
+
+    def generate_stream(self, prompt: str, params: GenerationParams,
+                        safety_settings: Optional[List[Dict]] = None) -> Iterator[str]:
+        response = self._model(safety_settings).generate_content(
+            prompt, generation_config=params.as_dict(), stream=True
+        )
+        for chunk in response:
+            if hasattr(chunk, 'text') and chunk.text:
+                yield chunk.text
+
+    def count_tokens(self, text: str) -> int:
+        return self._model().count_tokens(text).total_tokens
+
+    def warm_up(self):
+        # Imports the SDK and builds the pooled client for the default safety settings
+        self._model()
+
+
+class FakeBackend(LLMBackend):
+    """
+    Deterministic offline backend for load tests and benchmarks.
+
+    Responses are valid question JSON in the same shape Gemini returns. Latency,
+    errors, truncation and malformed JSON are injected at configurable rates.
+    The outcome of a call depends only on the seed, the prompt and how many
+    times that prompt was seen before, so a benchmark run is reproducible even
+    when calls are made concurrently.
+    """
+
+    name = "fake"
+
+    def __init__(self, seed: int = 0, latency_ms: float = 0.0, latency_jitter_ms: float = 0.0,
+                 ms_per_output_token: float = 0.0, error_rate: float = 0.0,
+                 truncation_rate: float = 0.0, malformed_rate: float = 0.0, duplicate_rate: float = 0.0):
+        self.seed = seed
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.ms_per_output_token = ms_per_output_token
+        self.error_rate = error_rate
+        self.truncation_rate = truncation_rate
+        self.malformed_rate = malformed_rate
+        self.duplicate_rate = duplicate_rate
+
+        self._lock = threading.Lock()
+        self._prompt_calls: Dict[str, int] = {}
+        self.stats = {"calls": 0, "errors": 0, "truncated": 0, "malformed": 0}
+
+    @classmethod
+    def from_env(cls) -> "FakeBackend":
+        """Build a fake backend from FAKE_LLM_* environment variables."""
+        return cls(
+            seed=int(os.getenv("FAKE_LLM_SEED", "0")),
+            latency_ms=float(os.getenv("FAKE_LLM_LATENCY_MS", "0")),
+            latency_jitter_ms=float(os.getenv("FAKE_LLM_LATENCY_JITTER_MS", "0")),
+            ms_per_output_token=float(os.getenv("FAKE_LLM_MS_PER_OUTPUT_TOKEN", "0")),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+            truncation_rate=float(os.getenv("FAKE_LLM_TRUNCATION_RATE", "0")),
+            malformed_rate=float(os.getenv("FAKE_LLM_MALFORMED_RATE", "0")),
+            duplicate_rate=float(os.getenv("FAKE_LLM_DUPLICATE_RATE", "0")),
+        )
+
+    def _rng_for(self, prompt: str) -> random.Random:
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        with self._lock:
+            call_index = self._prompt_calls.get(prompt_hash, 0)
+            self._prompt_calls[prompt_hash] = call_index + 1
+            self.stats["calls"] += 1
+        return random.Random(f"{self.seed}:{prompt_hash}:{call_index}")
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _requested_count(self, prompt: str) -> int:
+        match = re.search(r'exactly\s+(\d+)', prompt, re.IGNORECASE)
+        return int(match.group(1)) if match else 1
+
+    def _build_questions(self, rng: random.Random, count: int, with_explanations: bool = True,
+                         num_chunks: int = 0) -> List[Dict[str, Any]]:
+        questions = []
+        for _ in range(count):
+            topic = rng.randint(1, 10 ** 6)
+            if rng.random() < self.duplicate_rate:
+                # Draw from a tiny pool so the same question shows up again, like a repetitive model
+                topic = rng.randint(1, 3)
+            question = {
+                "question": f"מהו המושג המרכזי מספר {topic}?",
+                "options": [f"תשובה {topic}-{i}" for i in range(4)],
+                "correct_option_index": rng.randint(0, 3),
+            }
+            if num_chunks:
+                question["source_chunk"] = rng.randrange(num_chunks)
+            if with_explanations:
+                question["explanation"] = f"הסבר למושג {topic}"
+            questions.append(question)
+        return questions
+
+    def _render(self, rng: random.Random, prompt: str, params: GenerationParams) -> LLMResponse:
+        roll = rng.random()
+        if roll < self.error_rate:
+            self._count("errors")
+            self._sleep(rng, 0)
+            raise LLMBackendError("Simulated backend error")
+
+        if "write a short explanation" in prompt:
+            # Batched explanation request - answer every question id in the prompt
+            payload = [{"id": question_id, "explanation": f"הסבר לשאלה {question_id}"}
+                       for question_id in re.findall(r'"id": "([^"]+)"', prompt)]
+        else:
+            count = self._requested_count(prompt)
+            questions = self._build_questions(rng, count, with_explanations="Do NOT write explanations" not in prompt,
+                                              num_chunks=len(re.findall(r'\[CHUNK \d+\]', prompt)))
+            payload = questions[0] if count == 1 else questions
+        text = "```json\n" + json.dumps(payload, ensure_ascii=False, indent=2) + "\n```"
+        finish_reason = "STOP"
+
+        roll = rng.random()
+        if roll < self.truncation_rate:
+            self._count("truncated")
+            text = text[:rng.randint(1, max(1, len(text) - 1))]
+            finish_reason = "MAX_TOKENS"
+        elif roll < self.truncation_rate + self.malformed_rate:
+            self._count("malformed")
+            # Typical model mistakes: trailing commas and unbalanced brackets
+            text = re.sub(r'"\n(\s*)\}', r'",\n\1}', text, count=1).replace(']\n```', '\n```', 1)
+
+        max_tokens = params.max_output_tokens
+        output_tokens = self.count_tokens(text)
+        if max_tokens and output_tokens > max_tokens:
+            text = text[:max_tokens * 4]
+            output_tokens = max_tokens
+            finish_reason = "MAX_TOKENS"
+
+        return LLMResponse(
+            text=text,
+            input_tokens=self.count_tokens(prompt),
+            output_tokens=output_tokens,
+            finish_reason=finish_reason
+        )
+
+    def _sleep(self, rng: random.Random, output_tokens: int):
+        delay_ms = self.latency_ms + output_tokens * self.ms_per_output_token
+        if self.latency_jitter_ms:
+            delay_ms += rng.uniform(0, self.latency_jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000.0)
+
+    def generate(self, prompt: str, params: GenerationParams,
+                 safety_settings: Optional[List[Dict]] = None,
+                 deadline: Optional[Deadline] = None) -> LLMResponse:
+        rng = self._rng_for(prompt)
+        response = self._render(rng, prompt, params)
+        self._sleep(rng, response.output_tokens)
+        return response
+
+    def generate_stream(self, prompt: str, params: GenerationParams,
+                        safety_settings: Optional[List[Dict]] = None) -> Iterator[str]:
+        rng = self._rng_for(prompt)
+        response = self._render(rng, prompt, params)
+        pieces = [response.text[i:i + 200] for i in range(0, len(response.text), 200)] or [""]
+        per_piece_tokens = response.output_tokens // len(pieces)
+        for piece in pieces:
+            self._sleep(rng, per_piece_tokens)
+            yield piece
+
+    def count_tokens(self, text: str) -> int:
+        # Rough approximation of Gemini tokenization: ~4 characters per token
+        return max(1, len(text) // 4)
+
+
+def get_backend(name: Optional[str] = None) -> LLMBackend:
+    """Create the backend selected by name or the LLM_BACKEND environment variable."""
+    name = (name or os.getenv("LLM_BACKEND", "gemini")).lower()
+    if name == "fake":
+        logger.warning("Using fake LLM backend - responses are synthetic")
+        return FakeBackend.from_env()
+    if name == "gemini":
+        return GeminiBackend()
+    raise ValueError(f"Unknown LLM backend: {name}")
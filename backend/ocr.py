@@ -0,0 +1,164 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from pipeline import Deadline
+from redis_client import get_redis
+from serving import run_in_event_loop
+
+logger = logging.getLogger(__name__)
+
+# OCR for PDF pages without a text layer (scanned lecture notes). Pages are
+# rendered with poppler's pdftoppm and read by the tesseract binary; both run
+# as child processes, so the pool below only drives them and each page gets a
+# core of its own (under gevent its threads are greenlets on the main loop). Requires the poppler-utils, tesseract-ocr and
+# tesseract-ocr-heb system packages (see nixpacks.toml).
+OCR_ENABLED = os.getenv("OCR_ENABLED", "on").lower() not in ("0", "off", "false", "no")
+OCR_LANGUAGES = os.getenv("OCR_LANGUAGES", "heb+eng")
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+# Pages rendered and read at the same time, per process
+OCR_WORKERS = int(os.getenv("OCR_WORKERS") or os.cpu_count() or 1)
+# Upper bound for a single page, on top of the extraction deadline
+OCR_PAGE_TIMEOUT_S = int(os.getenv("OCR_PAGE_TIMEOUT_S", "60"))
+# A page whose text layer has fewer characters than this is treated as scanned
+OCR_MIN_PAGE_CHARS = int(os.getenv("OCR_MIN_PAGE_CHARS", "16"))
+OCR_CACHE_TTL_S = int(os.getenv("OCR_CACHE_TTL_S", str(30 * 24 * 3600)))
+
+# Tesseract parallelises one page over all cores with OpenMP; with one page
+# per core that oversubscribes the CPU, so each process keeps to one thread
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=max(1, OCR_WORKERS), thread_name_prefix="ocr")
+    return _pool
+
+
+def needs_ocr(page_text: str) -> bool:
+    """Whether a page's text layer is missing or too thin to be the page's real content."""
+    return len(page_text.strip()) < OCR_MIN_PAGE_CHARS
+
+
+def page_hash(page) -> Optional[str]:
+    """
+    Hash of a PyPDF2 page's content stream and the raw (still encoded) data
+    of the images it draws, plus the OCR settings. Identical scans give the
+    same hash without rendering anything; None if the page cannot be read.
+    """
+    try:
+        digest = hashlib.sha256(f"{OCR_LANGUAGES}:{OCR_DPI}".encode())
+        contents = page.get_contents()
+        if contents is not None:
+            digest.update(contents.get_data())
+        resources = page.get("/Resources")
+        xobjects = resources.get_object().get("/XObject") if resources is not None else None
+        if xobjects is not None:
+            for name, xobject in sorted(xobjects.get_object().items()):
+                stream = xobject.get_object()
+                digest.update(name.encode())
+                digest.update(getattr(stream, "_data", b"") or stream.get_data())
+        return digest.hexdigest()
+    except Exception as e:
+        logger.warning(f"Could not hash PDF page for the OCR cache: {e}")
+        return None
+
+
+def _cache_key(digest: str) -> str:
+    return f"ocr:page:{digest}"
+
+
+def _cached_pages(hashes: Dict[int, str]) -> Dict[int, str]:
+    if not hashes:
+        return {}
+    try:
+        values = get_redis().mget([_cache_key(digest) for digest in hashes.values()])
+    except Exception as e:
+        logger.warning(f"OCR cache read failed: {e}")
+        return {}
+    return {index: value for index, value in zip(hashes, values) if value is not None}
+
+
+def _cache_page(digest: str, text: str):
+    try:
+        get_redis().set(_cache_key(digest), text, ex=OCR_CACHE_TTL_S)
+    except Exception as e:
+        logger.warning(f"OCR cache write failed: {e}")
+
+
+def _ocr_page(pdf_path: str, page_number: int, timeout: int) -> str:
+    """Render one page (1-based) and read it with tesseract."""
+    from pdf2image import convert_from_path
+    import pytesseract
+
+    images = convert_from_path(
+        pdf_path, dpi=OCR_DPI, first_page=page_number, last_page=page_number,
+        grayscale=True, timeout=timeout
+    )
+    return "".join(
+        pytesseract.image_to_string(image, lang=OCR_LANGUAGES, timeout=timeout) for image in images
+    )
+
+
+def ocr_pages(file_content: bytes, pages: Dict[int, object], deadline: Optional[Deadline] = None) -> Dict[int, str]:
+    """
+    OCR the given PDF pages (0-based index -> PyPDF2 page) in parallel.
+
+    Cached pages are not rendered again. Returns index -> text for the pages
+    that were read; pages that failed, or were still waiting when the
+    deadline ran out, are left out.
+    """
+    if not OCR_ENABLED or not pages:
+        return {}
+
+    hashes = {index: digest for index, digest in ((i, page_hash(p)) for i, p in pages.items()) if digest}
+    results = _cached_pages(hashes)
+    todo = [index for index in pages if index not in results]
+    logger.info(f"OCR: {len(pages)} pages without text, {len(results)} cached, {len(todo)} to read")
+    if not todo:
+        return results
+
+    timeout = OCR_PAGE_TIMEOUT_S
+    if deadline is not None:
+        timeout = max(1, int(min(timeout, deadline.remaining())))
+
+    for index, text in run_in_event_loop(_read_pages, file_content, todo, timeout, deadline).items():
+        results[index] = text
+        if index in hashes:
+            _cache_page(hashes[index], text)
+    return results
+
+
+def _read_pages(file_content: bytes, todo: List[int], timeout: int, deadline: Optional[Deadline]) -> Dict[int, str]:
+    # pdftoppm reads from a file; every page task shares this copy
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+        pdf_file.write(file_content)
+        pdf_file.flush()
+
+        pool = _get_pool()
+        futures = {pool.submit(_ocr_page, pdf_file.name, index + 1, timeout): index for index in todo}
+        done, not_done = wait(futures, timeout=max(0, deadline.remaining()) if deadline is not None else None)
+        if not_done:
+            # Pages already rendering hold their own handle on the file and stop at their timeout
+            for future in not_done:
+                future.cancel()
+            logger.warning(f"OCR deadline reached, {len(not_done)} of {len(todo)} pages left unread")
+
+    texts = {}
+    for future in done:
+        index = futures[future]
+        try:
+            texts[index] = future.result()
+        except Exception as e:
+            logger.error(f"OCR failed for page {index + 1}: {e}")
+    return texts
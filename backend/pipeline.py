@@ -0,0 +1,239 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from serving import request_concurrency
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineCancelled(Exception):
+    """Raised inside a stage that noticed the pipeline was cancelled."""
+
+
+class Deadline:
+    """
+    Time budget of a request or job, created when it starts and passed down
+    to every stage so each one sizes its own timeouts from what is left.
+    """
+
+    def __init__(self, budget_seconds: float):
+        self.budget = budget_seconds
+        self._expires_at = time.monotonic() + budget_seconds
+
+    def remaining(self) -> float:
+        """Seconds left; never negative."""
+        return max(0.0, self._expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: float, reserve: float = 0.0) -> float:
+        """The timeout for one step: at most cap, leaving reserve seconds for the steps after it."""
+        return max(0.0, min(cap, self.remaining() - reserve))
+
+    def child(self, max_seconds: Optional[float] = None, reserve: float = 0.0) -> "Deadline":
+        """A deadline for one stage: at most max_seconds, ending reserve seconds before this one."""
+        budget = self.remaining() - reserve
+        if max_seconds is not None:
+            budget = min(budget, max_seconds)
+        return Deadline(max(0.0, budget))
+
+    def __repr__(self):
+        return f"Deadline(remaining={self.remaining():.1f}s of {self.budget:.0f}s)"
+
+
+class CancelToken:
+    """
+    Shared flag long-running stages check between steps so a failed pipeline
+    stops early. It also carries the pipeline's deadline, if it has one.
+    """
+
+    def __init__(self, deadline: Optional[Deadline] = None):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+        self.deadline = deadline
+
+    def cancel(self, reason: str):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise PipelineCancelled(f"Pipeline cancelled: {self.reason}")
+
+
+class Stage:
+    def __init__(self, name: str, fn: Callable, deps: Sequence[str] = (), inline: bool = False):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.inline = inline
+
+
+class Pipeline:
+    """
+    A small DAG of stages run on a shared thread pool.
+
+    Each stage starts as soon as the stages it depends on have finished and
+    receives their results as positional arguments, in the order of its deps.
+    The first failing stage cancels the token, pending stages are never
+    started, and its exception is re-raised unchanged from run(). Stages that
+    are already running finish in the background; long ones should check the
+    token. Per-stage start offsets and durations are kept in timings.
+    An optional deadline is carried on the token for stages to size their
+    timeouts from.
+
+    Stages added with inline=True run on the thread that called run(), one
+    at a time, instead of on the pool. Long blocking stages (waiting for a
+    generation slot, LLM calls) belong there: on the pool they would hold
+    threads that the short stages of every other pipeline in the process
+    need.
+    """
+
+    # Shared by all pipelines in the process; only short stages run here. By default sized
+    # for a few concurrent stages per request the worker serves, plus background jobs.
+    _executor = ThreadPoolExecutor(
+        max_workers=int(os.getenv("PIPELINE_THREADS") or max(16, 4 * request_concurrency())),
+        thread_name_prefix="pipeline"
+    )
+
+    def __init__(self, name: str, deadline: Optional[Deadline] = None):
+        self.name = name
+        self.token = CancelToken(deadline)
+        self.timings: Dict[str, Dict[str, Any]] = {}
+        self._stages: Dict[str, Stage] = {}
+        self._started_at = 0.0
+
+    def add(self, name: str, fn: Callable, deps: Sequence[str] = (), inline: bool = False) -> "Pipeline":
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'")
+        self._stages[name] = Stage(name, fn, deps, inline)
+        return self
+
+    def _run_stage(self, stage: Stage, args: List[Any]) -> Any:
+        self.token.raise_if_cancelled()
+        start = time.monotonic()
+        self.timings[stage.name] = {"start_ms": round((start - self._started_at) * 1000)}
+        try:
+            return stage.fn(*args)
+        finally:
+            self.timings[stage.name]["duration_ms"] = round((time.monotonic() - start) * 1000)
+
+    def elapsed_ms(self) -> int:
+        return round((time.monotonic() - self._started_at) * 1000)
+
+    def run(self) -> Dict[str, Any]:
+        """Run every stage; returns stage name -> result."""
+        self._started_at = time.monotonic()
+        results: Dict[str, Any] = {}
+        running = {}
+        pending = dict(self._stages)
+        ready_inline: List[Tuple[Stage, List[Any]]] = []
+        failures: List[Tuple[str, BaseException]] = []
+        # Pool stages are started from the completion callbacks of their dependencies,
+        # so they do not wait for an inline stage the calling thread is busy with
+        changed = threading.Condition()  # Reentrant: a callback can run inside start_ready()
+
+        def start_ready():
+            for name, stage in list(pending.items()):
+                if name not in pending or not all(dep in results for dep in stage.deps):
+                    continue
+                del pending[name]
+                args = [results[dep] for dep in stage.deps]
+                if stage.inline:
+                    ready_inline.append((stage, args))
+                else:
+                    future = self._executor.submit(self._run_stage, stage, args)
+                    running[future] = name
+                    future.add_done_callback(on_done)
+
+        def on_done(future):
+            with changed:
+                name = running.pop(future, None)
+                if name is None or future.cancelled():
+                    pass
+                elif future.exception() is not None:
+                    failures.append((name, future.exception()))
+                elif not failures:
+                    results[name] = future.result()
+                    start_ready()
+                changed.notify_all()
+
+        def fail(name: str, error: BaseException):
+            self.timings.setdefault(name, {})["failed"] = True
+            self.token.cancel(f"stage '{name}' failed: {error}")
+            for other in list(running):
+                other.cancel()
+            logger.error(f"Pipeline {self.name}: stage '{name}' failed, cancelling "
+                         f"{len(running) + len(pending) + len(ready_inline)} other stages")
+            raise error
+
+        try:
+            with changed:
+                start_ready()
+            while True:
+                with changed:
+                    while running and not failures and not ready_inline:
+                        changed.wait()
+                    if failures:
+                        fail(*failures[0])
+                    if not ready_inline:
+                        if pending:
+                            raise RuntimeError(f"Pipeline {self.name}: stages {list(pending)} can never start")
+                        break
+                    stage, args = ready_inline.pop(0)
+                try:
+                    result = self._run_stage(stage, args)
+                except Exception as error:
+                    with changed:
+                        fail(stage.name, error)
+                with changed:
+                    results[stage.name] = result
+                    start_ready()
+        finally:
+            logger.info(f"Pipeline {self.name} stage timings: {self.timings}")
+        return results
+
+
+class Heartbeat:
+    """
+    Calls beat() every interval seconds on a daemon thread while the block runs.
+
+    Long jobs use it to show they are alive; a job whose heartbeat stops
+    (the worker was killed) can then be picked up by another worker.
+    Errors from beat() are logged and the heartbeat keeps going.
+    """
+
+    def __init__(self, name: str, beat: Callable[[], None], interval: float):
+        self.name = name
+        self.beat = beat
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                logger.warning(f"Heartbeat {self.name} failed: {e}")
+
+    def __enter__(self) -> "Heartbeat":
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        return False
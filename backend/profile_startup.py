@@ -0,0 +1,83 @@
+"""
+Startup profile: how long importing the app takes, which imports dominate, and
+the resident memory of a freshly booted worker.
+
+Each run imports the module in a fresh interpreter with `python -X importtime`,
+using the current environment (set LLM_BACKEND, REDIS_URL etc. as in production).
+
+Example:
+    python profile_startup.py --runs 3 --top 15
+    python profile_startup.py --warm-up
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from typing import Dict, List, Tuple
+
+
+def import_once(module: str, warm_up: bool) -> Tuple[float, Dict[str, Tuple[int, int]], int]:
+    """Import module in a new interpreter; returns wall seconds, module -> (self us, cumulative us), peak RSS KB."""
+    code = f"import {module}"
+    if warm_up:
+        code += f"; {module}.warm_up()"
+    # Report the child's own peak RSS; RUSAGE_CHILDREN would mix in earlier runs
+    code += "; import resource, sys; sys.stderr.write('maxrss: %d\\n' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True
+    )
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    imports: Dict[str, Tuple[int, int]] = {}
+    max_rss = 0
+    for line in result.stderr.splitlines():
+        if line.startswith("maxrss: "):
+            max_rss = int(line.split()[1])
+        elif line.startswith("import time:") and "|" in line and "[us]" not in line:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return wall, imports, max_rss
+
+
+def top_level(imports: Dict[str, Tuple[int, int]]) -> List[Tuple[str, int]]:
+    """Cumulative import time per top-level package, largest first."""
+    roots: Dict[str, int] = {}
+    for name, (_, cumulative) in imports.items():
+        root = name.split(".")[0]
+        roots[root] = max(roots.get(root, 0), cumulative)
+    return sorted(roots.items(), key=lambda item: item[1], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile worker startup time and memory")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--warm-up", action="store_true", help="also run the module's warm_up() hook")
+    args = parser.parse_args()
+
+    walls, rss = [], []
+    imports: Dict[str, Tuple[int, int]] = {}
+    for _ in range(args.runs):
+        wall, imports, max_rss = import_once(args.module, args.warm_up)
+        walls.append(wall)
+        rss.append(max_rss)
+
+    print(f"module: {args.module}{' + warm_up()' if args.warm_up else ''}")
+    print(f"startup_s (median of {args.runs}): {statistics.median(walls):.3f}")
+    print(f"peak_rss_mb: {statistics.median(rss) / 1024:.1f}")
+    print(f"modules_imported: {len(imports)}")
+    print(f"top {args.top} packages by cumulative import time:")
+    for name, cumulative in top_level(imports)[:args.top]:
+        print(f"  {cumulative / 1000:9.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import re
+import zlib
+import random
+import unicodedata
+from typing import Dict, List, Set, Tuple
+
+# Hebrew points and cantillation marks (niqqud), removed during normalization
+_NIQQUD_RE = re.compile(r'[\u0591-\u05C7]')
+_NON_WORD_RE = re.compile(r'[^\w\s]')
+_SPACES_RE = re.compile(r'\s+')
+# Final letter forms are mapped to their regular forms so word endings compare equal
+_FINAL_LETTERS = str.maketrans({'ך': 'כ', 'ם': 'מ', 'ן': 'נ', 'ף': 'פ', 'ץ': 'צ'})
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def normalize_hebrew(text: str) -> str:
+    """Normalize text for comparison: NFKC, no niqqud or punctuation, regular letter forms, single spaces."""
+    text = unicodedata.normalize('NFKC', text or '')
+    text = _NIQQUD_RE.sub('', text)
+    text = text.translate(_FINAL_LETTERS).lower()
+    text = _NON_WORD_RE.sub(' ', text)
+    return _SPACES_RE.sub(' ', text).strip()
+
+
+def shingles(text: str, size: int = 4) -> Set[int]:
+    """Hashed character shingles of normalized text."""
+    if len(text) <= size:
+        return {zlib.crc32(text.encode('utf-8'))}
+    return {zlib.crc32(text[i:i + size].encode('utf-8')) for i in range(len(text) - size + 1)}
+
+
+class NearDuplicateFilter:
+    """
+    Detects near-duplicate questions with MinHash signatures and LSH banding.
+
+    A question is keyed by its stem plus its correct option, so the same
+    question with shuffled or reworded distractors still counts as a duplicate.
+    Candidates found through the LSH buckets are confirmed with the exact
+    Jaccard similarity of their shingle sets.
+    """
+
+    def __init__(self, threshold: float = 0.7, num_perm: int = 64, bands: int = 16, seed: int = 1):
+        assert num_perm % bands == 0, "num_perm must be divisible by bands"
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+        self._buckets: List[Dict[Tuple[int, ...], List[int]]] = [{} for _ in range(bands)]
+        self._shingle_sets: List[Set[int]] = []
+
+    @staticmethod
+    def question_key(question: Dict) -> str:
+        options = question.get('options') or []
+        correct_idx = question.get('correctAnswer', question.get('correct_option_index', 0))
+        correct_option = options[correct_idx] if isinstance(correct_idx, int) and 0 <= correct_idx < len(options) else ''
+        return normalize_hebrew(f"{question.get('question', '')} {correct_option}")
+
+    def _signature(self, shingle_set: Set[int]) -> List[int]:
+        return [min((a * s + b) % _MERSENNE_PRIME for s in shingle_set) for a, b in self._perms]
+
+    def _band_keys(self, signature: List[int]) -> List[Tuple[int, ...]]:
+        return [tuple(signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def is_duplicate(self, question: Dict) -> bool:
+        """Check a question against everything added so far without adding it."""
+        return self._check(question)[0]
+
+    def add(self, question: Dict) -> bool:
+        """Add a question if it is not a near-duplicate; returns True when it was added."""
+        duplicate, shingle_set, band_keys = self._check(question)
+        if duplicate:
+            return False
+        index = len(self._shingle_sets)
+        self._shingle_sets.append(shingle_set)
+        for band, key in enumerate(band_keys):
+            self._buckets[band].setdefault(key, []).append(index)
+        return True
+
+    def filter(self, questions: List[Dict]) -> List[Dict]:
+        """Return the questions that are new, adding them to the filter."""
+        return [q for q in questions if self.add(q)]
+
+    def _check(self, question: Dict):
+        shingle_set = shingles(self.question_key(question))
+        band_keys = self._band_keys(self._signature(shingle_set))
+        candidates = set()
+        for band, key in enumerate(band_keys):
+            candidates.update(self._buckets[band].get(key, ()))
+        for index in candidates:
+            other = self._shingle_sets[index]
+            similarity = len(shingle_set & other) / len(shingle_set | other)
+            if similarity >= self.threshold:
+                return True, shingle_set, band_keys
+        return False, shingle_set, band_keys
+
+    def __len__(self):
+        return len(self._shingle_sets)
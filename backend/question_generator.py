@@ -4,21 +4,18 @@ import json
 import random
 import string
 import logging
-import tempfile
-from pathlib import Path
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Dict, Any, Tuple, Optional, Callable
 
-# Import generative AI - using compatible import style
-import google.generativeai as genai
-
-# Using more focused libraries for different file types
-from unstructured.partition.text import partition_text
-# Avoiding unstructured.partition.pdf due to OCR module dependencies
-import PyPDF2
-import docx
-import pptx  # For PowerPoint presentations
 from dotenv import load_dotenv
 
+from llm_backend import LLMBackend, GenerationParams, DEFAULT_SAFETY_SETTINGS, get_backend
+from resilience import ResilientBackend, CircuitOpenError
+from rate_governor import RateLimitedError
+from question_dedup import NearDuplicateFilter
+from pipeline import CancelToken, Deadline
+import sandbox
+from sandbox import ExtractionError
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -26,86 +23,82 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
-# Set up Gemini AI using compatible configuration method
-api_key = os.getenv("GEMINI_API_KEY")
-genai.configure(api_key=api_key)
+# Version of the text extraction and cleaning pipeline, stored with every extracted text.
+# Bump it whenever extract_text() or clean_text() output changes for the same file.
+EXTRACTOR_VERSION = "3"
+
+# Size of the document chunks questions are attributed to. Questions store the character
+# offsets of their chunk, so changing this does not break the provenance of existing questions.
+CHUNK_SIZE = int(os.getenv("QUESTION_CHUNK_SIZE", "8000"))
+
+# Characters of document text sent to the model in one generation call. Gemini's window is far
+# larger (1M tokens); this keeps prompts affordable. Several documents share it (allocate_budget).
+MAX_CONTENT_CHARS = 200000
+
+# Generation stops this long before its deadline so the questions it has can still be stored,
+# and does not start an LLM call with less than MIN_CALL_BUDGET_S left
+DEADLINE_RESERVE_S = float(os.getenv("DEADLINE_RESERVE_S", "15"))
+MIN_CALL_BUDGET_S = float(os.getenv("MIN_CALL_BUDGET_S", "10"))
+
+def split_into_chunks(text: str, chunk_size: int = CHUNK_SIZE) -> List[Tuple[int, int]]:
+    """Split text into (start, end) spans of about chunk_size characters, breaking between words."""
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_size)
+        if end < len(text):
+            # Break at the last space in the second half of the chunk so words are not cut
+            split_at = text.rfind(' ', start + chunk_size // 2, end)
+            if split_at != -1:
+                end = split_at + 1
+        spans.append((start, end))
+        start = end
+    return spans
+
+def allocate_budget(lengths: List[int], budget: int) -> List[int]:
+    """
+    Split a character budget across documents of the given lengths, max-min fairly.
+    
+    Documents shorter than an equal share keep all their text, and what they
+    leave unused is shared by the longer ones, so a short lecture is never cut
+    to make room for a long one.
+    """
+    shares = [0] * len(lengths)
+    remaining = budget
+    # Shortest first: each takes its full length or an equal share of what is left, whichever is less
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    for position, index in enumerate(order):
+        equal_share = remaining // (len(order) - position)
+        shares[index] = min(lengths[index], equal_share)
+        remaining -= shares[index]
+    return shares
 
 class QuestionGenerator:
     """Generate quiz questions from text content using Gemini 2.0 Flash."""
     
-    def __init__(self):
+    def __init__(self, backend: Optional[LLMBackend] = None, resilient: bool = True):
         self.gemini_model = "gemini-2.0-flash"  # Using Gemini 2.0 Flash
+        # LLM backend - Gemini by default, or the offline fake when LLM_BACKEND=fake
+        backend = backend or get_backend()
+        # Deadlines, backoff, hedging and circuit breaking around every call
+        self.backend = ResilientBackend(backend) if resilient else backend
     
-    def extract_text(self, file_content: bytes, mime_type: str) -> str:
-        """Extract text from file using appropriate libraries based on file type."""
+    def extract_text(self, file_content: bytes, mime_type: str, deadline: Optional[Deadline] = None) -> str:
+        """
+        Extract text from file using the extractor registered for its MIME type.
+        
+        Parsing runs in a sandboxed child process (see sandbox.py); its failures
+        raise ExtractionError with a code. PDF pages and slides past the
+        deadline are skipped, keeping the text read so far.
+        """
         try:
-            # Create a temporary file to work with
-            suffix = self._get_file_suffix(mime_type)
-            with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
-                temp_file.write(file_content)
-                temp_file_path = temp_file.name
-            
-            text_content = ""
-            
-            # Use appropriate extraction method based on file type
-            if mime_type == 'application/pdf':
-                # Use PyPDF2 for PDF files
-                with open(temp_file_path, 'rb') as f:
-                    pdf_reader = PyPDF2.PdfReader(f)
-                    for page in pdf_reader.pages:
-                        text_content += page.extract_text() + "\n"
-                        
-            elif mime_type in ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
-                # Use python-docx for DOCX files
-                doc = docx.Document(temp_file_path)
-                for para in doc.paragraphs:
-                    text_content += para.text + "\n"
-            
-            elif mime_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
-                # Use python-pptx for PPTX files
-                presentation = pptx.Presentation(temp_file_path)
-                for slide in presentation.slides:
-                    for shape in slide.shapes:
-                        if hasattr(shape, "text"):
-                            text_content += shape.text + "\n"
-                    # Add a separator between slides
-                    text_content += "\n---\n"
-                    
-            elif mime_type == 'text/plain':
-                # Simple text file reading
-                with open(temp_file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    text_content = f.read()
-            else:
-                # Fallback for unsupported mime types - try as text
-                try:
-                    with open(temp_file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        text_content = f.read()
-                except:
-                    logger.error(f"Unsupported file type: {mime_type}")
-                    raise ValueError(f"Unsupported file type: {mime_type}")
-            
-            # Clean up the temporary file
-            os.unlink(temp_file_path)
-            
-            return text_content
-            
+            return sandbox.extract_text(file_content, mime_type, deadline)
+        except ExtractionError:
+            raise
         except Exception as e:
             logger.error(f"Error extracting text: {e}")
             raise ValueError(f"Failed to extract text: {str(e)}")
     
-    def _get_file_suffix(self, mime_type: str) -> str:
-        """Get file suffix based on MIME type."""
-        mime_to_suffix = {
-            'application/pdf': '.pdf',
-            'application/msword': '.doc',
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
-            'application/vnd.openxmlformats-officedocument.presentationml.presentation': '.pptx',
-            'text/plain': '.txt',
-            'image/jpeg': '.jpg',
-            'image/png': '.png'
-        }
-        return mime_to_suffix.get(mime_type, '.tmp')
-    
     def clean_text(self, text: str) -> str:
         """Clean and preprocess text."""
         # Remove excessive whitespace
@@ -114,7 +107,48 @@ class QuestionGenerator:
         text = "".join(c if c.isprintable() or c in ['\n', '\t'] else ' ' for c in text)
         return text.strip()
     
-    def generate_questions(self, file_content: bytes, mime_type: str, num_questions: int = 20) -> List[Dict]:
+    def prepare_text(self, file_content: bytes, mime_type: str, deadline: Optional[Deadline] = None) -> str:
+        """Extract and clean document text; raises ValueError if there is too little to generate from."""
+        # Extract text from file using the appropriate method
+        text = self.extract_text(file_content, mime_type, deadline)
+        clean_text = self.clean_text(text)
+        
+        # If text is too short, return an error
+        if len(clean_text) < 100:
+            logger.error("Extracted text is too short")
+            raise ValueError("The document contains too little text to generate questions")
+        
+        return clean_text
+    
+    def combine_documents(self, documents: List[Tuple[str, str]], max_chars: int = MAX_CONTENT_CHARS) -> str:
+        """
+        Combine the cleaned texts of several documents into one text for a single generation pass.
+        
+        Each document is cut to its share of max_chars (allocate_budget) and
+        introduced by a [DOCUMENT N: name] header. Raises ValueError if there
+        is too little text in total to generate from.
+        """
+        headers = [f"[DOCUMENT {index}: {name}]\n" for index, (name, _) in enumerate(documents, start=1)]
+        overhead = sum(len(header) for header in headers) + 2 * len(documents)
+        shares = allocate_budget([len(text) for _, text in documents], max(0, max_chars - overhead))
+        parts = []
+        for header, (name, text), share in zip(headers, documents, shares):
+            if share < len(text):
+                logger.warning(f"Document {name} ({len(text)} chars) truncated to its share of {share} chars")
+                # Cut between words, like split_into_chunks
+                cut = text.rfind(' ', share // 2, share)
+                text = text[:cut if cut != -1 else share]
+            if text:
+                parts.append(header + text)
+        
+        combined = "\n\n".join(parts)
+        if sum(len(text) for _, text in documents) < 100:
+            logger.error("Extracted text is too short")
+            raise ValueError("The documents contain too little text to generate questions")
+        return combined
+    
+    def generate_questions(self, file_content: bytes, mime_type: str, num_questions: int = 20,
+                           include_explanations: bool = True) -> List[Dict]:
         """
         Generate quiz questions from file content using Gemini 2.0 Flash's large context window.
         
@@ -122,57 +156,102 @@ class QuestionGenerator:
             file_content: Binary content of the file
             mime_type: MIME type of the file
             num_questions: Number of questions to generate (always 20 as per requirements)
+            include_explanations: If False, only stems, options and answers are generated;
+                explanations are produced later on demand by generate_explanations()
             
         Returns:
             List of question dictionaries - always 20 questions
         """
         try:
-            # Extract text from file using the appropriate method
-            text = self.extract_text(file_content, mime_type)
-            clean_text = self.clean_text(text)
-            
-            # If text is too short, return an error
-            if len(clean_text) < 100:
-                logger.error("Extracted text is too short")
-                raise ValueError("The document contains too little text to generate questions")
+            clean_text = self.prepare_text(file_content, mime_type)
+        except Exception as e:
+            logger.error(f"Critical error in generate_questions: {str(e)}")
+            raise e
+        
+        return self.generate_questions_from_text(clean_text, num_questions, include_explanations)
+    
+    def generate_questions_from_text(self, clean_text: str, num_questions: int = 20,
+                                     include_explanations: bool = True,
+                                     exclude_questions: Optional[List[Dict]] = None,
+                                     cancel_token: Optional[CancelToken] = None,
+                                     on_progress: Optional[Callable[[int], None]] = None,
+                                     on_checkpoint: Optional[Callable[[List[Dict]], None]] = None) -> List[Dict]:
+        """
+        Generate quiz questions from already extracted and cleaned text.
+        
+        Args:
+            clean_text: Output of prepare_text() or combine_documents()
+            num_questions: Number of questions to generate
+            include_explanations: If False, explanations are left empty for lazy generation
+            exclude_questions: Existing questions (e.g. earlier in the same quiz) that must not be
+                repeated; they are listed in the prompt and pre-seeded into the duplicate filter
+            cancel_token: Checked before every LLM call; a cancelled upload pipeline stops here.
+                If it carries a deadline, calls are sized from the time left and the questions
+                generated so far are returned once it runs out
+            on_progress: Called with the number of questions generated so far whenever it grows
+            on_checkpoint: Called with the questions accepted so far whenever they grow, so a
+                crashed job can resume without paying for them again
             
+        Returns:
+            List of question dictionaries
+        """
+        try:
             logger.info(f"Generating {num_questions} questions with Gemini 2.0 Flash")
             
-            # Configure the generation parameters for Gemini 2.0 Flash
-            generation_config = {
-                "temperature": round(random.uniform(0.9, 1.0), 2),  # Randomize temperature for diversity
-                "top_p": 1,
-                "top_k": 32,
-                "max_output_tokens": 8192,
-            }
+            # Configure the generation parameters for Gemini 2.0 Flash (immutable - derive per-call variants)
+            generation_params = GenerationParams(
+                temperature=round(random.uniform(0.9, 1.0), 2),  # Randomize temperature for diversity
+                top_p=1,
+                top_k=32,
+                max_output_tokens=8192,
+            )
             
-            logger.info(f"Using temperature: {generation_config['temperature']}")
+            logger.info(f"Using temperature: {generation_params.temperature}")
             
             # Set safety settings to lowest level - BLOCK_NONE for all categories
-            safety_settings = [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
+            safety_settings = DEFAULT_SAFETY_SETTINGS
             
             # Utilize Gemini's large context window (up to 1M tokens)
             # We'll use 200K characters which is a safe limit while still being much larger than before
-            max_content_length = 200000
+            max_content_length = MAX_CONTENT_CHARS
             
             if len(clean_text) > max_content_length:
                 logger.warning(f"Content length ({len(clean_text)}) exceeds maximum ({max_content_length}), truncating")
                 content_for_prompt = clean_text[:max_content_length]
             else:
                 content_for_prompt = clean_text
+
+            # Number the chunks so every question can say which one it came from
+            chunk_spans = split_into_chunks(content_for_prompt)
+            chunked_content = "\n".join(
+                f"[CHUNK {index}]\n{content_for_prompt[start:end]}"
+                for index, (start, end) in enumerate(chunk_spans)
+            )
+
+            # Explanations are a large share of the output tokens - skip them in lazy mode
+            if include_explanations:
+                explanation_rule = "Each explanation must clearly justify why the correct answer is the only valid choice"
+                explanation_field = ',\n                "explanation": "הסבר קצר"'
+            else:
+                explanation_rule = "Do NOT write explanations - return only the question, the options and the correct option index"
+                explanation_field = ''
+            
+            # Existing questions the model must not repeat (e.g. when adding more questions to a quiz)
+            exclusion_section = ""
+            if exclude_questions:
+                existing_stems = "\n".join(f"- {q.get('question', '')}" for q in exclude_questions[:200])
+                exclusion_section = f"""
+            DO NOT repeat, rephrase or closely paraphrase any of these existing questions:
+            {existing_stems}
+            """
             
             # Create the prompt to generate all questions at once
             prompt = f"""
-            Create EXACTLY 20 multiple choice questions in Hebrew that assess mastery 
+            Create EXACTLY {num_questions} multiple choice questions in Hebrew that assess mastery 
             of the concepts from the background content. Generate questions that could be answered by someone 
             who truly understands the material, without needing to reference specific text.
 
-            THE NUMBER OF QUESTIONS MUST BE EXACTLY 20. THIS IS CRITICAL.
+            THE NUMBER OF QUESTIONS MUST BE EXACTLY {num_questions}. THIS IS CRITICAL.
 
             CRITICAL RULES:
             1. NEVER use phrases like 'according to the text', 'based on the passage', or any direct text references
@@ -184,46 +263,63 @@ class QuestionGenerator:
                - Ability to apply principles
                - Understanding of relationships and implications
                - Critical thinking about the subject matter
-            6. Each explanation must clearly justify why the correct answer is the only valid choice
+            6. {explanation_rule}
             7. Do not use trailing commas in arrays
-            8. The questions should cover different aspects of the document
-            9. EXACTLY 20 QUESTIONS - NO MORE, NO LESS
+            8. The questions should cover different aspects of the document; when the content has several [DOCUMENT N] sections, cover every one of them
+            9. EXACTLY {num_questions} QUESTIONS - NO MORE, NO LESS
             10. IMPORTANT: All 4 answer options must be of approximately equal length and complexity
             11. All answer options must be plausible to avoid obvious wrong options
             12. Don't make the correct answer more detailed or longer than incorrect options
+            13. Set "source_chunk" to the number N of the [CHUNK N] section the question is based on
 
             Return a valid JSON array where each question has this exact format:
             {{
                 "question": "שאלה בעברית?",
                 "options": ["אפשרות 1", "אפשרות 2", "אפשרות 3", "אפשרות 4"],
                 "correct_option_index": 0,
-                "explanation": "הסבר קצר"
+                "source_chunk": 0{explanation_field}
             }}
-
+            {exclusion_section}
             Background content to derive concepts from:
-            {content_for_prompt}
+            {chunked_content}
             """
             
-            # Make the API call with retries
+            # Re-request only for missing or duplicate questions; API errors are retried by ResilientBackend
             max_attempts = 3
             all_questions = []
             attempt = 0
+            # Overlapping chunks and retries make the model repeat itself - keep only unique questions
+            dedup = NearDuplicateFilter()
+            for existing_question in exclude_questions or []:
+                dedup.add(existing_question)
+            backend_error = None
             
-            # Create Gemini model instance
-            model = genai.GenerativeModel(
-                model_name=self.gemini_model,
-                generation_config=generation_config,
-                safety_settings=safety_settings
-            )
+            # Keep part of the budget for storing whatever this returns
+            deadline = None
+            if cancel_token and cancel_token.deadline:
+                deadline = cancel_token.deadline.child(reserve=DEADLINE_RESERVE_S)
             
             # Try to generate all questions in one go
             while attempt < max_attempts and len(all_questions) < num_questions:
+                if cancel_token:
+                    cancel_token.raise_if_cancelled()
                 attempt += 1
+                if deadline and deadline.remaining() < MIN_CALL_BUDGET_S:
+                    logger.warning(f"Deadline reached after {len(all_questions)} questions, skipping further batch attempts")
+                    break
                 logger.warning(f"Attempt {attempt} to generate all questions")
                 
                 try:
-                    # Generate content using compatible API format
-                    response = model.generate_content(prompt)
+                    # Generate content through the configured backend
+                    try:
+                        response = self.backend.generate(prompt, generation_params, safety_settings, deadline=deadline)
+                    except (CircuitOpenError, RateLimitedError):
+                        raise
+                    except Exception as e:
+                        # The backend already retried with backoff - calling again would only multiply the load
+                        logger.error(f"Generation failed after the backend's retries: {e}")
+                        backend_error = e
+                        break
                     
                     if not response or not hasattr(response, 'text'):
                         logger.warning("Empty response from Gemini API")
@@ -293,9 +389,21 @@ class QuestionGenerator:
                                     'correctAnswer': new_correct_idx,
                                     'explanation': q.get('explanation', '')
                                 }
+
+                                # Chunk provenance - a missing or invalid chunk number is left unset
+                                source_chunk = q.get('source_chunk')
+                                if isinstance(source_chunk, int) and 0 <= source_chunk < len(chunk_spans):
+                                    self._set_source(processed_question, source_chunk, chunk_spans[source_chunk])
                                 processed_questions.append(processed_question)
                         
-                        all_questions.extend(processed_questions)
+                        unique_questions = dedup.filter(processed_questions)
+                        if len(unique_questions) < len(processed_questions):
+                            logger.warning(f"Dropped {len(processed_questions) - len(unique_questions)} near-duplicate questions")
+                        all_questions.extend(unique_questions)
+                        if on_progress and unique_questions:
+                            on_progress(min(len(all_questions), num_questions))
+                        if on_checkpoint and unique_questions:
+                            on_checkpoint(all_questions[:num_questions])
                         
                         # If we got sufficient questions, break
                         if len(all_questions) >= num_questions:
@@ -304,106 +412,65 @@ class QuestionGenerator:
                     except json.JSONDecodeError as e:
                         logger.error(f"Failed to parse JSON response: {e}")
                         logger.error(f"Response text: {response_text}")
+                except (CircuitOpenError, RateLimitedError):
+                    # API is degraded or out of quota - fail fast instead of retrying into it
+                    raise
                 except Exception as e:
-                    logger.error(f"Error generating questions: {e}")
+                    logger.error(f"Error processing generated questions: {e}")
+            
+            if backend_error is not None and not all_questions:
+                raise backend_error
             
             # If we still don't have enough questions, generate them one by one
-            if len(all_questions) < num_questions:
+            if len(all_questions) < num_questions and backend_error is None:
                 logger.warning(f"Only generated {len(all_questions)} questions in batch mode, generating remaining individually")
                 remaining = num_questions - len(all_questions)
                 
-                # Generate individual questions using smaller chunks of the content
-                chunk_size = len(content_for_prompt) // remaining
-                for i in range(remaining):
+                # Generate individual questions from single chunks spread across the content
+                # A few extra attempts replace individual questions rejected as duplicates
+                max_individual_attempts = remaining + min(remaining, 5)
+                for i in range(max_individual_attempts):
+                    if len(all_questions) >= num_questions:
+                        break
+                    if cancel_token:
+                        cancel_token.raise_if_cancelled()
+                    if deadline and deadline.remaining() < MIN_CALL_BUDGET_S:
+                        logger.warning(f"Deadline reached, returning {len(all_questions)} of {num_questions} questions")
+                        break
                     try:
-                        # Get a chunk of the content
-                        start_idx = (i * chunk_size) % max(1, len(content_for_prompt) - chunk_size)
-                        chunk = content_for_prompt[start_idx:start_idx + chunk_size]
+                        chunk_index = (i * len(chunk_spans) // max_individual_attempts) % len(chunk_spans)
+                        chunk_start, chunk_end = chunk_spans[chunk_index]
                         
                         # Randomize temperature for this individual question
                         individual_temp = round(random.uniform(0.9, 1.0), 2)
-                        model.generation_config["temperature"] = individual_temp
+                        individual_params = generation_params.with_temperature(individual_temp)
                         logger.info(f"Using temperature {individual_temp} for individual question #{i+1}")
                         
-                        # Create prompt for a single question
-                        single_prompt = f"""
-                        Create exactly 1 multiple choice question in Hebrew that assesses mastery 
-                        of the concepts from the background content. The question should test understanding 
-                        of the material without directly referencing the text.
-
-                        CRITICAL RULES:
-                        1. Question must be in Hebrew
-                        2. Must have exactly 4 options WITHOUT any prefixes
-                        3. The correct answer must be unambiguously correct
-                        4. IMPORTANT: All 4 answer options must be of approximately equal length and complexity
-                        5. The correct answer should NOT be more detailed or longer than incorrect options
-                        6. All answer options must be plausible and look legitimate
-
-                        Return ONLY ONE question in this JSON format:
-                        {{
-                            "question": "שאלה בעברית?",
-                            "options": ["אפשרות 1", "אפשרות 2", "אפשרות 3", "אפשרות 4"],
-                            "correct_option_index": 0,
-                            "explanation": "הסבר קצר"
-                        }}
-
-                        Background content:
-                        {chunk}
-                        """
-                        
                         logger.warning(f"Generating individual question #{i+1}")
+                        processed_question = self._generate_single_question(
+                            content_for_prompt[chunk_start:chunk_end], individual_params,
+                            explanation_rule, explanation_field, exclusion_section, deadline
+                        )
+                        if not processed_question:
+                            continue
                         
-                        # Generate individual question using compatible API format
-                        # We can reuse the model instance from above
-                        response = model.generate_content(single_prompt)
+                        if not dedup.add(processed_question):
+                            logger.warning(f"Individual question #{i+1} is a near-duplicate, discarding")
+                            continue
                         
-                        if response and hasattr(response, 'text'):
-                            # Clean the response
-                            response_text = response.text
-                            response_text = re.sub(r'^```json', '', response_text)
-                            response_text = re.sub(r'```$', '', response_text)
-                            response_text = re.sub(r'^```', '', response_text)
-                            response_text = response_text.strip()
-                            
-                            try:
-                                question_data = json.loads(response_text)
-                            except:
-                                logger.error(f"Failed to parse individual question response: {response_text}")
-                                continue
-                            
-                            if question_data and 'question' in question_data and 'options' in question_data:
-                                # Get correct index
-                                correct_idx = question_data.get('correctAnswer', 
-                                             question_data.get('correct_option_index', 0))
-                                
-                                options = question_data['options'][:4]  # Ensure exactly 4 options
-                                
-                                # Avoid index errors
-                                if not 0 <= correct_idx < len(options):
-                                    correct_idx = 0
-                                    
-                                correct_option = options[correct_idx]
-                                
-                                # Randomize the position of the correct answer
-                                shuffled_options = options.copy()
-                                random.shuffle(shuffled_options)
-                                new_correct_idx = shuffled_options.index(correct_option)
-                                
-                                logger.info(f"Individual question: original correct idx={correct_idx}, new correct idx={new_correct_idx}")
-                                
-                                # Create standardized question
-                                processed_question = {
-                                    'id': ''.join(random.choices(string.ascii_lowercase + string.digits, k=10)),
-                                    'question': question_data['question'],
-                                    'options': shuffled_options,
-                                    'correctAnswer': new_correct_idx,
-                                    'explanation': question_data.get('explanation', '')
-                                }
-                                
-                                all_questions.append(processed_question)
-                                logger.warning(f"Successfully generated individual question #{i+1}")
+                        self._set_source(processed_question, chunk_index, chunk_spans[chunk_index])
+                        all_questions.append(processed_question)
+                        logger.warning(f"Successfully generated individual question #{i+1}")
+                        if on_progress:
+                            on_progress(len(all_questions))
+                        if on_checkpoint:
+                            on_checkpoint(list(all_questions))
+                    except (CircuitOpenError, RateLimitedError):
+                        raise
                     except Exception as e:
-                        logger.error(f"Error generating individual question #{i+1}: {e}")
+                        # Unusable responses return None above; an exception is a call the backend gave up on
+                        logger.error(f"Error generating individual question #{i+1}, returning {len(all_questions)} questions: {e}")
+                        break
             
             # Final validation - ensure we have exactly the right number of questions
             if len(all_questions) > num_questions:
@@ -415,11 +482,240 @@ class QuestionGenerator:
             return all_questions
             
         except Exception as e:
-            logger.error(f"Critical error in generate_questions: {str(e)}")
+            logger.error(f"Critical error in generate_questions_from_text: {str(e)}")
             raise e  # Re-raise the exception to be handled by the caller
 
-# Example usage
+    @staticmethod
+    def _set_source(question: Dict, chunk_index: int, span: Tuple[int, int]):
+        """Record which chunk of the extracted text a question was generated from."""
+        question['source_chunk'] = chunk_index
+        question['source_start'], question['source_end'] = span
+
+    def _generate_single_question(self, chunk: str, params: GenerationParams, explanation_rule: str,
+                                  explanation_field: str, exclusion_section: str,
+                                  deadline: Optional[Deadline] = None) -> Optional[Dict]:
+        """Generate one question from a single chunk of content; returns None if the response is unusable."""
+        # Create prompt for a single question
+        single_prompt = f"""
+        Create exactly 1 multiple choice question in Hebrew that assesses mastery 
+        of the concepts from the background content. The question should test understanding 
+        of the material without directly referencing the text.
+
+        CRITICAL RULES:
+        1. Question must be in Hebrew
+        2. Must have exactly 4 options WITHOUT any prefixes
+        3. The correct answer must be unambiguously correct
+        4. IMPORTANT: All 4 answer options must be of approximately equal length and complexity
+        5. The correct answer should NOT be more detailed or longer than incorrect options
+        6. All answer options must be plausible and look legitimate
+        7. {explanation_rule}
+
+        {exclusion_section}
+        Return ONLY ONE question in this JSON format:
+        {{
+            "question": "שאלה בעברית?",
+            "options": ["אפשרות 1", "אפשרות 2", "אפשרות 3", "אפשרות 4"],
+            "correct_option_index": 0{explanation_field}
+        }}
+
+        Background content:
+        {chunk}
+        """
+        
+        # Generate individual question through the configured backend
+        response = self.backend.generate(single_prompt, params, DEFAULT_SAFETY_SETTINGS, deadline=deadline)
+        if not response or not hasattr(response, 'text'):
+            return None
+        
+        # Clean the response
+        response_text = response.text
+        response_text = re.sub(r'^```json', '', response_text)
+        response_text = re.sub(r'```$', '', response_text)
+        response_text = re.sub(r'^```', '', response_text)
+        response_text = response_text.strip()
+        
+        try:
+            question_data = json.loads(response_text)
+        except:
+            logger.error(f"Failed to parse individual question response: {response_text}")
+            return None
+        
+        # Some responses wrap the single question in an array
+        if isinstance(question_data, list):
+            question_data = question_data[0] if question_data else None
+        if not isinstance(question_data, dict) or 'question' not in question_data or 'options' not in question_data:
+            return None
+        
+        # Get correct index
+        correct_idx = question_data.get('correctAnswer', 
+                     question_data.get('correct_option_index', 0))
+        
+        options = question_data['options'][:4]  # Ensure exactly 4 options
+        
+        # Avoid index errors
+        if not isinstance(correct_idx, int) or not 0 <= correct_idx < len(options):
+            correct_idx = 0
+            
+        correct_option = options[correct_idx]
+        
+        # Randomize the position of the correct answer
+        shuffled_options = options.copy()
+        random.shuffle(shuffled_options)
+        new_correct_idx = shuffled_options.index(correct_option)
+        
+        logger.info(f"Individual question: original correct idx={correct_idx}, new correct idx={new_correct_idx}")
+        
+        # Create standardized question
+        return {
+            'id': ''.join(random.choices(string.ascii_lowercase + string.digits, k=10)),
+            'question': question_data['question'],
+            'options': shuffled_options,
+            'correctAnswer': new_correct_idx,
+            'explanation': question_data.get('explanation', '')
+        }
+
+    def source_span(self, clean_text: str, question: Dict) -> Tuple[int, int, int]:
+        """
+        Find the chunk of the extracted text a stored question came from.
+        
+        Args:
+            clean_text: Extracted text of the upload
+            question: Question row with source_chunk/source_start/source_end (may be unset)
+            
+        Returns:
+            (chunk index, start, end) - questions without provenance get a random chunk
+        """
+        start, end = question.get('source_start'), question.get('source_end')
+        if start is not None and end is not None and 0 <= start < end <= len(clean_text):
+            return question.get('source_chunk') or 0, start, end
+        
+        chunk_spans = split_into_chunks(clean_text)
+        chunk_index = question.get('source_chunk')
+        if not isinstance(chunk_index, int) or not 0 <= chunk_index < len(chunk_spans):
+            chunk_index = random.randrange(len(chunk_spans))
+        return (chunk_index,) + chunk_spans[chunk_index]
+
+    def regenerate_question(self, clean_text: str, question: Dict, include_explanations: bool = True,
+                            exclude_questions: Optional[List[Dict]] = None, max_attempts: int = 3) -> Optional[Dict]:
+        """
+        Generate a replacement for one question from its source chunk only.
+        
+        Args:
+            clean_text: Extracted text of the upload
+            question: The question row being replaced
+            include_explanations: If False, the explanation is left empty for lazy generation
+            exclude_questions: Other questions of the quiz the replacement must not repeat
+            max_attempts: Small calls to make before giving up
+            
+        Returns:
+            The new question with its source fields set, or None if no usable question was generated
+        """
+        chunk_index, start, end = self.source_span(clean_text, question)
+        
+        if include_explanations:
+            explanation_rule = "The explanation must clearly justify why the correct answer is the only valid choice"
+            explanation_field = ',\n            "explanation": "הסבר קצר"'
+        else:
+            explanation_rule = "Do NOT write explanations - return only the question, the options and the correct option index"
+            explanation_field = ''
+        
+        # The replaced question must not come back, nor any other question of the quiz
+        excluded = [question] + list(exclude_questions or [])
+        existing_stems = "\n".join(f"- {q.get('question', '')}" for q in excluded[:200])
+        exclusion_section = f"""
+        DO NOT repeat, rephrase or closely paraphrase any of these existing questions:
+        {existing_stems}
+        """
+        dedup = NearDuplicateFilter()
+        dedup.filter(excluded)
+        
+        params = GenerationParams(temperature=round(random.uniform(0.9, 1.0), 2), top_p=1, top_k=32,
+                                  max_output_tokens=1024)
+        for attempt in range(1, max_attempts + 1):
+            try:
+                new_question = self._generate_single_question(
+                    clean_text[start:end], params, explanation_rule, explanation_field, exclusion_section
+                )
+            except (CircuitOpenError, RateLimitedError):
+                raise
+            except Exception as e:
+                # The backend already retried this call; only unusable or duplicate questions are re-requested
+                logger.error(f"Error regenerating question (attempt {attempt}/{max_attempts}): {e}")
+                return None
+            if new_question and dedup.add(new_question):
+                self._set_source(new_question, chunk_index, (start, end))
+                return new_question
+            logger.warning(f"Regenerated question unusable or duplicate (attempt {attempt}/{max_attempts})")
+        return None
+
+    def generate_explanations(self, questions: List[Dict], context: Optional[str] = None) -> Dict[str, str]:
+        """
+        Generate explanations for existing questions in a single batched call.
+        
+        Args:
+            questions: Question dicts with 'id', 'question', 'options' and the correct option index
+            context: Optional source text the questions were generated from
+            
+        Returns:
+            Mapping of question id to a Hebrew explanation (missing ids were not answered by the model)
+        """
+        if not questions:
+            return {}
+        
+        items = []
+        for q in questions:
+            options = q.get('options') or []
+            correct_idx = q.get('correctAnswer', q.get('correct_option_index', 0))
+            correct_option = options[correct_idx] if isinstance(correct_idx, int) and 0 <= correct_idx < len(options) else ''
+            items.append({
+                "id": str(q['id']),
+                "question": q.get('question', ''),
+                "options": options,
+                "correct_answer": correct_option
+            })
+        
+        context_section = f"\nBackground content the questions were written from:\n{context[:50000]}\n" if context else ""
+        prompt = f"""
+        For each multiple choice question below, write a short explanation in Hebrew (2-3 sentences)
+        of why the correct answer is right and why the other options are wrong.
+        Do not use phrases like 'according to the text'.
+        
+        Return ONLY a valid JSON array in this exact format, one entry per question:
+        [{{"id": "question id", "explanation": "הסבר קצר"}}]
+        
+        Questions:
+        {json.dumps(items, ensure_ascii=False)}
+        {context_section}
+        """
+        
+        # Roughly 200 output tokens per explanation is plenty
+        params = GenerationParams(temperature=0.3, top_p=1, top_k=32,
+                                  max_output_tokens=min(8192, 256 * len(items) + 256))
+        response = self.backend.generate(prompt, params, DEFAULT_SAFETY_SETTINGS)
+        
+        response_text = re.sub(r'^```json', '', response.text.strip())
+        response_text = re.sub(r'^```', '', response_text)
+        response_text = re.sub(r'```$', '', response_text).strip()
+        
+        try:
+            results = json.loads(response_text)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse explanations response: {e}")
+            return {}
+        
+        if isinstance(results, dict):
+            results = [results]
+        
+        known_ids = {item["id"] for item in items}
+        explanations = {}
+        for entry in results:
+            if isinstance(entry, dict) and str(entry.get('id')) in known_ids and entry.get('explanation'):
+                explanations[str(entry['id'])] = entry['explanation']
+        
+        logger.info(f"Generated {len(explanations)}/{len(items)} explanations")
+        return explanations
+
+# Pre-process a course pack: python question_generator.py <directory or .zip> (see bulk_ingest.py)
 if __name__ == "__main__":
-    generator = QuestionGenerator()
-    # Example would load a file and generate questions
-    print("Question generator ready - using specialized parsers and Gemini for PDF, DOCX, PPTX and TXT files") 
\ No newline at end of file
+    import bulk_ingest
+    bulk_ingest.main()
@@ -0,0 +1,273 @@
+import os
+import time
+import random
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from llm_backend import LLMBackendError
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Atomically refills every bucket from the Redis clock and takes the cost from
+# all of them, or none. Returns 0 on success, otherwise the milliseconds until
+# the scarcest bucket will hold enough tokens.
+# KEYS: one hash per bucket. ARGV: (rate_per_ms, capacity, cost) per bucket, then ttl_ms.
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local ttl = tonumber(ARGV[#KEYS * 3 + 1])
+local levels = {}
+local costs = {}
+local wait = 0
+for i = 1, #KEYS do
+  local rate = tonumber(ARGV[(i - 1) * 3 + 1])
+  local cap = tonumber(ARGV[(i - 1) * 3 + 2])
+  local cost = math.min(tonumber(ARGV[(i - 1) * 3 + 3]), cap)
+  local state = redis.call('HMGET', KEYS[i], 'level', 'ts')
+  local level = tonumber(state[1]) or cap
+  local ts = tonumber(state[2]) or now
+  level = math.min(cap, level + math.max(0, now - ts) * rate)
+  levels[i] = level
+  costs[i] = cost
+  if level < cost then
+    wait = math.max(wait, (cost - level) / rate)
+  end
+end
+for i = 1, #KEYS do
+  local level = levels[i]
+  if wait == 0 then level = level - costs[i] end
+  redis.call('HSET', KEYS[i], 'level', tostring(level), 'ts', tostring(now))
+  redis.call('PEXPIRE', KEYS[i], ttl)
+end
+return math.ceil(wait)
+"""
+
+
+class RateLimitedError(LLMBackendError):
+    """Raised when a caller waited the maximum time without getting API quota."""
+
+    code = "llm_rate_limited"
+    retryable = True
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate; Hebrew averages about 3 characters per Gemini token."""
+    return max(1, len(text) // 3)
+
+
+class Reservation:
+    """Quota taken by acquire(); settle() corrects it with the real token usage."""
+
+    def __init__(self, input_tokens: int, output_tokens: int, granted: bool = True):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.granted = granted
+
+
+class RateGovernor:
+    """
+    Cluster-wide token buckets for requests, input tokens and output tokens per
+    minute, shared by every worker and replica through Redis.
+
+    Buckets refill continuously at headroom * limit per minute, so throughput
+    settles just under the provider quota instead of bursting into it and
+    backing off. Callers that find a bucket empty sleep until it refills (up to
+    max_wait) rather than failing. If Redis is unreachable the governor fails
+    open and calls go straight to the API.
+    """
+
+    DIMENSIONS = ("requests", "input_tokens", "output_tokens")
+
+    def __init__(self, model_name: str, rpm: int, input_tpm: int, output_tpm: int,
+                 headroom: float = 0.9, burst_seconds: float = 5.0, max_wait: float = 30.0):
+        self.model_name = model_name
+        self.limits = {"requests": rpm, "input_tokens": input_tpm, "output_tokens": output_tpm}
+        self.headroom = headroom
+        self.burst_seconds = burst_seconds
+        self.max_wait = max_wait
+        self._script = None
+        self._unavailable_until = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, model_name: str) -> "RateGovernor":
+        return cls(
+            model_name,
+            rpm=int(os.getenv("GEMINI_RPM", "2000")),
+            input_tpm=int(os.getenv("GEMINI_INPUT_TPM", "4000000")),
+            output_tpm=int(os.getenv("GEMINI_OUTPUT_TPM", "0")),
+            headroom=float(os.getenv("GEMINI_RATE_HEADROOM", "0.9")),
+            burst_seconds=float(os.getenv("GEMINI_RATE_BURST_S", "5")),
+            max_wait=float(os.getenv("GEMINI_RATE_MAX_WAIT_S", "30")),
+        )
+
+    def _key(self, dimension: str) -> str:
+        return f"llm:rate:{self.model_name}:{dimension}"
+
+    def _usage_key(self, dimension: str, minute: int) -> str:
+        return f"llm:usage:{self.model_name}:{dimension}:{minute}"
+
+    def _waiting_key(self) -> str:
+        return f"llm:rate:{self.model_name}:waiting"
+
+    def _bucket(self, dimension: str):
+        """Return (rate per ms, capacity) for a dimension, or None when it is unlimited."""
+        limit = self.limits[dimension]
+        if not limit:
+            return None
+        per_minute = limit * self.headroom
+        rate_per_ms = per_minute / 60000.0
+        return rate_per_ms, max(1.0, per_minute / 60.0 * self.burst_seconds)
+
+    def _redis_available(self) -> bool:
+        return time.monotonic() >= self._unavailable_until
+
+    def _mark_unavailable(self, error: Exception):
+        with self._lock:
+            if self._redis_available():
+                logger.warning(f"Rate governor cannot reach Redis, failing open for 30s: {error}")
+            self._unavailable_until = time.monotonic() + 30
+
+    def _try_acquire(self, costs: Dict[str, int]) -> int:
+        """One atomic attempt; returns 0 when granted, else milliseconds to wait."""
+        keys: List[str] = []
+        args: List = []
+        for dimension in self.DIMENSIONS:
+            bucket = self._bucket(dimension)
+            if bucket is None:
+                continue
+            keys.append(self._key(dimension))
+            args.extend([bucket[0], bucket[1], costs[dimension]])
+        if not keys:
+            return 0
+        args.append(120000)
+        if self._script is None:
+            self._script = get_redis().register_script(_ACQUIRE_SCRIPT)
+        return int(self._script(keys=keys, args=args))
+
+    def _record_usage(self, costs: Dict[str, int]):
+        minute = int(time.time() // 60)
+        pipe = get_redis().pipeline(transaction=False)
+        for dimension, amount in costs.items():
+            if amount:
+                key = self._usage_key(dimension, minute)
+                pipe.incrby(key, amount)
+                pipe.expire(key, 180)
+        pipe.execute()
+
+    def acquire(self, input_tokens: int, output_tokens: int, block: bool = True,
+                max_wait: Optional[float] = None) -> Reservation:
+        """
+        Take quota for one API call, waiting in line for up to max_wait seconds.
+
+        With block=False a denied attempt returns a reservation with granted=False
+        instead of waiting. Raises RateLimitedError when the wait would exceed max_wait.
+        """
+        costs = {"requests": 1, "input_tokens": input_tokens, "output_tokens": output_tokens}
+        if not self._redis_available():
+            return Reservation(input_tokens, output_tokens)
+
+        max_wait = self.max_wait if max_wait is None else max_wait
+        give_up_at = time.monotonic() + max_wait
+        waiting = False
+        try:
+            while True:
+                wait_ms = self._try_acquire(costs)
+                if wait_ms == 0:
+                    self._record_usage(costs)
+                    return Reservation(input_tokens, output_tokens)
+                if not block:
+                    return Reservation(input_tokens, output_tokens, granted=False)
+
+                remaining = give_up_at - time.monotonic()
+                if wait_ms / 1000.0 > remaining:
+                    raise RateLimitedError(
+                        f"Gemini quota exhausted for the next {wait_ms / 1000.0:.1f}s",
+                        retry_after=wait_ms / 1000.0
+                    )
+                if not waiting:
+                    waiting = True
+                    get_redis().incr(self._waiting_key())
+                    logger.info(f"Waiting {wait_ms}ms for Gemini quota")
+                # Small jitter so waiting workers do not retry in lockstep
+                time.sleep(wait_ms / 1000.0 + random.uniform(0, 0.05))
+        except RateLimitedError:
+            raise
+        except Exception as e:
+            self._mark_unavailable(e)
+            return Reservation(input_tokens, output_tokens)
+        finally:
+            if waiting:
+                try:
+                    get_redis().decr(self._waiting_key())
+                except Exception:
+                    pass
+
+    def settle(self, reservation: Reservation, input_tokens: Optional[int] = None,
+               output_tokens: Optional[int] = None):
+        """Return over-reserved tokens (or charge the overrun) once real usage is known; None means unknown."""
+        if not reservation.granted or not self._redis_available():
+            return
+        corrections = {}
+        if input_tokens is not None:
+            corrections["input_tokens"] = reservation.input_tokens - input_tokens
+        if output_tokens is not None:
+            corrections["output_tokens"] = reservation.output_tokens - output_tokens
+        try:
+            minute = int(time.time() // 60)
+            pipe = get_redis().pipeline(transaction=False)
+            for dimension, delta in corrections.items():
+                if not delta:
+                    continue
+                if self._bucket(dimension) is not None:
+                    pipe.hincrbyfloat(self._key(dimension), "level", delta)
+                pipe.incrby(self._usage_key(dimension, minute), -delta)
+            pipe.execute()
+        except Exception as e:
+            self._mark_unavailable(e)
+
+    def snapshot(self) -> Dict:
+        """Current per-minute usage against the configured limits, for the admin status endpoint."""
+        now = time.time()
+        minute = int(now // 60)
+        # Sliding one-minute window: all of this minute plus the unexpired share of the last one
+        previous_weight = 1 - (now % 60) / 60.0
+        result = {"model": self.model_name, "headroom": self.headroom,
+                  "redis_available": self._redis_available(), "dimensions": {}}
+        try:
+            client = get_redis()
+            for dimension in self.DIMENSIONS:
+                used = int(client.get(self._usage_key(dimension, minute)) or 0)
+                previous = int(client.get(self._usage_key(dimension, minute - 1)) or 0)
+                limit = self.limits[dimension]
+                level = client.hget(self._key(dimension), "level")
+                result["dimensions"][dimension] = {
+                    "limit_per_minute": limit or None,
+                    "used_this_minute": used,
+                    "used_last_minute": previous,
+                    "utilization": round((used + previous * previous_weight) / limit, 3) if limit else None,
+                    "bucket_level": float(level) if level is not None else None,
+                }
+            result["waiting_callers"] = int(client.get(self._waiting_key()) or 0)
+        except Exception as e:
+            result["redis_available"] = False
+            result["error"] = str(e)
+        return result
+
+
+_governors: Dict[str, RateGovernor] = {}
+_governors_lock = threading.Lock()
+
+
+def get_rate_governor(model_name: str) -> RateGovernor:
+    """Return the process-wide governor for a model."""
+    with _governors_lock:
+        if model_name not in _governors:
+            _governors[model_name] = RateGovernor.from_env(model_name)
+        return _governors[model_name]
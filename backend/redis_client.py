@@ -0,0 +1,26 @@
+import os
+import logging
+import threading
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_redis() -> redis.Redis:
+    """Return the process-wide Redis client (same REDIS_URL as the rate limiter)."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.Redis.from_url(
+                    os.getenv("REDIS_URL", "redis://localhost:6379"),
+                    decode_responses=True,
+                    socket_connect_timeout=2,
+                    socket_timeout=5,
+                    health_check_interval=30,
+                )
+    return _client
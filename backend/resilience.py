@@ -0,0 +1,297 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Iterator, Optional
+
+from llm_backend import LLMBackend, LLMBackendError, LLMResponse, GenerationParams
+from pipeline import Deadline
+from serving import request_concurrency
+from rate_governor import RateGovernor, Reservation, get_rate_governor, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(LLMBackendError):
+    """Raised without calling the API while the circuit breaker is open."""
+
+    code = "llm_unavailable"
+    retryable = True
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(LLMBackendError):
+    """Raised when a call (including its hedge) does not finish before its deadline."""
+
+    code = "llm_timeout"
+    retryable = True
+
+
+BACKOFF_BASE_S = float(os.getenv("LLM_BACKOFF_BASE_S", "1"))
+BACKOFF_CAP_S = float(os.getenv("LLM_BACKOFF_CAP_S", "20"))
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE_S, cap: float = BACKOFF_CAP_S) -> float:
+    """Exponential backoff with full jitter for the given 1-based retry attempt."""
+    return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies used to pick the hedge delay."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Return the latency at the given percentile, or None until enough samples exist."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100.0 * len(ordered)))]
+
+
+class CircuitBreaker:
+    """
+    Fails fast after repeated errors.
+
+    Closed: calls pass through. After failure_threshold consecutive failures the
+    breaker opens and rejects calls for reset_timeout seconds. Then one trial call
+    is let through (half-open); its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if self.state == "open" and remaining <= 0:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            raise CircuitOpenError(
+                f"Circuit '{self.name}' is open - LLM API is degraded",
+                retry_after=max(1.0, remaining)
+            )
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.warning(f"Circuit '{self.name}' closed after successful trial call")
+            self.state = "closed"
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """End a half-open trial that never reached the API, without counting it either way."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.error(f"Circuit '{self.name}' opened after {self._failures} consecutive failures")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"name": self.name, "state": self.state, "consecutive_failures": self._failures}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Return the process-wide breaker for a backend name."""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+                reset_timeout=float(os.getenv("LLM_BREAKER_RESET_S", "30")),
+            )
+        return _breakers[name]
+
+
+class ResilientBackend(LLMBackend):
+    """
+    Wraps another backend with a per-call deadline, retries with exponential
+    backoff and jitter, hedged duplicate requests past the observed p95 latency,
+    and a circuit breaker shared by every caller in the process. Every API call,
+    hedges included, first takes quota from the cluster-wide rate governor.
+    """
+
+    # Shared by all wrappers; abandoned calls keep a thread until the SDK returns.
+    # Room for every request the worker serves plus a hedge each - under gevent these
+    # threads are greenlets, so WORKER_CONNECTIONS of them cost little.
+    _executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_CALL_THREADS", "0")) or 2 * request_concurrency(),
+                                   thread_name_prefix="llm-call")
+
+    def __init__(self, inner: LLMBackend, call_timeout: Optional[float] = None,
+                 max_attempts: Optional[int] = None, hedge_percentile: float = 95.0,
+                 breaker: Optional[CircuitBreaker] = None, governor: Optional[RateGovernor] = None):
+        self.inner = inner
+        self.name = inner.name
+        self.call_timeout = call_timeout if call_timeout is not None else float(os.getenv("LLM_CALL_TIMEOUT_S", "120"))
+        self.max_attempts = max_attempts if max_attempts is not None else int(os.getenv("LLM_CALL_ATTEMPTS", "2"))
+        self.hedge_percentile = hedge_percentile
+        self.hedging_enabled = os.getenv("LLM_HEDGING", "on").lower() != "off"
+        self.breaker = breaker or get_circuit_breaker(inner.name)
+        self.latency = LatencyTracker()
+        if governor is None and os.getenv("LLM_RATE_GOVERNOR", "on").lower() != "off":
+            governor = get_rate_governor(getattr(inner, 'model_name', inner.name))
+        self.governor = governor
+
+    def _submit(self, prompt: str, params: GenerationParams, safety_settings: Optional[List[Dict]],
+                reservation: Optional[Reservation]) -> Future:
+        """Start one call; its reservation is settled with that call's own usage whenever it ends, even if abandoned."""
+        future = self._executor.submit(self.inner.generate, prompt, params, safety_settings)
+        if reservation is not None:
+            future.add_done_callback(lambda f: self._settle(f, reservation))
+        return future
+
+    def _settle(self, future: Future, reservation: Reservation):
+        if future.cancelled() or future.exception() is not None:
+            # Failed or never-started calls produce no output; give the reserved output tokens back
+            self.governor.settle(reservation, output_tokens=0)
+            return
+        response = future.result()
+        self.governor.settle(
+            reservation,
+            input_tokens=response.input_tokens or None,
+            output_tokens=response.output_tokens or estimate_tokens(response.text)
+        )
+
+    def _call_once(self, prompt: str, params: GenerationParams, safety_settings: Optional[List[Dict]],
+                   timeout: float, reservation: Optional[Reservation] = None) -> LLMResponse:
+        start = time.monotonic()
+        deadline = start + timeout
+        futures = [self._submit(prompt, params, safety_settings, reservation)]
+
+        hedge_delay = self.latency.percentile(self.hedge_percentile) if self.hedging_enabled else None
+        last_error = None
+
+        while futures:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_for = remaining
+            if hedge_delay is not None and len(futures) == 1:
+                wait_for = min(remaining, max(0.0, start + hedge_delay - time.monotonic()))
+
+            done, _ = wait(futures, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            if not done:
+                if hedge_delay is not None and len(futures) == 1 and time.monotonic() - start >= hedge_delay:
+                    # Only hedge when quota is free right now - never queue a duplicate
+                    hedge_reservation = None
+                    if self.governor is not None:
+                        hedge_reservation = self.governor.acquire(
+                            estimate_tokens(prompt), params.max_output_tokens, block=False)
+                    if hedge_reservation is None or hedge_reservation.granted:
+                        logger.warning(f"LLM call exceeded p{self.hedge_percentile:.0f} ({hedge_delay:.1f}s), sending hedged request")
+                        futures.append(self._submit(prompt, params, safety_settings, hedge_reservation))
+                    hedge_delay = None
+                continue
+
+            for future in done:
+                futures.remove(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                for other in futures:
+                    other.cancel()
+                self.latency.record(time.monotonic() - start)
+                return response
+
+            # The only outstanding request failed; hedging it would not help
+            if not futures:
+                break
+
+        if last_error is not None and not futures:
+            raise last_error
+        for other in futures:
+            other.cancel()
+        raise DeadlineExceededError(f"LLM call did not finish within {timeout:.0f}s")
+
+    def generate(self, prompt: str, params: GenerationParams,
+                 safety_settings: Optional[List[Dict]] = None,
+                 deadline: Optional[Deadline] = None) -> LLMResponse:
+        last_error = None
+        for attempt in range(1, self.max_attempts + 1):
+            # Each attempt gets the call timeout or whatever is left of the deadline, if less
+            timeout = deadline.timeout(self.call_timeout) if deadline else self.call_timeout
+            if timeout <= 0:
+                raise last_error or DeadlineExceededError("No time left in the deadline for an LLM call")
+            self.breaker.before_call()
+            reservation = None
+            try:
+                if self.governor is not None:
+                    reservation = self.governor.acquire(estimate_tokens(prompt), params.max_output_tokens)
+            except Exception:
+                # No quota (RateLimitedError) is not an API failure, but a half-open trial must not stay taken
+                self.breaker.release_trial()
+                raise
+            try:
+                response = self._call_once(prompt, params, safety_settings, timeout, reservation)
+            except Exception as e:
+                self.breaker.record_failure()
+                last_error = e
+                logger.warning(f"LLM call attempt {attempt}/{self.max_attempts} failed: {e}")
+                if attempt < self.max_attempts:
+                    delay = backoff_delay(attempt)
+                    if deadline and delay >= deadline.remaining():
+                        break  # Retrying would only outlive the deadline
+                    time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return response
+        raise last_error
+
+    def generate_stream(self, prompt: str, params: GenerationParams,
+                        safety_settings: Optional[List[Dict]] = None) -> Iterator[str]:
+        self.breaker.before_call()
+        try:
+            for piece in self.inner.generate_stream(prompt, params, safety_settings):
+                yield piece
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+
+    def count_tokens(self, text: str) -> int:
+        return self.inner.count_tokens(text)
+
+    def warm_up(self):
+        self.inner.warm_up()
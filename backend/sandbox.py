@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import pickle
+import signal
+import logging
+import resource
+import threading
+import subprocess
+from typing import List, Optional
+
+import extractors
+from pipeline import Deadline
+from serving import run_in_event_loop
+
+logger = logging.getLogger(__name__)
+
+# Document parsing runs in a child process per file, so a pathological PDF or a
+# zip-bomb PPTX costs that child its limits instead of taking the worker down.
+# Each child is `python sandbox.py`: it imports the parsers, waits for one file
+# on stdin, answers on stdout and exits. A few are kept started ahead of time so
+# an upload does not wait for an interpreter to boot.
+EXTRACTION_SANDBOX = os.getenv("EXTRACTION_SANDBOX", "on").lower() not in ("0", "off", "false", "no")
+# Address-space limit per child (virtual memory, including the interpreter and parsers)
+EXTRACTION_MEMORY_MB = int(os.getenv("EXTRACTION_MEMORY_MB", "1024"))
+# CPU seconds per child; OCR runs in grandchild processes that each get their own
+EXTRACTION_CPU_S = int(os.getenv("EXTRACTION_CPU_S", "60"))
+# Wall-clock limit, further capped by the caller's deadline
+EXTRACTION_TIMEOUT_S = int(os.getenv("EXTRACTION_TIMEOUT_S", "120"))
+# Children running at once, per process
+EXTRACTION_MAX_PARALLEL = int(os.getenv("EXTRACTION_MAX_PARALLEL") or os.cpu_count() or 1)
+# Idle children kept booted, per process
+EXTRACTION_SPARE_WORKERS = int(os.getenv("EXTRACTION_SPARE_WORKERS", "2"))
+# Time a child gets past its deadline to hand back the text it has before it is killed
+KILL_GRACE_S = 5
+
+_slots = threading.BoundedSemaphore(max(1, EXTRACTION_MAX_PARALLEL))
+_spares: List[subprocess.Popen] = []
+_spares_lock = threading.Lock()
+
+
+class ExtractionError(ValueError):
+    """Extraction failed in the sandbox; code classifies why and is stored on the upload."""
+
+    code = "extraction_failed"
+    retryable = False
+
+
+class ExtractionTimeoutError(ExtractionError):
+    """The file took longer than its wall-clock or CPU limit to parse."""
+
+    code = "extraction_timeout"
+
+
+class ExtractionMemoryError(ExtractionError):
+    """Parsing the file needed more memory than EXTRACTION_MEMORY_MB."""
+
+    code = "extraction_oom"
+
+
+class CorruptFileError(ExtractionError):
+    """The parser rejected the file."""
+
+    code = "corrupt_file"
+
+
+def _start_worker() -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+
+def _take_worker() -> subprocess.Popen:
+    """An idle booted child if there is one, otherwise a new one; the spares are topped up."""
+    with _spares_lock:
+        worker = None
+        while _spares and worker is None:
+            candidate = _spares.pop()
+            if candidate.poll() is None:
+                worker = candidate
+        while len(_spares) < EXTRACTION_SPARE_WORKERS:
+            _spares.append(_start_worker())
+    return worker or _start_worker()
+
+
+def warm_up() -> List[str]:
+    """
+    Boot the spare children, which import the parsers, now rather than on the
+    first upload (or import the parsers here when the sandbox is off).
+    Returns the parser modules.
+    """
+    if not EXTRACTION_SANDBOX:
+        return extractors.warm_up()
+    with _spares_lock:
+        while len(_spares) < EXTRACTION_SPARE_WORKERS:
+            _spares.append(_start_worker())
+    return extractors.parser_modules()
+
+
+def extract_text(file_content: bytes, mime_type: str, deadline: Optional[Deadline] = None) -> str:
+    """
+    extractors.extract_text() in a child process with memory, CPU and wall-clock limits.
+
+    The child gets the deadline too, so a slow file returns the pages read
+    so far; it is only killed KILL_GRACE_S after that. Raises an
+    ExtractionError subclass when the child fails or is killed.
+    """
+    if not EXTRACTION_SANDBOX:
+        return extractors.extract_text(file_content, mime_type, deadline)
+    # Child processes are managed from the event loop under gevent (see serving.py)
+    return run_in_event_loop(_extract_in_worker, file_content, mime_type, deadline)
+
+
+def _extract_in_worker(file_content: bytes, mime_type: str, deadline: Optional[Deadline]) -> str:
+    budget = EXTRACTION_TIMEOUT_S if deadline is None else min(EXTRACTION_TIMEOUT_S, deadline.remaining())
+    # time.monotonic() is system-wide, so the deadline means the same thing in the child
+    child_deadline = Deadline(budget)
+    if not _slots.acquire(timeout=budget):
+        raise ExtractionTimeoutError("No extraction slot became free before the deadline")
+    try:
+        worker = _take_worker()
+        job = pickle.dumps((file_content, mime_type, child_deadline, EXTRACTION_MEMORY_MB, EXTRACTION_CPU_S))
+        timed_out = False
+        try:
+            output, _ = worker.communicate(job, timeout=child_deadline.remaining() + KILL_GRACE_S)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            worker.kill()
+            output, _ = worker.communicate()
+    finally:
+        _slots.release()
+
+    if output:
+        # The child parsed untrusted input, so its answer is plain data - never unpickled
+        try:
+            status, value = json.loads(output)
+        except (ValueError, TypeError):
+            raise ExtractionError("Extraction returned an unreadable result")
+        if status == "ok" and isinstance(value, str):
+            return value
+        if status == "oom":
+            raise ExtractionMemoryError(f"Extraction exceeded {EXTRACTION_MEMORY_MB} MB")
+        raise CorruptFileError(f"Failed to extract text: {value}")
+
+    returncode = worker.returncode
+    logger.warning(f"Extraction of a {mime_type} file ({len(file_content)} bytes) ended with exit code {returncode}")
+    if timed_out:
+        raise ExtractionTimeoutError(f"Extraction took longer than {budget:.0f}s")
+    if returncode == -signal.SIGXCPU:
+        raise ExtractionTimeoutError(f"Extraction exceeded {EXTRACTION_CPU_S} CPU seconds")
+    if returncode == -signal.SIGKILL:
+        # Not sent by us: the kernel's OOM killer
+        raise ExtractionMemoryError("Extraction was killed, most likely out of memory")
+    raise ExtractionError(f"Extraction crashed with exit code {returncode}")
+
+
+def _serve_one():
+    """Child side: read one job from stdin, extract it under the limits and write the outcome to stdout."""
+    # Keep stdout for the result; anything a library prints goes to stderr
+    result = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    try:
+        file_content, mime_type, deadline, memory_mb, cpu_s = pickle.load(sys.stdin.buffer)
+    except EOFError:
+        return  # The parent exited while this child was a spare
+
+    memory = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    # SIGXCPU at the soft limit, SIGKILL at the hard one
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_s, cpu_s + 5))
+    try:
+        outcome = ("ok", extractors.extract_text(file_content, mime_type, deadline))
+    except MemoryError:
+        outcome = ("oom", "ran out of memory")
+    except Exception as e:
+        outcome = ("error", f"{type(e).__name__}: {e}")
+    result.write(json.dumps(outcome).encode("utf-8"))
+    result.close()
+    # Leave without waiting for threads a deadline left running (OCR pages)
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C in a dev server is for the parent
+    extractors.warm_up()
+    _serve_one()
@@ -0,0 +1,371 @@
+import os
+import time
+import uuid
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+from llm_backend import LLMBackendError
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Queues a ticket with start-time fair queueing: each user has a virtual clock
+# that advances by 1/weight per job, and never lags behind the global clock.
+# A user who submits many jobs at once therefore waits behind other users'
+# single jobs instead of in front of them.
+# KEYS: waiting, user_vt, global_vt, ticket hash. ARGV: ticket, user, lane, weight, ticket_ttl_s
+_ENQUEUE_SCRIPT = """
+local global_vt = tonumber(redis.call('GET', KEYS[3]) or '0')
+local user_vt = tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or '0')
+local score = math.max(global_vt, user_vt) + 1 / tonumber(ARGV[4])
+redis.call('HSET', KEYS[2], ARGV[2], tostring(score))
+redis.call('ZADD', KEYS[1], score, ARGV[1])
+redis.call('HSET', KEYS[4], 'user', ARGV[2], 'lane', ARGV[3])
+redis.call('EXPIRE', KEYS[4], tonumber(ARGV[5]))
+return redis.call('ZRANK', KEYS[1], ARGV[1])
+"""
+
+# Grants a slot to the ticket if it is the first eligible waiting ticket.
+# Eligible: its user is under the per-user cap, and free-lane tickets may not
+# use the slots reserved for premium users. Expired leases (crashed workers)
+# and abandoned tickets (callers that stopped polling) are cleaned up first.
+# Returns 1 when granted, otherwise -(1 + number of eligible tickets ahead).
+# KEYS: waiting, running, user_running, lane_running, global_vt, ticket prefix
+# ARGV: ticket, capacity, user_cap, premium_reserved, lease_ms, ticket_ttl_s
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local prefix = KEYS[6]
+
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+for _, ticket in ipairs(expired) do
+  local info = redis.call('HMGET', prefix .. ticket, 'user', 'lane')
+  redis.call('ZREM', KEYS[2], ticket)
+  if info[1] then
+    redis.call('HINCRBY', KEYS[3], info[1], -1)
+    redis.call('HINCRBY', KEYS[4], info[2], -1)
+  end
+  redis.call('DEL', prefix .. ticket)
+end
+
+redis.call('EXPIRE', prefix .. ARGV[1], tonumber(ARGV[6]))
+local capacity = tonumber(ARGV[2])
+local full = redis.call('ZCARD', KEYS[2]) >= capacity
+local free_running = tonumber(redis.call('HGET', KEYS[4], 'free') or '0')
+local free_capacity = capacity - tonumber(ARGV[4])
+local ahead = 0
+
+for _, ticket in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+  local info = redis.call('HMGET', prefix .. ticket, 'user', 'lane')
+  if not info[1] then
+    redis.call('ZREM', KEYS[1], ticket)
+  else
+    local user_running = tonumber(redis.call('HGET', KEYS[3], info[1]) or '0')
+    local eligible = user_running < tonumber(ARGV[3]) and (info[2] == 'premium' or free_running < free_capacity)
+    if ticket == ARGV[1] then
+      if eligible and ahead == 0 and not full then
+        local score = redis.call('ZSCORE', KEYS[1], ticket)
+        redis.call('ZREM', KEYS[1], ticket)
+        redis.call('ZADD', KEYS[2], now + tonumber(ARGV[5]), ticket)
+        redis.call('HINCRBY', KEYS[3], info[1], 1)
+        redis.call('HINCRBY', KEYS[4], info[2], 1)
+        redis.call('EXPIRE', prefix .. ticket, math.ceil(tonumber(ARGV[5]) / 1000) + 60)
+        redis.call('SET', KEYS[5], score)
+        return 1
+      end
+      return -(1 + ahead)
+    end
+    if eligible then
+      ahead = ahead + 1
+    end
+  end
+end
+return -(1 + ahead)
+"""
+
+# KEYS: waiting, running, user_running, lane_running, ticket hash. ARGV: ticket
+_RELEASE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 1 then
+  local info = redis.call('HMGET', KEYS[5], 'user', 'lane')
+  if info[1] then
+    redis.call('HINCRBY', KEYS[3], info[1], -1)
+    redis.call('HINCRBY', KEYS[4], info[2], -1)
+  end
+end
+redis.call('DEL', KEYS[5])
+return 1
+"""
+
+
+class Admission:
+    """Result of an admission check: whether to accept new work, and when to come back if not."""
+
+    def __init__(self, admitted: bool, retry_after: int = 0, running: int = 0, waiting: int = 0):
+        self.admitted = admitted
+        self.retry_after = retry_after
+        self.running = running
+        self.waiting = waiting
+
+
+class SchedulerBusyError(LLMBackendError):
+    """Raised when a generation job waited the maximum time without getting a slot."""
+
+    code = "queue_timeout"
+    retryable = True
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GenerationScheduler:
+    """
+    Cluster-wide admission of question generation jobs, shared by every worker
+    and replica through Redis.
+
+    At most capacity jobs generate at once. Waiting jobs are ordered with
+    weighted fair queueing across users, with premium subscribers weighted
+    premium_weight times higher. premium_reserved slots are only ever given to
+    premium jobs (the priority lane), and no user runs more than user_cap jobs
+    at once. Queue wait times are recorded per lane for the admin status
+    endpoint. If Redis is unreachable the scheduler fails open.
+    """
+
+    LANES = ("premium", "free")
+    _PREFIX = "sched:generation"
+
+    def __init__(self, capacity: int = 8, user_cap: int = 2, premium_reserved: int = 2,
+                 premium_weight: float = 4.0, lease_seconds: float = 600.0, max_wait: float = 240.0,
+                 poll_interval: float = 0.25, max_queue: int = 16, throughput_window: float = 300.0):
+        self.capacity = capacity
+        self.user_cap = user_cap
+        self.premium_reserved = min(premium_reserved, max(0, capacity - 1))
+        self.weights = {"premium": premium_weight, "free": 1.0}
+        self.lease_seconds = lease_seconds
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.ticket_ttl = 30
+        self.max_queue = max_queue
+        self.throughput_window = throughput_window
+        self._scripts = {}
+        self._unavailable_until = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "GenerationScheduler":
+        return cls(
+            capacity=int(os.getenv("GENERATION_SLOTS", "8")),
+            user_cap=int(os.getenv("GENERATION_USER_CAP", "2")),
+            premium_reserved=int(os.getenv("GENERATION_PREMIUM_RESERVED", "2")),
+            premium_weight=float(os.getenv("GENERATION_PREMIUM_WEIGHT", "4")),
+            lease_seconds=float(os.getenv("GENERATION_LEASE_S", "600")),
+            max_wait=float(os.getenv("GENERATION_QUEUE_MAX_WAIT_S", "240")),
+            max_queue=int(os.getenv("GENERATION_MAX_QUEUE", "16")),
+        )
+
+    def _key(self, name: str) -> str:
+        return f"{self._PREFIX}:{name}"
+
+    def _ticket_key(self, ticket: str) -> str:
+        return f"{self._PREFIX}:ticket:{ticket}"
+
+    def _script(self, name: str, source: str):
+        if name not in self._scripts:
+            self._scripts[name] = get_redis().register_script(source)
+        return self._scripts[name]
+
+    def _redis_available(self) -> bool:
+        return time.monotonic() >= self._unavailable_until
+
+    def _mark_unavailable(self, error: Exception):
+        with self._lock:
+            if self._redis_available():
+                logger.warning(f"Generation scheduler cannot reach Redis, failing open for 30s: {error}")
+            self._unavailable_until = time.monotonic() + 30
+
+    def _enqueue(self, ticket: str, user_id: str, lane: str) -> int:
+        return int(self._script("enqueue", _ENQUEUE_SCRIPT)(
+            keys=[self._key("waiting"), self._key("user_vt"), self._key("vt"), self._ticket_key(ticket)],
+            args=[ticket, user_id, lane, self.weights[lane], self.ticket_ttl]
+        ))
+
+    def _try_acquire(self, ticket: str) -> int:
+        return int(self._script("acquire", _ACQUIRE_SCRIPT)(
+            keys=[self._key("waiting"), self._key("running"), self._key("user_running"),
+                  self._key("lane_running"), self._key("vt"), f"{self._PREFIX}:ticket:"],
+            args=[ticket, self.capacity, self.user_cap, self.premium_reserved,
+                  int(self.lease_seconds * 1000), self.ticket_ttl]
+        ))
+
+    def _release(self, ticket: str):
+        self._script("release", _RELEASE_SCRIPT)(
+            keys=[self._key("waiting"), self._key("running"), self._key("user_running"),
+                  self._key("lane_running"), self._ticket_key(ticket)],
+            args=[ticket]
+        )
+
+    def _record_wait(self, lane: str, seconds: float):
+        key = self._key(f"waits:{lane}")
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.lpush(key, round(seconds, 3))
+        pipe.ltrim(key, 0, 499)
+        pipe.execute()
+
+    def _record_completion(self, seconds: float):
+        # Completion timestamps (member carries the duration) give the recent throughput
+        now = time.time()
+        key = self._key("completions")
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.zadd(key, {f"{uuid.uuid4().hex}:{round(seconds, 3)}": now})
+        pipe.zremrangebyscore(key, "-inf", now - self.throughput_window)
+        pipe.execute()
+
+    def throughput(self) -> float:
+        """Generation jobs completed per second over the last throughput_window seconds."""
+        client = get_redis()
+        now = time.time()
+        completed = client.zcount(self._key("completions"), now - self.throughput_window, "+inf")
+        if completed:
+            return completed / self.throughput_window
+        # Nothing finished recently (idle or just started): assume every slot takes a minute
+        return self.capacity / 60.0
+
+    def admit(self, premium: bool = False) -> Admission:
+        """
+        Decide whether to accept a new generation job before any work is done for it.
+
+        Free jobs are shed once max_queue jobs are waiting, premium jobs only
+        at twice that depth. Rejected callers get a Retry-After estimate: the
+        time the current queue takes to drain at the recent throughput.
+        """
+        if not self._redis_available():
+            return Admission(True)
+        try:
+            client = get_redis()
+            running = client.zcard(self._key("running"))
+            waiting = client.zcard(self._key("waiting"))
+            limit = self.max_queue * 2 if premium else self.max_queue
+            if waiting < limit:
+                return Admission(True, running=running, waiting=waiting)
+            drain_seconds = (waiting - limit + 1 + self.capacity) / self.throughput()
+            retry_after = int(min(300, max(5, drain_seconds)))
+            logger.warning(f"Shedding {'premium' if premium else 'free'} generation job: "
+                           f"{running} running, {waiting} waiting, retry after {retry_after}s")
+            return Admission(False, retry_after=retry_after, running=running, waiting=waiting)
+        except Exception as e:
+            self._mark_unavailable(e)
+            return Admission(True)
+
+    @contextmanager
+    def slot(self, user_id: str, premium: bool = False,
+             on_queued: Optional[Callable[[int], None]] = None,
+             max_wait: Optional[float] = None) -> Iterator[float]:
+        """
+        Hold one generation slot for the duration of the block; yields the seconds spent queued.
+
+        on_queued is called with the number of jobs ahead when the job has to wait.
+        Raises SchedulerBusyError after max_wait seconds (the scheduler's by default) without a slot.
+        """
+        max_wait = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+        lane = "premium" if premium else "free"
+        ticket = uuid.uuid4().hex
+        start = time.monotonic()
+        held = False
+
+        if self._redis_available():
+            try:
+                self._enqueue(ticket, user_id, lane)
+                notified = False
+                while True:
+                    result = self._try_acquire(ticket)
+                    if result == 1:
+                        held = True
+                        break
+                    if time.monotonic() - start >= max_wait:
+                        raise SchedulerBusyError(
+                            f"No generation slot became free within {max_wait:.0f}s",
+                            retry_after=30
+                        )
+                    if not notified:
+                        notified = True
+                        logger.info(f"Generation job of user {user_id} ({lane}) queued behind {-result - 1} jobs")
+                        if on_queued:
+                            on_queued(-result - 1)
+                    # Jitter so queued workers do not poll Redis in lockstep
+                    time.sleep(self.poll_interval + random.uniform(0, self.poll_interval))
+            except SchedulerBusyError:
+                self._safe_release(ticket)
+                raise
+            except Exception as e:
+                self._mark_unavailable(e)
+                self._safe_release(ticket)
+
+        waited = time.monotonic() - start
+        if held:
+            try:
+                self._record_wait(lane, waited)
+            except Exception as e:
+                logger.warning(f"Could not record queue wait: {e}")
+        started = time.monotonic()
+        try:
+            yield waited
+        finally:
+            if held:
+                self._safe_release(ticket)
+                try:
+                    self._record_completion(time.monotonic() - started)
+                except Exception as e:
+                    logger.warning(f"Could not record generation completion: {e}")
+
+    def _safe_release(self, ticket: str):
+        try:
+            self._release(ticket)
+        except Exception as e:
+            logger.error(f"Could not release generation slot {ticket}: {e}")
+
+    def snapshot(self) -> Dict:
+        """Queue lengths, running jobs and queue wait percentiles per lane, for the admin status endpoint."""
+        result = {"capacity": self.capacity, "user_cap": self.user_cap,
+                  "premium_reserved": self.premium_reserved, "weights": self.weights,
+                  "max_queue": self.max_queue,
+                  "redis_available": self._redis_available(), "lanes": {}}
+        try:
+            client = get_redis()
+            result["throughput_per_min"] = round(self.throughput() * 60, 2)
+            lane_running = client.hgetall(self._key("lane_running"))
+            waiting_lanes = {lane: 0 for lane in self.LANES}
+            for ticket in client.zrange(self._key("waiting"), 0, -1):
+                lane = client.hget(self._ticket_key(ticket), "lane")
+                if lane in waiting_lanes:
+                    waiting_lanes[lane] += 1
+            for lane in self.LANES:
+                waits = sorted(float(w) for w in client.lrange(self._key(f"waits:{lane}"), 0, -1))
+                result["lanes"][lane] = {
+                    "running": int(lane_running.get(lane, 0)),
+                    "waiting": waiting_lanes[lane],
+                    "wait_samples": len(waits),
+                    "wait_p50_s": waits[len(waits) // 2] if waits else None,
+                    "wait_p95_s": waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else None,
+                    "wait_max_s": waits[-1] if waits else None,
+                }
+        except Exception as e:
+            result["redis_available"] = False
+            result["error"] = str(e)
+        return result
+
+
+_scheduler: Optional[GenerationScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> GenerationScheduler:
+    """Return the process-wide generation scheduler."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = GenerationScheduler.from_env()
+        return _scheduler
@@ -0,0 +1,102 @@
+import os
+import logging
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+# 'threads': gunicorn gthread workers, one OS thread per in-flight request ('sync' is
+# accepted as an older name for it - gunicorn's own sync worker is never used).
+# 'gevent': gunicorn gevent workers - the standard library is monkey-patched, so the
+# existing blocking calls to Supabase, Storage, Redis and Gemini yield to other
+# requests while they wait, and one worker holds hundreds of requests.
+SERVING_MODE = os.getenv("SERVING_MODE", "threads").lower()
+if SERVING_MODE == "sync":
+    SERVING_MODE = "threads"
+
+
+def request_concurrency() -> int:
+    """Requests one worker process serves at once in the configured mode (see gunicorn.conf.py)."""
+    if SERVING_MODE == "gevent":
+        return int(os.getenv("WORKER_CONNECTIONS", "500"))
+    return int(os.getenv("GUNICORN_THREADS", "8"))
+
+
+def gevent_active() -> bool:
+    """Whether this process runs under gevent's monkey-patching."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def _init_grpc():
+    # gRPC runs its own I/O threads; without this, Gemini calls over the grpc
+    # transport would block the whole gevent hub. Must run before any channel exists.
+    try:
+        from grpc.experimental import gevent as grpc_gevent
+    except ImportError:
+        return
+    grpc_gevent.init_gevent()
+    logger.info("gRPC configured for gevent")
+
+
+def run_blocking(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Run CPU-bound work (document parsing) without stalling other requests.
+
+    Under gevent a long parse would hold the event loop, so it runs on the
+    hub's pool of real OS threads instead; otherwise it is called directly.
+    """
+    if not gevent_active():
+        return fn(*args, **kwargs)
+    import gevent
+    return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+
+
+def run_in_event_loop(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    The reverse of run_blocking: call fn as a greenlet on the main event loop
+    and wait for it, from one of the hub's OS threads.
+
+    gevent's subprocess module only works on the main loop, so code running
+    under run_blocking that starts child processes (OCR) goes through here.
+    Otherwise fn is called directly.
+    """
+    if _main_hub is None:
+        return fn(*args, **kwargs)
+    from gevent import monkey
+    if monkey.get_original("_thread", "get_ident")() == _main_thread_id:
+        return fn(*args, **kwargs)
+
+    import gevent
+    # A real lock: blocks this OS thread, not a greenlet
+    done = monkey.get_original("_thread", "allocate_lock")()
+    done.acquire()
+    outcome = {}
+
+    def call():
+        try:
+            outcome["value"] = fn(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            done.release()
+
+    _main_hub.loop.run_callback_threadsafe(gevent.spawn, call)
+    done.acquire()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["value"]
+
+
+_main_hub = None
+_main_thread_id = None
+
+# Imported by app.py before the LLM backend, so gRPC is set up before its first channel
+if gevent_active():
+    _init_grpc()
+    import gevent
+    from gevent import monkey
+    _main_hub = gevent.get_hub()
+    _main_thread_id = monkey.get_original("_thread", "get_ident")()
@@ -15,10 +15,34 @@ CREATE TABLE IF NOT EXISTS public.uploads (
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL
 );
 
+-- Machine-readable failure code; 'llm_unavailable' and 'llm_timeout' are safe to retry
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS error_code TEXT;
+-- Storage path of the cleaned extracted text, reused to generate more questions without re-parsing
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS extracted_text_path TEXT;
+-- SHA-256 of the stored extracted text and the extractor version that produced it
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS extracted_text_hash TEXT;
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS extractor_version TEXT;
+-- SHA-256 of the uploaded file; references public.file_blobs (NULL for uploads stored before deduplication)
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS content_sha256 TEXT;
+-- Start offset and duration (ms) of each processing pipeline stage, for latency analysis
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS stage_timings JSONB;
+-- Liveness of a processing job: refreshed by the worker; a stale heartbeat lets another worker resume it
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS worker_id TEXT;
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS resume_attempts INTEGER DEFAULT 0;
+-- Generation parameters and questions accepted so far, cleared when the job completes
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS checkpoint JSONB;
+-- Uploads of several files: each file's name, MIME type and blob, and the blob hashes for the garbage collector
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS source_files JSONB;
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS source_sha256s TEXT[];
+
 -- Indexes for uploads table
 CREATE INDEX IF NOT EXISTS idx_uploads_user_id ON public.uploads(user_id);
+CREATE INDEX IF NOT EXISTS idx_uploads_content_sha256 ON public.uploads(content_sha256);
 CREATE INDEX IF NOT EXISTS idx_uploads_status ON public.uploads(status);
 CREATE INDEX IF NOT EXISTS idx_uploads_created_at ON public.uploads(created_at);
+CREATE INDEX IF NOT EXISTS idx_uploads_source_sha256s ON public.uploads USING GIN(source_sha256s);
+CREATE INDEX IF NOT EXISTS idx_uploads_processing_heartbeat ON public.uploads(heartbeat_at) WHERE status = 'processing';
 
 -- RLS policies for uploads table
 ALTER TABLE public.uploads ENABLE ROW LEVEL SECURITY;
@@ -49,6 +73,76 @@ CREATE POLICY "Service role has full access to uploads"
     USING (auth.role() = 'service_role');
 
 
+-- 1b. File Blobs Table
+-- One row per distinct file content, stored once at blobs/{sha[:2]}/{sha} in the uploads bucket.
+-- Uploads reference a blob through uploads.content_sha256; blobs no upload references are
+-- removed by the /admin/storage/gc endpoint.
+CREATE TABLE IF NOT EXISTS public.file_blobs (
+    sha256 TEXT PRIMARY KEY,
+    storage_path TEXT NOT NULL,
+    size_bytes BIGINT NOT NULL,
+    mime_type TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
+    last_referenced_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_file_blobs_last_referenced_at ON public.file_blobs(last_referenced_at);
+
+-- Blobs are shared between users, so only the service role can see or change them
+ALTER TABLE public.file_blobs ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Service role has full access to file blobs" ON public.file_blobs;
+CREATE POLICY "Service role has full access to file blobs"
+    ON public.file_blobs FOR ALL
+    USING (auth.role() = 'service_role');
+
+-- Blobs older than the cutoff that no upload references, neither as its file (content_sha256)
+-- nor as one of several files (source_sha256s), in sha256 order after the given cursor.
+-- Used by /admin/storage/gc, which pages through with the last sha256 returned.
+CREATE OR REPLACE FUNCTION public.unreferenced_file_blobs(
+    cutoff TIMESTAMP WITH TIME ZONE,
+    after_sha256 TEXT DEFAULT '',
+    batch_size INTEGER DEFAULT 500
+)
+RETURNS TABLE (sha256 TEXT, storage_path TEXT, size_bytes BIGINT)
+LANGUAGE sql STABLE
+AS $$
+    SELECT b.sha256, b.storage_path, b.size_bytes
+    FROM public.file_blobs b
+    WHERE b.last_referenced_at < cutoff
+      AND b.sha256 > after_sha256
+      AND NOT EXISTS (SELECT 1 FROM public.uploads u WHERE u.content_sha256 = b.sha256)
+      AND NOT EXISTS (SELECT 1 FROM public.uploads u WHERE u.source_sha256s @> ARRAY[b.sha256])
+    ORDER BY b.sha256
+    LIMIT batch_size;
+$$;
+
+REVOKE EXECUTE ON FUNCTION public.unreferenced_file_blobs(TIMESTAMP WITH TIME ZONE, TEXT, INTEGER) FROM PUBLIC, anon, authenticated;
+
+-- 1c. Content Cache Table
+-- Extracted text and generated questions of known documents (course packs), keyed by file SHA-256.
+-- Filled by bulk ingestion (bulk_ingest.py, /admin/ingest); uploads of the same file reuse them.
+-- The text is stored at cache/{sha[:2]}/{sha}.txt.zst in the uploads bucket.
+CREATE TABLE IF NOT EXISTS public.content_cache (
+    content_sha256 TEXT PRIMARY KEY,
+    extractor_version TEXT NOT NULL,
+    text_path TEXT NOT NULL,
+    text_hash TEXT,
+    text_chars INTEGER,
+    questions JSONB,
+    num_questions INTEGER,
+    include_explanations BOOLEAN,
+    source TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL
+);
+
+ALTER TABLE public.content_cache ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Service role has full access to the content cache" ON public.content_cache;
+CREATE POLICY "Service role has full access to the content cache"
+    ON public.content_cache FOR ALL
+    USING (auth.role() = 'service_role');
+
 -- 2. Questions Table
 -- Stores the AI-generated questions for each upload.
 CREATE TABLE IF NOT EXISTS public.questions (
@@ -61,6 +155,11 @@ CREATE TABLE IF NOT EXISTS public.questions (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL
 );
 
+-- Chunk of the extracted text a question was generated from (character offsets), for single-question regeneration
+ALTER TABLE public.questions ADD COLUMN IF NOT EXISTS source_chunk INTEGER;
+ALTER TABLE public.questions ADD COLUMN IF NOT EXISTS source_start INTEGER;
+ALTER TABLE public.questions ADD COLUMN IF NOT EXISTS source_end INTEGER;
+
 -- Indexes for questions table
 CREATE INDEX IF NOT EXISTS idx_questions_job_id ON public.questions(job_id);
 
@@ -93,6 +192,44 @@ CREATE POLICY "Only service role can delete questions"
     ON public.questions FOR DELETE
     USING (auth.role() = 'service_role');
 
+-- Stores a processing job's questions and marks it completed in one transaction, but only
+-- while owner_worker_id still owns the job (the reaper rewrites worker_id on takeover).
+-- Returns the number of questions stored, or NULL if another worker has taken the job over.
+CREATE OR REPLACE FUNCTION public.complete_upload_job(
+    target_job_id TEXT,
+    owner_worker_id TEXT,
+    question_rows JSONB DEFAULT '[]'::jsonb
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    stored INTEGER;
+BEGIN
+    UPDATE public.uploads
+    SET status = 'completed'
+    WHERE id = target_job_id
+      AND status = 'processing'
+      AND worker_id = owner_worker_id;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO public.questions (job_id, question, options, correct_option_index, explanation,
+                                  source_chunk, source_start, source_end)
+    SELECT target_job_id, q.question, q.options, q.correct_option_index, q.explanation,
+           q.source_chunk, q.source_start, q.source_end
+    FROM jsonb_to_recordset(question_rows) AS q(
+        question TEXT, options JSONB, correct_option_index INTEGER, explanation TEXT,
+        source_chunk INTEGER, source_start INTEGER, source_end INTEGER
+    );
+    GET DIAGNOSTICS stored = ROW_COUNT;
+    RETURN stored;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION public.complete_upload_job(TEXT, TEXT, JSONB) FROM PUBLIC, anon, authenticated;
+
 
 -- 3. Quiz Attempts Table
 -- Stores user attempts for quizzes.
@@ -0,0 +1,56 @@
+import unittest
+
+from llm_backend import GenerationParams, LLMResponse
+from rate_governor import RateLimitedError
+from resilience import CircuitBreaker, CircuitOpenError, ResilientBackend
+
+
+class _Backend:
+    name = "test"
+
+    def __init__(self):
+        self.calls = 0
+
+    def generate(self, prompt, params, safety_settings=None):
+        self.calls += 1
+        return LLMResponse("ok", input_tokens=1, output_tokens=1)
+
+
+class _Governor:
+    def __init__(self):
+        self.limited = False
+
+    def acquire(self, input_tokens, output_tokens, block=True):
+        if self.limited:
+            raise RateLimitedError("no quota")
+        return None
+
+    def settle(self, reservation, input_tokens=None, output_tokens=None):
+        pass
+
+
+class HalfOpenRateLimitTest(unittest.TestCase):
+    def test_rate_limited_trial_does_not_keep_breaker_open(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.0)
+        breaker.record_failure()
+        governor = _Governor()
+        inner = _Backend()
+        backend = ResilientBackend(inner, max_attempts=1, breaker=breaker, governor=governor)
+        backend.hedging_enabled = False
+
+        governor.limited = True
+        with self.assertRaises(RateLimitedError):
+            backend.generate("prompt", GenerationParams())
+        self.assertEqual(inner.calls, 0)
+
+        governor.limited = False
+        try:
+            response = backend.generate("prompt", GenerationParams())
+        except CircuitOpenError:
+            self.fail("the rate-limited trial left the breaker stuck half-open")
+        self.assertEqual(response.text, "ok")
+        self.assertEqual(breaker.state, "closed")
+
+
+if __name__ == "__main__":
+    unittest.main()
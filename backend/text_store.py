@@ -0,0 +1,58 @@
+import io
+import codecs
+import hashlib
+import logging
+from typing import BinaryIO, Iterator, Tuple
+
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+# Extracted text is mostly Hebrew prose; level 3 gets most of the ratio at a fraction of the CPU of higher levels
+COMPRESSION_LEVEL = 3
+# Suffix of compressed text objects; older uploads stored plain UTF-8 under extracted.txt
+COMPRESSED_SUFFIX = ".zst"
+CONTENT_TYPE = "application/zstd"
+
+
+def text_hash(text: str) -> str:
+    """SHA-256 of the UTF-8 text, stored on the upload to detect changed extraction output."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def compress_text(text: str) -> Tuple[bytes, str]:
+    """Compress extracted text for storage; returns (zstd frame, text hash)."""
+    data = text.encode('utf-8')
+    compressed = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(data)
+    logger.info(f"Compressed extracted text {len(data)} -> {len(compressed)} bytes")
+    return compressed, hashlib.sha256(data).hexdigest()
+
+
+def iter_text(source: BinaryIO, chunk_size: int = 64 * 1024) -> Iterator[str]:
+    """
+    Stream decoded text out of a compressed object without holding the whole
+    decompressed payload as bytes. Multi-byte characters split across chunk
+    boundaries are handled by the incremental decoder.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with zstandard.ZstdDecompressor().stream_reader(source, closefd=False) as reader:
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def read_text(source: BinaryIO) -> str:
+    """Read a whole compressed text object from a file-like source."""
+    return ''.join(iter_text(source))
+
+
+def decompress_text(data: bytes) -> str:
+    """Decompress a text object already held in memory."""
+    return read_text(io.BytesIO(data))
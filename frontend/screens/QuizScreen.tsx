@@ -65,6 +65,7 @@ export default function QuizScreen() {
     showFeedback: false,
   });
   const [resultsSaved, setResultsSaved] = useState(false);
+  const [loadingExplanations, setLoadingExplanations] = useState(false);
   
   // Load quiz questions (would fetch from API in a real app)
   useEffect(() => {
@@ -180,7 +181,8 @@ export default function QuizScreen() {
               question,
               options,
               correctAnswer,
-              explanation: q.explanation || 'לא נמצא הסבר לשאלה זו'
+              // Explanations may be generated lazily by the server - wrong answers get theirs on completion
+              explanation: q.explanation || ''
             });
             
           } catch (err) {
@@ -223,7 +225,13 @@ export default function QuizScreen() {
   const saveQuizResults = async (score: number) => {
     if (resultsSaved) return; // Prevent duplicate saves
     
+    // Wrong answers without an explanation get theirs in one batch with the results
+    const wrongQuestionIds = questions
+      .filter((q, index) => quizState.answers[index] !== q.correctAnswer && !q.explanation)
+      .map(q => q.id);
+    
     try {
+      setLoadingExplanations(wrongQuestionIds.length > 0);
       const { data: { session } } = await supabase.auth.getSession();
       const token = session?.access_token;
       
@@ -246,7 +254,8 @@ export default function QuizScreen() {
         body: JSON.stringify({
           answers: quizState.answers,
           score: score,
-          question_count: questions.length
+          question_count: questions.length,
+          wrong_question_ids: wrongQuestionIds
         })
       });
       
@@ -258,8 +267,14 @@ export default function QuizScreen() {
       console.log("Quiz results saved successfully:", data);
       setResultsSaved(true);
       
+      const explanations: Record<string, string> = data.explanations || {};
+      if (Object.keys(explanations).length > 0) {
+        setQuestions(prev => prev.map(q => explanations[q.id] ? { ...q, explanation: explanations[q.id] } : q));
+      }
     } catch (error) {
       console.error('Error saving quiz results:', error);
+    } finally {
+      setLoadingExplanations(false);
     }
   };
   
@@ -380,6 +395,15 @@ export default function QuizScreen() {
                         `\nהתשובה הנכונה: ${correctAnswerText}`
                       }
                     </Text>
+                    {userAnswer !== question.correctAnswer && (
+                      loadingExplanations && !question.explanation ? (
+                        <ActivityIndicator size="small" />
+                      ) : (
+                        <Text style={styles.explanationText}>
+                          {question.explanation || 'לא נמצא הסבר לשאלה זו'}
+                        </Text>
+                      )
+                    )}
                   </View>
                 </View>
               );
@@ -495,9 +519,11 @@ export default function QuizScreen() {
               ]}>
                 {isCorrect ? '✓ תשובה נכונה!' : '✗ תשובה שגויה'}
               </Text>
-              <Text style={styles.explanationText}>
-                {currentQuestion.explanation}
-              </Text>
+              {(currentQuestion.explanation || !isCorrect) ? (
+                <Text style={styles.explanationText}>
+                  {currentQuestion.explanation || 'ההסבר יופיע בסיכום הבוחן'}
+                </Text>
+              ) : null}
             </View>
           )}
           